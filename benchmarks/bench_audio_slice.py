@@ -0,0 +1,126 @@
+"""Compares the in-memory audio slicing pipeline against the old file based one.
+
+Each mode runs in its own process, so that the peak RSS of one doesn't hide the
+other. Recognition is measured up to the signature being generated, as sending it to
+Shazam is the same for both modes.
+
+    python3 -m benchmarks.bench_audio_slice --iterations 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import ffmpeg
+from shazamio import Shazam
+
+from src import conversion
+
+_shazam = Shazam()
+
+
+def create_fixture(path: str, duration: int) -> None:
+    (
+        ffmpeg.input(f"sine=frequency=440:duration={duration}", f="lavfi")
+        .output(path, acodec="libvorbis", ac=2, ar=44_100)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+async def run_file(input_path: str, time_start: int, time_duration: int) -> None:
+    """The pipeline as it was, with `ffmpeg` writing to disk and Shazam reading it."""
+    loop = asyncio.get_event_loop()
+
+    with TemporaryDirectory() as path_temp:
+        path_output = os.path.join(path_temp, "output.ogg")
+
+        cmd = ffmpeg.input(
+            filename=input_path, ss=str(time_start), t=time_duration
+        ).output(path_output, vn=None)
+
+        await loop.run_in_executor(None, lambda: cmd.run(quiet=True))
+        await _shazam.core_recognizer.recognize_path(value=path_output, options=None)
+
+
+async def run_memory(input_path: str, time_start: int, time_duration: int) -> None:
+    data = await conversion.audio_slice(input_path, time_start, time_duration)
+
+    await _shazam.core_recognizer.recognize_bytes(
+        value=conversion.pcm_to_wav(data), options=None
+    )
+
+
+async def run_mode(mode: str, input_path: str, iterations: int) -> dict:
+    func = run_memory if mode == "memory" else run_file
+    timings = []
+
+    for index in range(iterations):
+        time_begin = time.perf_counter()
+        await func(input_path, (index * 15) % 240, 15)
+        timings.append(time.perf_counter() - time_begin)
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "mode": mode,
+        "iterations": iterations,
+        "latency_mean_ms": statistics.mean(timings) * 1000,
+        "latency_p50_ms": statistics.median(timings) * 1000,
+        "latency_max_ms": max(timings) * 1000,
+        # Linux reports these in kilobytes.
+        "peak_rss_kb": usage_self.ru_maxrss,
+        "peak_rss_ffmpeg_kb": usage_children.ru_maxrss,
+        "disk_writes_blocks": usage_self.ru_oublock + usage_children.ru_oublock,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--mode", choices=("file", "memory"))
+    parser.add_argument("--input", help="media to slice, a tone is used by default")
+    args = parser.parse_args()
+
+    if args.mode:
+        result = asyncio.run(run_mode(args.mode, args.input, args.iterations))
+        return print(json.dumps(result))
+
+    with TemporaryDirectory() as path_temp:
+        input_path = args.input
+
+        if input_path is None:
+            input_path = os.path.join(path_temp, "fixture.ogg")
+            create_fixture(input_path, 300)
+
+        results = []
+
+        for mode in ("file", "memory"):
+            output = subprocess.check_output(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_audio_slice",
+                    "--mode",
+                    mode,
+                    "--input",
+                    input_path,
+                    "--iterations",
+                    str(args.iterations),
+                ]
+            )
+            results.append(json.loads(output))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Measures how long `/convert` takes for each output format, with and without an
+upload limit to fit, along with how large the output is, in a given speed tier.
+
+Each preset runs in its own process, so that the peak RSS of one doesn't hide
+another's.
+
+    python3 -m benchmarks.bench_conversion --iterations 3 --tier fast
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+import ffmpeg
+
+from src import conversion
+
+# Each preset, with the extension to convert to and the size it has to fit in.
+PRESETS = {
+    "mp4": (".mp4", None),
+    "mp4-8mb": (".mp4", 8 * 1024 * 1024),
+    "webm-8mb": (".webm", 8 * 1024 * 1024),
+    "gif": (".gif", None),
+    "gif-8mb": (".gif", 8 * 1024 * 1024),
+    "gif-split": (".gif", None),
+    "mp3": (".mp3", None),
+    "flac-8mb": (".flac", 8 * 1024 * 1024),
+}
+
+
+async def gif_split(input_path: str, output_path: str) -> None:
+    """Convert to a GIF in one pass, picking the palette from every frame. This
+    holds every frame until the palette is known, and is what `video_to_gif` did
+    before picking the palette separately."""
+    split = (
+        ffmpeg.input(input_path)
+        .video.filter("scale", 360, -1, flags="lanczos")
+        .filter("fps", fps=15)
+        .split()
+    )
+
+    cmd = (
+        ffmpeg.filter(
+            [split[1], split[0].filter("palettegen", max_colors=32)],
+            "paletteuse",
+            dither="bayer",
+        )
+        .output(output_path)
+        .overwrite_output()
+    )
+
+    await conversion.run_ffmpeg(cmd)
+
+
+def create_fixture(path: str, duration: int) -> None:
+    video = ffmpeg.input(f"testsrc2=size=1280x720:rate=30:d={duration}", f="lavfi")
+    audio = ffmpeg.input(f"sine=frequency=440:d={duration}", f="lavfi")
+
+    (
+        ffmpeg.output(
+            video,
+            audio,
+            path,
+            vcodec="libx264",
+            video_bitrate="4M",
+            acodec="aac",
+            audio_bitrate="192k",
+            pix_fmt="yuv420p",
+        )
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+async def run_preset(
+    preset: str, input_path: str, iterations: int, tier: conversion.SpeedTier
+) -> dict:
+    extension, target_size = PRESETS[preset]
+    timings = []
+    size: Optional[int] = None
+
+    with TemporaryDirectory() as path_temp:
+        output_path = os.path.join(path_temp, f"output{extension}")
+
+        for _ in range(iterations):
+            time_begin = time.perf_counter()
+
+            if preset == "gif-split":
+                await gif_split(input_path, output_path)
+            else:
+                await conversion.video(
+                    input_path,
+                    output_path,
+                    target_size=target_size,
+                    tier=tier,
+                    threads=os.cpu_count(),
+                )
+
+            timings.append(time.perf_counter() - time_begin)
+
+            size = os.path.getsize(output_path)
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "preset": preset,
+        "tier": tier.value,
+        "iterations": iterations,
+        "input_size": os.path.getsize(input_path),
+        "output_size": size,
+        "target_size": target_size,
+        "latency_mean_ms": statistics.mean(timings) * 1000,
+        "latency_p50_ms": statistics.median(timings) * 1000,
+        "latency_max_ms": max(timings) * 1000,
+        # Linux reports these in kilobytes.
+        "peak_rss_kb": usage_self.ru_maxrss,
+        "peak_rss_ffmpeg_kb": usage_children.ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--preset", choices=PRESETS, nargs="+", default=list(PRESETS))
+    parser.add_argument("--input", help="video to convert, a test card by default")
+    parser.add_argument(
+        "--tier",
+        choices=[tier.value for tier in conversion.SpeedTier],
+        default=conversion.SpeedTier.SMALL.value,
+    )
+    parser.add_argument(
+        "--duration", type=int, default=30, help="length of the test card in seconds"
+    )
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        tier = conversion.SpeedTier(args.tier)
+        result = asyncio.run(
+            run_preset(args.preset[0], args.input, args.iterations, tier)
+        )
+        return print(json.dumps(result))
+
+    with TemporaryDirectory() as path_temp:
+        input_path = args.input
+
+        if input_path is None:
+            input_path = os.path.join(path_temp, "fixture.mp4")
+            create_fixture(input_path, args.duration)
+
+        results = []
+
+        for preset in args.preset:
+            output = subprocess.check_output(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_conversion",
+                    "--run",
+                    "--preset",
+                    preset,
+                    "--input",
+                    input_path,
+                    "--iterations",
+                    str(args.iterations),
+                    "--tier",
+                    args.tier,
+                ]
+            )
+            results.append(json.loads(output))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
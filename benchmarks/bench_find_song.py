@@ -0,0 +1,275 @@
+"""Measures `find_song` from end to end without touching the network: the latency of
+requests when nothing is cached, and again when everything is, followed by the
+throughput of increasing numbers of requests at once.
+
+Media is served from a local HTTP server standing in for a CDN, yt-dlp is replaced
+with an extractor pointing every link at it, and Shazam with a recognizer which
+takes a fixed time to answer. Redis isn't used unless `--redis` is given.
+
+    python3 -m benchmarks.bench_find_song --requests 32 --concurrency 1 4 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import time
+from collections import Counter
+from tempfile import TemporaryDirectory
+from typing import List, Optional
+from urllib import parse
+
+import ffmpeg
+from aiohttp import web
+
+from src import cache, downloader, recognition, shazam
+
+from .bench_partial_fetch import create_app
+
+WINDOW_DURATION = 15
+
+
+def create_fixture(path: str, duration: int) -> None:
+    # Noise under a tone, so that no two windows share a fingerprint.
+    source = (
+        f"anoisesrc=c=pink:a=0.3:r=44100:d={duration}[noise];"
+        f"sine=frequency=440:sample_rate=44100:d={duration}[tone];"
+        "[noise][tone]amix=inputs=2"
+    )
+
+    (
+        ffmpeg.input(source, f="lavfi")
+        .output(path, acodec="libopus", audio_bitrate="64k", ac=2)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+class FakeYoutubeDL:
+    """Stands in for `YoutubeDL`, treating every link as a direct link to media of
+    a known duration, identified by its `id` query parameter."""
+
+    duration: int = 0
+    latency: float = 0
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+
+    def __enter__(self) -> "FakeYoutubeDL":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def extract_info(self, link: str, download: bool = False) -> dict:
+        time.sleep(self.latency)
+
+        return {
+            "id": parse.parse_qs(parse.urlparse(link).query)["id"][0],
+            "extractor_key": "Generic",
+            "url": link,
+            "ext": "ogg",
+            "duration": self.duration,
+        }
+
+
+class FakeRecognizer(recognition.Recognizer):
+    """Stands in for Shazam, finding the same song after a fixed delay."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def recognize(self, data: bytes) -> dict:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+        return {
+            "matches": [{"id": "0", "offset": 0}],
+            "track": {
+                "title": "Title",
+                "subtitle": "Artist",
+                "images": {},
+                "sections": [{"type": "SONG", "metadata": []}],
+            },
+        }
+
+
+def _percentiles(timings: List[float]) -> dict:
+    ordered = sorted(timings)
+
+    def _at(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+    return {
+        "latency_mean_ms": statistics.mean(ordered) * 1000,
+        "latency_p50_ms": _at(0.5),
+        "latency_p95_ms": _at(0.95),
+        "latency_p99_ms": _at(0.99),
+        "latency_max_ms": ordered[-1] * 1000,
+    }
+
+
+def _peak_rss() -> dict:
+    # Linux reports these in kilobytes.
+    return {
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_rss_ffmpeg_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+async def _timed(link: str, time_start: int, timings: List[float]) -> None:
+    time_begin = time.perf_counter()
+    await shazam.find_song(link, time_start, WINDOW_DURATION)
+    timings.append(time.perf_counter() - time_begin)
+
+
+async def run_phase(
+    name: str,
+    links: List[str],
+    duration: int,
+    concurrency: int,
+    recognizer: FakeRecognizer,
+) -> dict:
+    """Find songs for every link, at most `concurrency` at once. Each link gets its
+    own window of the fixture, so the fingerprint cache doesn't join them up."""
+    limit = asyncio.Semaphore(concurrency)
+    timings: List[float] = []
+    windows = duration // WINDOW_DURATION
+    calls = recognizer.calls
+
+    async def _request(index: int, link: str) -> None:
+        async with limit:
+            time_start = (index % windows) * WINDOW_DURATION
+            await _timed(link, time_start, timings)
+
+    time_begin = time.perf_counter()
+    await asyncio.gather(*[_request(index, link) for index, link in enumerate(links)])
+    elapsed = time.perf_counter() - time_begin
+
+    return {
+        "phase": name,
+        "requests": len(links),
+        "concurrency": concurrency,
+        "recognized": recognizer.calls - calls,
+        "throughput_per_second": len(links) / elapsed,
+        **_percentiles(timings),
+        **_peak_rss(),
+    }
+
+
+def _use_cache(redis_host: Optional[str]) -> cache.Cache:
+    # Nothing listens on port 1, so the in-memory fallback is used straight away.
+    instance = cache.Cache(redis_host or "redis://127.0.0.1:1", health_interval=3600)
+    cache._cache = instance
+
+    return instance
+
+
+async def run(
+    requests: int,
+    concurrency: List[int],
+    duration: int,
+    extract_latency: float,
+    recognize_latency: float,
+    redis_host: Optional[str],
+) -> list:
+    results = []
+
+    FakeYoutubeDL.duration = duration
+    FakeYoutubeDL.latency = extract_latency
+    shazam.YoutubeDL = FakeYoutubeDL
+
+    recognizer = FakeRecognizer(recognize_latency)
+    recognition.set_recognizer(recognizer)
+
+    with TemporaryDirectory() as path_temp:
+        create_fixture(os.path.join(path_temp, "fixture.ogg"), duration)
+
+        runner = web.AppRunner(create_app(path_temp, Counter()))
+        await runner.setup()
+
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+
+        # Unique to this run, so that nothing is cached in Redis by a previous one.
+        run_id = int(time.time())
+
+        def _links(phase: str) -> List[str]:
+            return [
+                f"http://127.0.0.1:{port}/fixture.ogg?id={run_id}-{phase}-{index}"
+                for index in range(requests)
+            ]
+
+        try:
+            instance = _use_cache(redis_host)
+            links = _links("latency")
+
+            for phase in ("cold", "cached"):
+                results.append(await run_phase(phase, links, duration, 1, recognizer))
+
+            await instance.close()
+
+            for count in concurrency:
+                instance = _use_cache(redis_host)
+
+                results.append(
+                    await run_phase(
+                        "concurrent",
+                        _links(f"concurrent-{count}"),
+                        duration,
+                        count,
+                        recognizer,
+                    )
+                )
+
+                await instance.close()
+        finally:
+            await downloader.close()
+            await runner.cleanup()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument(
+        "--duration", type=int, default=600, help="length of the fixture in seconds"
+    )
+    parser.add_argument(
+        "--extract-latency",
+        type=float,
+        default=0.2,
+        help="how long extracting a link takes, in seconds",
+    )
+    parser.add_argument(
+        "--recognize-latency",
+        type=float,
+        default=0.3,
+        help="how long recognizing a window takes, in seconds",
+    )
+    parser.add_argument("--redis", help="Redis to cache in, instead of memory")
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run(
+            args.requests,
+            args.concurrency,
+            args.duration,
+            args.extract_latency,
+            args.recognize_latency,
+            args.redis,
+        )
+    )
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Compares how many bytes are transferred to recognize a window of a direct link,
+between `ffmpeg` reading the link itself and only fetching the ranges it needs.
+
+Fixtures in a few containers are served from a local HTTP server supporting range
+requests, which counts the bytes it sends.
+
+    python3 -m benchmarks.bench_partial_fetch --iterations 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from collections import Counter
+from tempfile import TemporaryDirectory
+
+import ffmpeg
+from aiohttp import web
+
+from src import conversion, downloader, partial
+
+SERVER_CHUNK_SIZE = 16 * 1024
+
+# Each fixture, along with the arguments to encode it with.
+FIXTURES = {
+    "mp4": {"acodec": "aac", "audio_bitrate": "96k", "movflags": "+faststart"},
+    "m4a": {
+        "acodec": "aac",
+        "audio_bitrate": "96k",
+        "f": "mp4",
+        "movflags": "+frag_keyframe+empty_moov+default_base_moof+global_sidx",
+        "frag_duration": 5_000_000,
+    },
+    "webm": {"acodec": "libopus", "audio_bitrate": "64k"},
+    "ogg": {"acodec": "libopus", "audio_bitrate": "64k"},
+    "mp3": {"acodec": "libmp3lame", "audio_bitrate": "128k"},
+}
+
+
+def create_fixture(path: str, duration: int, **kwargs) -> None:
+    # A tone which changes every ten seconds, so windows can be told apart.
+    source = f"aevalsrc=0.5*sin(2*PI*(200+40*floor(t/10))*t):s=44100:d={duration}"
+
+    (
+        ffmpeg.input(source, f="lavfi")
+        .output(path, ac=2, **kwargs)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+def create_app(path_root: str, bytes_sent: Counter) -> web.Application:
+    async def handle(request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+
+        with open(os.path.join(path_root, name), "rb") as file:
+            data = file.read()
+
+        http_range = request.http_range
+        start, stop, _ = http_range.indices(len(data))
+
+        if http_range.start is None and http_range.stop is None:
+            resp = web.StreamResponse(headers={"Accept-Ranges": "bytes"})
+        else:
+            resp = web.StreamResponse(
+                status=206,
+                headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(data)}"},
+            )
+
+        resp.content_length = stop - start
+        await resp.prepare(request)
+
+        # Written a chunk at a time, so that only what was sent before the client
+        # hung up is counted.
+        for offset in range(start, stop, SERVER_CHUNK_SIZE):
+            chunk = data[offset : min(stop, offset + SERVER_CHUNK_SIZE)]
+
+            try:
+                await resp.write(chunk)
+            except ConnectionError:
+                break
+
+            bytes_sent[name] += len(chunk)
+
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/{name}", handle)
+
+    return app
+
+
+async def recognize_url(link: str, time_start: int, duration: int) -> bytes:
+    return await conversion.audio_slice(link, time_start, 15)
+
+
+async def recognize_partial(link: str, time_start: int, duration: int) -> bytes:
+    async with partial.window(link, time_start, 15, duration) as (path, time_offset):
+        return await conversion.audio_slice(path, time_start - time_offset, 15)
+
+
+async def run(iterations: int, duration: int) -> list:
+    results = []
+
+    with TemporaryDirectory() as path_temp:
+        for extension, kwargs in FIXTURES.items():
+            create_fixture(
+                os.path.join(path_temp, f"fixture.{extension}"), duration, **kwargs
+            )
+
+        bytes_sent: Counter = Counter()
+
+        runner = web.AppRunner(create_app(path_temp, bytes_sent))
+        await runner.setup()
+
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            for extension in FIXTURES:
+                name = f"fixture.{extension}"
+                link = f"http://127.0.0.1:{port}/{name}"
+                size = os.path.getsize(os.path.join(path_temp, name))
+
+                for mode, func in (
+                    ("url", recognize_url),
+                    ("partial", recognize_partial),
+                ):
+                    timings = []
+                    bytes_sent.clear()
+
+                    for index in range(iterations):
+                        time_start = int(duration * (index + 0.5) / iterations)
+
+                        time_begin = time.perf_counter()
+                        await func(link, time_start, duration)
+                        timings.append(time.perf_counter() - time_begin)
+
+                    results.append(
+                        {
+                            "container": extension,
+                            "mode": mode,
+                            "iterations": iterations,
+                            "file_size": size,
+                            "bytes_per_recognition": bytes_sent[name] / iterations,
+                            "latency_mean_ms": statistics.mean(timings) * 1000,
+                            "latency_max_ms": max(timings) * 1000,
+                        }
+                    )
+        finally:
+            await downloader.close()
+            await runner.cleanup()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--duration", type=int, default=600, help="length of each fixture in seconds"
+    )
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args.iterations, args.duration)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
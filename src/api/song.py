@@ -1,4 +1,25 @@
-from typing import Optional, TypedDict
+import json
+from typing import List, Optional, Tuple, TypedDict
+
+# Version of the binary encoding, in the first byte of each encoded song. Anything
+# starting with `{` is instead a song from before, encoded as JSON.
+ENCODING_VERSION = 1
+
+# Fields in the order they are encoded in.
+FIELDS = ("title", "artist", "album", "album_art", "label", "release_year")
+
+# Album art from Shazam nearly always starts and ends with one of these, so only the
+# index of each is stored. Changing them needs a new encoding version.
+ALBUM_ART_PREFIXES = (
+    "",
+    "https://is1-ssl.mzstatic.com/image/thumb/",
+    "https://is2-ssl.mzstatic.com/image/thumb/",
+    "https://is3-ssl.mzstatic.com/image/thumb/",
+    "https://is4-ssl.mzstatic.com/image/thumb/",
+    "https://is5-ssl.mzstatic.com/image/thumb/",
+    "https://images.shazam.com/coverart/",
+)
+ALBUM_ART_SUFFIXES = ("", "/400x400cc.jpg", "/800x800cc.jpg")
 
 
 class Song(TypedDict):
@@ -48,3 +69,138 @@ def create(data: dict) -> Optional[Song]:
         label=_find_section_data("Label"),
         release_year=_find_section_data("Release"),
     )
+
+
+def _encode_varint(value: int) -> bytes:
+    data = bytearray()
+
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+
+    data.append(value)
+    return bytes(data)
+
+
+def _decode_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return value, offset
+
+
+def _split_album_art(value: str) -> Tuple[int, str]:
+    prefix = max(
+        (index for index, p in enumerate(ALBUM_ART_PREFIXES) if value.startswith(p)),
+        key=lambda index: len(ALBUM_ART_PREFIXES[index]),
+    )
+    value = value[len(ALBUM_ART_PREFIXES[prefix]) :]
+
+    suffix = max(
+        (index for index, s in enumerate(ALBUM_ART_SUFFIXES) if value.endswith(s)),
+        key=lambda index: len(ALBUM_ART_SUFFIXES[index]),
+    )
+    value = value[: len(value) - len(ALBUM_ART_SUFFIXES[suffix])]
+
+    return suffix << 4 | prefix, value
+
+
+def encode(data: Optional[Song]) -> bytes:
+    """Encodes a song compactly, for caching.
+
+    The first byte is the encoding version, followed by a byte with a bit set for each
+    field that is present. Each present field is then stored as its length and UTF-8
+    bytes, with album art stored as indices into the common prefixes and suffixes
+    followed by the rest of the link.
+
+    Args:
+        data (Song): The song to encode, or None if no song was found.
+
+    Returns:
+        The encoded song.
+    """
+    parts: List[bytes] = []
+    present = 0
+
+    for index, field in enumerate(FIELDS):
+        value = (data or {}).get(field)
+
+        if value is None:
+            continue
+
+        present |= 1 << index
+
+        if field == "album_art":
+            affixes, value = _split_album_art(value)
+            parts.append(bytes([affixes]))
+
+        value_bytes = value.encode("utf-8")
+        parts.append(_encode_varint(len(value_bytes)) + value_bytes)
+
+    return bytes([ENCODING_VERSION, present]) + b"".join(parts)
+
+
+def is_legacy(data: bytes) -> bool:
+    """Whether a cached song was encoded as JSON, before the binary encoding."""
+    return data[:1] == b"{"
+
+
+def decode(data: bytes) -> dict:
+    """Decodes a cached song, in either the binary encoding or as legacy JSON.
+
+    Args:
+        data (bytes): The encoded song.
+
+    Returns:
+        The song, or an empty dictionary if no song was found.
+
+    Raises:
+        ValueError: The song was encoded with an unknown version.
+    """
+    if is_legacy(data):
+        data_decoded = json.loads(data.decode("utf-8"))
+        return Song(**data_decoded) if data_decoded else {}
+
+    if data[0] != ENCODING_VERSION:
+        raise ValueError(f"Unknown song encoding version {data[0]}")
+
+    present = data[1]
+
+    if present == 0:
+        return {}
+
+    values = {}
+    offset = 2
+
+    for index, field in enumerate(FIELDS):
+        if not present & 1 << index:
+            values[field] = None
+            continue
+
+        affixes = None
+
+        if field == "album_art":
+            affixes = data[offset]
+            offset += 1
+
+        length, offset = _decode_varint(data, offset)
+        value = data[offset : offset + length].decode("utf-8")
+        offset += length
+
+        if affixes is not None:
+            value = (
+                ALBUM_ART_PREFIXES[affixes & 0x0F]
+                + value
+                + ALBUM_ART_SUFFIXES[affixes >> 4]
+            )
+
+        values[field] = value
+
+    return Song(**values)
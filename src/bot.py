@@ -1,9 +1,11 @@
 import logging
 import os
+import time
 
 import discord
 from discord import app_commands
 
+from . import cache, downloader, metrics
 from .commands.convert import convert
 from .commands.extract import extract
 from .commands.shazam import shazam_group
@@ -17,10 +19,40 @@ GUILDS_SYNC = [
 ]
 
 
+def _observe_command(interaction: discord.Interaction, outcome: str) -> None:
+    time_started = interaction.extras.get("time_started")
+
+    if time_started is None or interaction.command is None:
+        return
+
+    metrics.COMMAND_SECONDS.observe(
+        time.perf_counter() - time_started,
+        interaction.command.qualified_name,
+        outcome,
+    )
+
+
+class CommandTree(app_commands.CommandTree):
+    """Times every command, from when it is received until it returns or raises."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["time_started"] = time.perf_counter()
+        return True
+
+    async def on_error(
+        self,
+        interaction: discord.Interaction,
+        error: app_commands.AppCommandError,
+    ):
+        _observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+
 class Client(discord.Client):
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
+        self.tree = CommandTree(self)
+        self.metrics_runner = None
 
     async def setup_hook(self):
         mode = os.getenv("CMD_MODE", "dev")
@@ -35,6 +67,16 @@ class Client(discord.Client):
 
         else:
             await self.tree.sync()
+
+        self.metrics_runner = await metrics.start_server()
+
+    async def close(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+        await cache.close()
+        await downloader.close()
+        await super().close()
     
 intents = discord.Intents.default()
 bot = Client(intents=intents)
@@ -46,3 +88,8 @@ bot.tree.add_command(convert)
 @bot.event
 async def on_ready():
     log.info(f"Logged in as {bot.user}")
+
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    _observe_command(interaction, "ok")
@@ -0,0 +1,173 @@
+"""Finds songs for many links at once, printing each result as a line of JSON as soon
+as it is found.
+
+Each line of the input is a link, optionally followed by the timestamp to search from
+and which item of a playlist to use, separated by spaces.
+
+    python3 -m src.bulk links.txt > songs.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from typing import Iterable, Optional, TextIO, Tuple
+
+from . import cache, downloader, shazam
+from .utility import timestamp_to_seconds
+
+
+def parse_line(line: str) -> Optional[Tuple[str, Optional[int], int]]:
+    """Parse a line of input into a link, timestamp, and playlist index.
+
+    Returns:
+        The parsed request, or None for blank lines and comments.
+
+    Raises:
+        ValueError: The timestamp or playlist index isn't a number.
+    """
+    parts = line.split()
+
+    if not parts or parts[0].startswith("#"):
+        return
+
+    time_start = None
+
+    if len(parts) > 1 and parts[1] != "-":
+        try:
+            time_start = timestamp_to_seconds(parts[1])
+        except ValueError as e:
+            raise ValueError(f"invalid timestamp: {parts[1]}") from e
+
+    playlist_index = 1
+
+    if len(parts) > 2:
+        try:
+            playlist_index = int(parts[2])
+        except ValueError as e:
+            raise ValueError(f"invalid playlist index: {parts[2]}") from e
+
+    return parts[0], time_start, playlist_index
+
+
+async def run(
+    lines: Iterable[str],
+    output: TextIO,
+    time_duration: int,
+    extract_concurrency: int,
+    slice_concurrency: int,
+    recognize_concurrency: int,
+    use_cache: bool,
+) -> int:
+    """Find songs for each line of input, writing each result to the output. Lines
+    that can't be parsed are written first, as failures.
+
+    Returns:
+        How many of the requests failed.
+    """
+    failures = 0
+
+    # Where each request is among the lines that weren't blank or comments, so that
+    # results are numbered the same whether or not their line could be parsed.
+    requests = []
+    indexes = []
+    index = 0
+
+    def _write(result: shazam.BulkResult) -> None:
+        nonlocal failures
+        failures += result["error"] is not None
+
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    for line in lines:
+        try:
+            request = parse_line(line)
+        except ValueError as e:
+            _write(
+                shazam.BulkResult(
+                    index=index,
+                    link=line.split()[0],
+                    time_start=None,
+                    song=None,
+                    error=str(e),
+                )
+            )
+            index += 1
+            continue
+
+        if request is not None:
+            requests.append(request)
+            indexes.append(index)
+            index += 1
+
+    try:
+        async for result in shazam.find_songs(
+            requests,
+            time_duration=time_duration,
+            extract_concurrency=extract_concurrency,
+            slice_concurrency=slice_concurrency,
+            recognize_concurrency=recognize_concurrency,
+            use_cache=use_cache,
+        ):
+            result["index"] = indexes[result["index"]]
+            _write(result)
+    finally:
+        await cache.close()
+        await downloader.close()
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        type=argparse.FileType("r"),
+        default=sys.stdin,
+        help="file of links, one per line (default: stdin)",
+    )
+    parser.add_argument(
+        "--duration", type=int, default=15, help="length of each sample in seconds"
+    )
+    parser.add_argument(
+        "--extract-concurrency", type=int, default=shazam.BULK_EXTRACT_CONCURRENCY
+    )
+    parser.add_argument(
+        "--slice-concurrency", type=int, default=shazam.BULK_SLICE_CONCURRENCY
+    )
+    parser.add_argument(
+        "--recognize-concurrency", type=int, default=shazam.BULK_RECOGNIZE_CONCURRENCY
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="don't use or update the cache"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] [%(name)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    failures = asyncio.run(
+        run(
+            args.input,
+            sys.stdout,
+            args.duration,
+            args.extract_concurrency,
+            args.slice_concurrency,
+            args.recognize_concurrency,
+            not args.no_cache,
+        )
+    )
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,77 +1,985 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
-from typing import Any, Dict, Optional
+import struct
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+import numpy as np
 
 from redis import asyncio as aioredis
-from redis.exceptions import ConnectionError
+from redis.exceptions import RedisError
 
+from . import fingerprint, metrics
 from .api import song
+from .utility import normalize_url, url_expiry
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class MemoryCache:
+    """In-memory LRU cache, bounded by both its number of entries and their total
+    size, where each entry can have its own expiry.
+
+    Args:
+        max_entries (int): How many entries can be stored before the least recently
+            used ones are evicted.
+        max_bytes (int): How many bytes (of keys and values) can be stored before the
+            least recently used entries are evicted.
+        default_ttl (int): How long entries are kept for, in seconds, if no TTL is
+            given when setting them. None to keep them until they are evicted.
+        clock (Callable): Where to get the current time from, in seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        default_ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+
+        self._clock = clock
+
+        # Maps each key to its value and when it expires, oldest used first.
+        self._items: OrderedDict[str, Tuple[bytes, Optional[float]]] = OrderedDict()
+        self._bytes: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: str) -> bool:
+        return self._peek(key) is not None
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def _peek(self, key: str) -> Optional[bytes]:
+        item = self._items.get(key)
+
+        if item is None:
+            return
+
+        value, expires_at = item
+
+        if expires_at is not None and expires_at <= self._clock():
+            self.delete(key)
+            self.expirations += 1
+            return
+
+        return value
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._peek(key)
+
+        if value is None:
+            self.misses += 1
+            return
+
+        self._items.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl is None:
+            ttl = self.default_ttl
+
+        size = len(key) + len(value)
+
+        self.delete(key)
+
+        # Never going to fit, so don't evict everything else trying to make it.
+        if size > self.max_bytes:
+            return
+
+        expires_at = self._clock() + ttl if ttl is not None else None
+
+        self._items[key] = (value, expires_at)
+        self._bytes += size
+
+        while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._items))
+
+            self.delete(oldest)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        item = self._items.pop(key, None)
+
+        if item is not None:
+            self._bytes -= len(key) + len(item[0])
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._items),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def _encode(value: Any, encoding: str = "utf-8") -> bytes:
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+
+    return str(value).encode(encoding)
+
 
 class Cache:
-    def __init__(self, redis_host: str = "redis://localhost"):
+    """Redis backed cache, which falls back to an in-memory cache whenever Redis can't
+    be reached.
+
+    Redis is health checked in the background, and the cache switches between it and
+    the in-memory tier in both directions. Anything written while Redis was down is
+    written back to it once it recovers.
+
+    Args:
+        redis_host (str): Connection URI of the Redis host.
+        memory_entries (int): Maximum number of entries in the in-memory fallback.
+        memory_bytes (int): Maximum size of the in-memory fallback, in bytes.
+        l1_entries (int): Maximum number of entries kept in memory in front of Redis,
+            0 to disable it.
+        l1_ttl (float): How long entries are kept in memory in front of Redis, in
+            seconds.
+        pool_size (int): Maximum number of connections to Redis.
+        timeout (float): Timeout for connecting to Redis and for each command, in
+            seconds.
+        health_interval (float): How often to check whether Redis is reachable, in
+            seconds.
+        latency_budget (float): The longest any single cache operation may take, in
+            seconds, before we carry on without Redis.
+        pending_max (int): Maximum number of writes to keep for writing back to Redis
+            once it recovers.
+    """
+
+    def __init__(
+        self,
+        redis_host: str = "redis://localhost",
+        memory_entries: int = 10_000,
+        memory_bytes: int = 64 * 1024 * 1024,
+        l1_entries: int = 1_024,
+        l1_ttl: float = 60,
+        pool_size: int = 16,
+        timeout: float = 2,
+        health_interval: float = 15,
+        latency_budget: float = 0.25,
+        pending_max: int = 10_000,
+    ):
         self.redis_host = redis_host
-        self.redis_conn = aioredis.from_url(redis_host)
+        self.redis_pool = aioredis.BlockingConnectionPool.from_url(
+            redis_host,
+            max_connections=pool_size,
+            timeout=latency_budget,
+            socket_timeout=timeout,
+            socket_connect_timeout=timeout,
+        )
+        self.redis_conn = aioredis.Redis(connection_pool=self.redis_pool)
+
+        self.health_interval = health_interval
+        self.latency_budget = latency_budget
+        self.pending_max = pending_max
 
         self._have_pinged: bool = False
         self._is_using_redis: bool = True
 
+        self._health_task: Optional[asyncio.Task] = None
+        self._write_back_task: Optional[asyncio.Task] = None
+
         # Cache to use if we cannot make a connection to Redis.
-        self._cache_fallback: Dict[str, bytes] = {}
+        self._cache_fallback = MemoryCache(memory_entries, memory_bytes)
+
+        # Small cache in front of Redis for keys that were used very recently. Its
+        # entries are kept briefly, as other processes may also write to Redis.
+        self._cache_l1: Optional[MemoryCache] = None
+
+        if l1_entries > 0:
+            self._cache_l1 = MemoryCache(l1_entries, memory_bytes, default_ttl=l1_ttl)
+
+        # Writes made while Redis was unavailable (or too slow to answer), with when
+        # they expire, to write back once it recovers.
+        self._pending_writes: OrderedDict[str, Tuple[bytes, Optional[float]]] = (
+            OrderedDict()
+        )
+
+        self.timeouts: int = 0
+        self.failovers: int = 0
+
+    @property
+    def is_using_redis(self) -> bool:
+        return self._is_using_redis
 
     async def _do_redis_ping(self) -> None:
-        if not self._have_pinged:
+        if self._have_pinged:
+            return
+
+        self._have_pinged = True
+
+        if await self._ping():
+            self._is_using_redis = True
+            log.info("Successfully connected to the Redis host")
+        else:
+            self._is_using_redis = False
+            log.warning(
+                "Failed to connect to the Redis host, using fallback cache system"
+            )
+
+        self._health_task = asyncio.ensure_future(self._health_check_loop())
+
+    async def _ping(self) -> bool:
+        try:
+            await asyncio.wait_for(self.redis_conn.ping(), self.latency_budget)
+        except (asyncio.TimeoutError, RedisError, OSError):
+            return False
+
+        return True
+
+    async def _health_check_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+
+            try:
+                await self.check_health()
+            except Exception:
+                log.exception("Failed to check the health of the Redis host")
+
+    async def check_health(self) -> bool:
+        """Ping Redis, and switch to or away from it depending on the result.
+
+        Returns:
+            Whether Redis is being used after the check.
+        """
+        is_healthy = await self._ping()
+
+        if is_healthy and not self._is_using_redis:
+            log.info("Reconnected to the Redis host")
+
+            await self._write_back()
+
+            # Anything in front of Redis may be older than what it now holds.
+            if self._cache_l1 is not None:
+                self._cache_l1.clear()
+
+            self._is_using_redis = True
+        elif not is_healthy and self._is_using_redis:
+            self._set_degraded()
+
+        return self._is_using_redis
+
+    def _set_degraded(self) -> None:
+        if not self._is_using_redis:
+            return
+
+        self._is_using_redis = False
+        self.failovers += 1
+
+        log.warning("Lost connection to the Redis host, using fallback cache system")
+
+    def _add_pending(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        self._pending_writes[key] = (value, expires_at)
+        self._pending_writes.move_to_end(key)
+
+        while len(self._pending_writes) > self.pending_max:
+            self._pending_writes.popitem(last=False)
+
+    async def _write_back(self, batch_size: int = 500) -> None:
+        while self._pending_writes:
+            batch = []
+
+            while self._pending_writes and len(batch) < batch_size:
+                batch.append(self._pending_writes.popitem(last=False))
+
+            pipe = self.redis_conn.pipeline(transaction=False)
+            now = time.monotonic()
+
+            for key, (value, expires_at) in batch:
+                if expires_at is None:
+                    pipe.set(key, value)
+                elif expires_at > now:
+                    pipe.set(key, value, px=int((expires_at - now) * 1000))
+
             try:
-                await self.redis_conn.ping()
+                await pipe.execute()
+            except (RedisError, OSError):
+                # Put them back for the next time Redis recovers.
+                for key, (value, expires_at) in batch:
+                    self._pending_writes.setdefault(key, (value, expires_at))
+
+                raise
+
+        log.info("Wrote back all pending writes to the Redis host")
+
+    def _get_pending(self, key: str) -> Optional[bytes]:
+        pending = self._pending_writes.get(key)
+
+        if pending is None:
+            return
+
+        value, expires_at = pending
 
-                self._is_using_redis = True
-                log.info("Successfully connected to the Redis host")
-            except ConnectionError:
-                self._is_using_redis = False
-                log.warning(
-                    "Failed to connect to the Redis host, using fallback cache system"
-                )
+        if expires_at is not None and expires_at <= time.monotonic():
+            return
 
-            self._have_pinged = True
+        return value
 
+    def _schedule_write_back(self) -> None:
+        """Write back writes that timed out while Redis was still healthy, without
+        holding up the call that found it answering again."""
+        if self._write_back_task is not None and not self._write_back_task.done():
+            return
+
+        self._write_back_task = asyncio.ensure_future(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        try:
+            await self._write_back()
+        except (RedisError, OSError):
+            log.debug("Failed to write back pending writes, will try again later")
+
+    async def _redis_call(self, coro: Awaitable[T]) -> Tuple[bool, Optional[T]]:
+        try:
+            result = await asyncio.wait_for(coro, self.latency_budget)
+        except asyncio.TimeoutError:
+            # A single slow call doesn't mean that Redis is down, leave that up to the
+            # health checks.
+            self.timeouts += 1
+            log.debug("Redis call exceeded the latency budget")
+        except (RedisError, OSError):
+            self._set_degraded()
+        else:
+            if self._pending_writes and self._is_using_redis:
+                self._schedule_write_back()
+
+            return True, result
+
+        return False, None
+
+    @metrics.timed("cache_get")
     async def get(self, key: str) -> Optional[bytes]:
         await self._do_redis_ping()
 
+        if not self._is_using_redis:
+            return self._cache_fallback.get(key)
+
+        if self._cache_l1 is not None:
+            value = self._cache_l1.get(key)
+
+            if value is not None:
+                return value
+
+        success, value = await self._redis_call(self.redis_conn.get(key))
+
+        if not success:
+            return self._cache_fallback.get(key)
+
+        # A write that timed out may not have reached Redis yet.
+        if value is None:
+            return self._get_pending(key)
+
+        if self._cache_l1 is not None:
+            self._cache_l1.set(key, value)
+
+        return value
+
+    @metrics.timed("cache_set")
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        encoding: str = "utf-8",
+        ttl: Optional[int] = None,
+    ) -> None:
+        await self._do_redis_ping()
+
+        value = _encode(value, encoding)
+
         if self._is_using_redis:
-            return await self.redis_conn.get(key)
+            success, _ = await self._redis_call(self.redis_conn.set(key, value, ex=ttl))
         else:
-            return self._cache_fallback.get(key)
+            success = False
+
+        if not success:
+            self._cache_fallback.set(key, value, ttl)
+            self._add_pending(key, value, ttl)
+
+            # Redis is still used for reads if the write only timed out.
+            if self._is_using_redis:
+                self._set_l1(key, value, ttl)
 
-    async def set(self, key: str, value: Any, encoding: str = "utf-8") -> None:
+            return
+
+        # Anything still waiting to be written back is older than this.
+        self._pending_writes.pop(key, None)
+        self._set_l1(key, value, ttl)
+
+    def _set_l1(self, key: str, value: bytes, ttl: Optional[int]) -> None:
+        if self._cache_l1 is None:
+            return
+
+        l1_ttl = self._cache_l1.default_ttl
+
+        if ttl is not None and l1_ttl is not None:
+            l1_ttl = min(ttl, l1_ttl)
+
+        self._cache_l1.set(key, value, l1_ttl)
+
+    @metrics.timed("cache_get")
+    async def get_many(self, keys: Iterable[str]) -> List[Optional[bytes]]:
+        """Get several keys at once, with a single round trip to Redis.
+
+        Returns:
+            The value of each key in the same order, or None for those not found.
+        """
         await self._do_redis_ping()
 
+        keys = list(keys)
+
+        if not self._is_using_redis:
+            return [self._cache_fallback.get(key) for key in keys]
+
+        values: Dict[str, Optional[bytes]] = {}
+
+        if self._cache_l1 is not None:
+            for key in keys:
+                value = self._cache_l1.get(key)
+
+                if value is not None:
+                    values[key] = value
+
+        keys_missing = list(dict.fromkeys(key for key in keys if key not in values))
+
+        if keys_missing:
+            success, found = await self._redis_call(self.redis_conn.mget(keys_missing))
+
+            if not success:
+                found = [self._cache_fallback.get(key) for key in keys_missing]
+
+            for key, value in zip(keys_missing, found):
+                if success and value is None:
+                    value = self._get_pending(key)
+
+                values[key] = value
+
+                if success and value is not None and self._cache_l1 is not None:
+                    self._cache_l1.set(key, value)
+
+        return [values.get(key) for key in keys]
+
+    @metrics.timed("cache_set")
+    async def set_many(
+        self,
+        items: Dict[str, Any],
+        encoding: str = "utf-8",
+        ttl: Optional[int] = None,
+    ) -> None:
+        """Set several keys at once, in a single pipeline to Redis."""
+        await self._do_redis_ping()
+
+        if not items:
+            return
+
+        items_encoded = {key: _encode(value, encoding) for key, value in items.items()}
+
         if self._is_using_redis:
-            await self.redis_conn.set(key, value)
+            pipe = self.redis_conn.pipeline(transaction=False)
+
+            for key, value in items_encoded.items():
+                pipe.set(key, value, ex=ttl)
+
+            success, _ = await self._redis_call(pipe.execute())
         else:
-            self._cache_fallback[key] = str(value).encode(encoding)
+            success = False
+
+        for key, value in items_encoded.items():
+            if success:
+                self._pending_writes.pop(key, None)
+                self._set_l1(key, value, ttl)
+            else:
+                self._cache_fallback.set(key, value, ttl)
+                self._add_pending(key, value, ttl)
+
+                if self._is_using_redis:
+                    self._set_l1(key, value, ttl)
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+        if self._write_back_task is not None:
+            self._write_back_task.cancel()
+            self._write_back_task = None
+
+        await self.redis_pool.disconnect()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Counters for the in-memory tiers of the cache.
+
+        Returns:
+            The hits, misses, evictions, and sizes of the fallback and L1 caches.
+        """
+        stats = {
+            "fallback": self._cache_fallback.stats(),
+            "redis": {
+                "connected": int(self._is_using_redis),
+                "pending_writes": len(self._pending_writes),
+                "timeouts": self.timeouts,
+                "failovers": self.failovers,
+            },
+        }
+
+        if self._cache_l1 is not None:
+            stats["l1"] = self._cache_l1.stats()
+
+        return stats
+
 
+_cache = Cache(
+    os.getenv("REDIS_HOST", "redis://localhost"),
+    memory_entries=int(os.getenv("CACHE_MEMORY_ENTRIES", 10_000)),
+    memory_bytes=int(os.getenv("CACHE_MEMORY_BYTES", 64 * 1024 * 1024)),
+    l1_entries=int(os.getenv("CACHE_L1_ENTRIES", 1_024)),
+    l1_ttl=float(os.getenv("CACHE_L1_TTL", 60)),
+    pool_size=int(os.getenv("REDIS_POOL_SIZE", 16)),
+    timeout=float(os.getenv("REDIS_TIMEOUT", 2)),
+    health_interval=float(os.getenv("REDIS_HEALTH_INTERVAL", 15)),
+    latency_budget=float(os.getenv("CACHE_LATENCY_BUDGET", 0.25)),
+)
 
-_cache = Cache(os.getenv("REDIS_HOST", "redis://localhost"))
+# How long identified songs are kept for, in seconds. None to keep them forever.
+SONG_TTL = int(os.getenv("CACHE_SONG_TTL", 0)) or None
 
+# How long to remember that nothing was found, in seconds. Recognition can fail
+# because of a bad sample, so these are kept for much less time than songs.
+SONG_EMPTY_TTL = int(os.getenv("CACHE_SONG_EMPTY_TTL", 6 * 3600)) or None
 
-async def set_empty_from_info(media_info: dict, scan_start: int = 0) -> None:
+# How long fingerprints of recognized audio are kept for, in seconds. None to keep
+# them forever.
+FINGERPRINT_TTL = int(os.getenv("CACHE_FINGERPRINT_TTL", 30 * 86400)) or None
+
+# How many windows each anchor remembers, newest first.
+FINGERPRINT_BUCKET_SIZE = 32
+
+# How many anchors need to agree on a window and its alignment before it is compared,
+# and how many of the best such windows are compared.
+FINGERPRINT_MIN_VOTES = 2
+FINGERPRINT_CANDIDATES = 3
+
+# Each window an anchor appears in, and where in the window it appears.
+_ANCHOR_RECORD = struct.Struct("<8sH")
+
+# Length of the encoded song which a stored fingerprint starts with.
+_FINGERPRINT_HEADER = struct.Struct("<H")
+
+# How far before a recognized window a song may be assumed to have started, in
+# seconds. Shazam reports how far into the song the window was, but in mixes the song
+# may have only been mixed in part of the way through.
+SPAN_EXTEND_MAX = 30
+
+# How many spans are kept for each piece of media, oldest dropped first.
+SPANS_MAX = 256
+
+# Where a span starts and ends, the timestamp that was actually recognized, and when
+# the span expires (0 for never), followed by the length of the encoded song.
+_SPAN_RECORD = struct.Struct("<fffIH")
+
+# How long extracted media information is kept for, in seconds.
+EXTRACT_TTL = int(os.getenv("CACHE_EXTRACT_TTL", 1800))
+
+# How long before a signed media URL expires that we should stop handing it out.
+EXTRACT_TTL_MARGIN = 120
+
+# The only fields of `YoutubeDL.extract_info` that the commands make use of.
+EXTRACT_FIELDS = (
+    "id",
+    "extractor_key",
+    "url",
+    "protocol",
+    "ext",
+    "filesize_approx",
+    "duration",
+)
+
+# How long the colors picked for making a video into a GIF are kept for, in seconds.
+PALETTE_TTL = int(os.getenv("CACHE_PALETTE_TTL", 7 * 86400)) or None
+
+# How long links to media we have already uploaded to Discord are kept for, in
+# seconds. They expire sooner if Discord's link does.
+ATTACHMENT_TTL = int(os.getenv("CACHE_ATTACHMENT_TTL", 7 * 86400))
+
+
+def _extract_key(link: str, playlist_index: int, file_format: Optional[str]) -> str:
+    link_hash = hashlib.sha1(normalize_url(link).encode("utf-8")).hexdigest()
+    key_format = ["extract", link_hash, str(playlist_index), file_format or "default"]
+
+    return "-".join(key_format)
+
+
+async def set_extract_info(
+    link: str,
+    media_info: dict,
+    playlist_index: int = 1,
+    file_format: Optional[str] = None,
+) -> None:
+    """
+    Add the extracted information for a link to the cache.
+
+    Only the fields that we make use of are kept, and the entry will expire before
+    the media URL (which is often signed by the CDN) stops working.
+
+    Args:
+        link (str): The link that the information was extracted from.
+        media_info (dict): Data we get from `YoutubeDL.extract_info`, for the entry
+            that was selected from a playlist.
+        playlist_index (int): Which item of the playlist was extracted.
+        file_format (str): The YoutubeDL format the media was extracted with.
+
+    Returns:
+        None.
+    """
+    ttl = EXTRACT_TTL
+    expires_at = url_expiry(media_info.get("url") or "")
+
+    if expires_at is not None:
+        ttl = min(ttl, int(expires_at - time.time() - EXTRACT_TTL_MARGIN))
+
+    if ttl <= 0:
+        return
+
+    value_data = {key: media_info.get(key) for key in EXTRACT_FIELDS}
+    value_encoded = json.dumps(value_data, separators=(",", ":"))
+
+    await _cache.set(
+        _extract_key(link, playlist_index, file_format), value_encoded, ttl=ttl
+    )
+
+
+async def get_extract_info(
+    link: str, playlist_index: int = 1, file_format: Optional[str] = None
+) -> Optional[dict]:
+    """
+    Get previously extracted information for a link from the cache.
+
+    Args:
+        link (str): The link that the information was extracted from.
+        playlist_index (int): Which item of the playlist was extracted.
+        file_format (str): The YoutubeDL format the media was extracted with.
+
+    Returns:
+        The cached subset of `YoutubeDL.extract_info` data, or none.
+    """
+    data = await _cache.get(_extract_key(link, playlist_index, file_format))
+    metrics.cache_lookup("extract", data)
+
+    if data is None:
+        return
+
+    return json.loads(data.decode("utf-8"))
+
+
+def _attachment_key(media_key: str) -> str:
+    return f"attachment-{media_key}"
+
+
+async def set_attachment_url(media_key: str, url: str) -> None:
+    """
+    Remember where some media was uploaded to, so that it can be linked to instead
+    of uploading it again.
+
+    Args:
+        media_key (str): What the media is stored under, from `store.media_key`
+            or `store.conversion_key`.
+        url (str): Link to the uploaded attachment.
+
+    Returns:
+        None.
+    """
+    ttl = ATTACHMENT_TTL
+    expires_at = url_expiry(url)
+
+    if expires_at is not None:
+        ttl = min(ttl, int(expires_at - time.time() - EXTRACT_TTL_MARGIN))
+
+    if ttl <= 0:
+        return
+
+    await _cache.set(_attachment_key(media_key), url, ttl=ttl)
+
+
+async def get_attachment_url(media_key: str) -> Optional[str]:
+    """
+    Get where some media was uploaded to before.
+
+    Args:
+        media_key (str): What the media is stored under, from `store.media_key`
+            or `store.conversion_key`.
+
+    Returns:
+        Link to the uploaded attachment, or none.
+    """
+    data = await _cache.get(_attachment_key(media_key))
+    metrics.cache_lookup("attachment", data)
+
+    if data is None:
+        return
+
+    return data.decode("utf-8")
+
+
+def _palette_key(digest: str, max_colors: int) -> str:
+    return f"palette-{digest}-{max_colors}"
+
+
+async def set_palettes(digest: str, palettes: Dict[int, bytes]) -> None:
+    """
+    Remember the colors picked for making a video into a GIF.
+
+    Args:
+        digest (str): Hash of the contents of the video.
+        palettes (dict): The palettes, as PNGs, by how many colors they could have.
+
+    Returns:
+        None.
+    """
+    await _cache.set_many(
+        {
+            _palette_key(digest, max_colors): data_palette
+            for max_colors, data_palette in palettes.items()
+        },
+        ttl=PALETTE_TTL,
+    )
+
+
+async def get_palettes(digest: str, max_colors: Iterable[int]) -> Dict[int, bytes]:
+    """
+    Get the colors picked for making a video into a GIF before.
+
+    Args:
+        digest (str): Hash of the contents of the video.
+        max_colors (Iterable): How many colors each palette could have.
+
+    Returns:
+        The palettes that were found, as PNGs, by how many colors they could have.
+    """
+    max_colors = list(max_colors)
+    values = await _cache.get_many(_palette_key(digest, value) for value in max_colors)
+
+    palettes = {}
+
+    for value, data in zip(max_colors, values):
+        metrics.cache_lookup("palette", data)
+
+        if data is not None:
+            palettes[value] = data
+
+    return palettes
+
+
+def _song_key(media_info: dict, scan_start: int) -> str:
+    key_format = [media_info["extractor_key"], media_info["id"], str(scan_start)]
+    return "-".join(key_format)
+
+
+def _spans_key(media_info: dict) -> str:
+    return "-".join(["spans", media_info["extractor_key"], media_info["id"]])
+
+
+class Span(NamedTuple):
+    """A stretch of media which is known to be a song, or to have nothing found."""
+
+    start: float
+    end: float
+    scan_start: float
+    expires_at: int
+    data_song: dict
+
+    def covers(self, time_start: int, time_duration: int) -> bool:
+        """Whether a window starting at the timestamp would mostly be in the span."""
+        return self.start <= time_start and time_start + time_duration / 2 <= self.end
+
+
+def _decode_spans(data: Optional[bytes], now: float) -> List[Span]:
+    spans = []
+    offset = 0
+
+    while data and offset < len(data):
+        *fields, length = _SPAN_RECORD.unpack_from(data, offset)
+        offset += _SPAN_RECORD.size
+
+        span = Span(*fields, song.decode(data[offset : offset + length]))
+        offset += length
+
+        if span.expires_at == 0 or span.expires_at > now:
+            spans.append(span)
+
+    return spans
+
+
+def _encode_spans(spans: List[Span]) -> bytes:
+    parts = []
+
+    for span in spans:
+        value_song = song.encode(span.data_song or None)
+        parts.append(
+            _SPAN_RECORD.pack(
+                span.start, span.end, span.scan_start, span.expires_at, len(value_song)
+            )
+            + value_song
+        )
+
+    return b"".join(parts)
+
+
+def _find_span(
+    spans: List[Span], time_start: int, time_duration: int
+) -> Optional[Span]:
+    covering = [span for span in spans if span.covers(time_start, time_duration)]
+
+    if not covering:
+        return
+
+    # Spans can overlap when songs were mixed into each other, in which case the one
+    # recognized closest to the timestamp is the most likely to be right.
+    return min(covering, key=lambda span: abs(span.scan_start - time_start))
+
+
+# Spans are read, updated, and written back, so concurrent updates for the same media
+# (such as from a scan) take turns. Each lock is kept with how many are using it.
+_span_locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+
+@asynccontextmanager
+async def _span_lock(key: str) -> AsyncIterator[None]:
+    lock, users = _span_locks.get(key, (asyncio.Lock(), 0))
+    _span_locks[key] = (lock, users + 1)
+
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = _span_locks[key]
+
+        if users == 1:
+            del _span_locks[key]
+        else:
+            _span_locks[key] = (lock, users - 1)
+
+
+async def _add_span(
+    media_info: dict,
+    span_start: float,
+    span_end: float,
+    scan_start: int,
+    data_song: Optional[song.Song],
+    ttl: Optional[int],
+) -> None:
+    key = _spans_key(media_info)
+    now = time.time()
+
+    async with _span_lock(key):
+        spans = _decode_spans(await _cache.get(key), now)
+        spans.append(
+            Span(
+                max(0.0, span_start),
+                span_end,
+                scan_start,
+                int(now + ttl) if ttl is not None else 0,
+                data_song or {},
+            )
+        )
+        spans = spans[-SPANS_MAX:]
+
+        # Kept for as long as the longest lived span in it.
+        spans_ttl = None
+
+        if all(span.expires_at != 0 for span in spans):
+            spans_ttl = max(span.expires_at for span in spans) - int(now)
+
+        await _cache.set(key, _encode_spans(spans), ttl=spans_ttl)
+
+
+async def get_many_extract_info(
+    requests: List[Tuple[str, int, Optional[str]]],
+) -> List[Optional[dict]]:
+    """
+    Get previously extracted information for several links from the cache, in a
+    single round trip.
+
+    Args:
+        requests (list): Each link, with which item of its playlist was extracted and
+            the YoutubeDL format it was extracted with.
+
+    Returns:
+        For each link, the cached subset of `YoutubeDL.extract_info` data, or none.
+    """
+    values = await _cache.get_many(_extract_key(*request) for request in requests)
+
+    return [json.loads(value.decode("utf-8")) if value else None for value in values]
+
+
+async def set_empty_from_info(
+    media_info: dict, scan_start: int = 0, time_duration: Optional[int] = None
+) -> None:
     """
     Add any unidentified song to the Redis cache.
 
     Args:
         media_info (dict): Data we get from `YoutubeDL.extract_info`.
         scan_start (int): Timestamp (in seconds) at which the audio was scanned from.
+        time_duration (int): How long the scanned audio was, in seconds. If given,
+            nearby timestamps whose windows mostly fall within it are also cached.
 
     Returns:
         None.
     """
-    key_format = [media_info["extractor_key"], media_info["id"], str(scan_start)]
-    key_string = "-".join(key_format)
+    await _cache.set(
+        _song_key(media_info, scan_start), song.encode(None), ttl=SONG_EMPTY_TTL
+    )
 
-    await _cache.set(key_string, "{}")
+    if time_duration is not None:
+        await _add_span(
+            media_info,
+            scan_start,
+            scan_start + time_duration,
+            scan_start,
+            None,
+            SONG_EMPTY_TTL,
+        )
 
 
 async def set_from_info(media_info: dict, song_info: dict, scan_start: int = 0) -> None:
@@ -86,34 +994,285 @@ async def set_from_info(media_info: dict, song_info: dict, scan_start: int = 0)
     Returns:
         None.
     """
-    key_format = [media_info["extractor_key"], media_info["id"], str(scan_start)]
-    key_string = "-".join(key_format)
+    await set_song_from_info(media_info, song.create(song_info), scan_start)
 
-    value_data = song.create(song_info)
-    value_encoded = json.dumps(value_data, separators=(",", ":"))
 
-    await _cache.set(key_string, value_encoded)
+async def set_song_from_info(
+    media_info: dict,
+    data_song: Optional[song.Song],
+    scan_start: int = 0,
+    time_duration: Optional[int] = None,
+    song_offset: float = 0,
+) -> None:
+    """
+    Add an already formatted song to the Redis cache.
 
+    Args:
+        media_info (dict): Data we get from `YoutubeDL.extract_info`.
+        data_song (song.Song): The song that was identified.
+        scan_start (int): Timestamp (in seconds) at which the audio was scanned from.
+        time_duration (int): How long the scanned audio was, in seconds. If given,
+            nearby timestamps whose windows mostly fall within the song are also
+            cached.
+        song_offset (float): How far into the song the scanned audio started, in
+            seconds, which Shazam gives as the offset of the match.
 
-async def get_from_info(media_info: dict, scan_start: int = 0) -> Optional[song.Song]:
+    Returns:
+        None.
+    """
+    await _cache.set(
+        _song_key(media_info, scan_start), song.encode(data_song), ttl=SONG_TTL
+    )
+
+    if time_duration is not None and data_song:
+        await _add_span(
+            media_info,
+            scan_start - min(max(song_offset, 0), SPAN_EXTEND_MAX),
+            scan_start + time_duration,
+            scan_start,
+            data_song,
+            SONG_TTL,
+        )
+
+
+async def get_from_info(
+    media_info: dict, scan_start: int = 0, time_duration: Optional[int] = None
+) -> Optional[song.Song]:
     """
     Get any identified song from the Redis cache.
 
     Args:
         media_info (dict): Data we get from `YoutubeDL.extract_info`.
         scan_start (int): Timestamp (in seconds) at which the audio was scanned from.
+        time_duration (int): How long the audio to scan is, in seconds. If given,
+            songs found at nearby timestamps which cover it are also used.
 
     Returns:
         Any identified songs, or none.
     """
-    key_format = [media_info["extractor_key"], media_info["id"], str(scan_start)]
-    key_string = "-".join(key_format)
+    (data_song,) = await get_many_from_info(media_info, [scan_start], time_duration)
+    return data_song
 
-    data = await _cache.get(key_string)
 
-    if data is None:
-        return
+async def get_many_from_info(
+    media_info: dict, scan_starts: List[int], time_duration: Optional[int] = None
+) -> List[Optional[song.Song]]:
+    """
+    Get any identified songs for several timestamps of the same media from the Redis
+    cache, in a single round trip.
+
+    Songs cached as JSON before the binary encoding are re-encoded as they are read.
+
+    Args:
+        media_info (dict): Data we get from `YoutubeDL.extract_info`.
+        scan_starts (list): Timestamps (in seconds) at which the audio was scanned
+            from.
+        time_duration (int): How long the audio to scan is, in seconds. If given,
+            timestamps without a song of their own use any found at nearby
+            timestamps which cover them.
+
+    Returns:
+        For each timestamp, any identified song, an empty dictionary if nothing was
+        found there, or none if it isn't cached.
+    """
+    return await get_songs(
+        [(media_info, scan_start) for scan_start in scan_starts], time_duration
+    )
+
+
+async def get_songs(
+    entries: List[Tuple[dict, int]], time_duration: Optional[int] = None
+) -> List[Optional[song.Song]]:
+    """
+    Get any identified songs for timestamps of any number of pieces of media from the
+    Redis cache, in a single round trip. See `get_many_from_info`.
+
+    Args:
+        entries (list): Data we get from `YoutubeDL.extract_info`, along with the
+            timestamp (in seconds) at which the audio was scanned from.
+        time_duration (int): How long the audio to scan is, in seconds. If given,
+            timestamps without a song of their own use any found at nearby
+            timestamps which cover them.
+
+    Returns:
+        For each entry, any identified song, an empty dictionary if nothing was
+        found there, or none if it isn't cached.
+    """
+    keys = [_song_key(media_info, scan_start) for media_info, scan_start in entries]
+    keys_spans: List[str] = []
+
+    if time_duration is not None:
+        keys_spans = list(dict.fromkeys(_spans_key(media) for media, _ in entries))
+
+    values = await _cache.get_many([*keys, *keys_spans])
+
+    now = time.time()
+    spans = {
+        key: _decode_spans(value, now)
+        for key, value in zip(keys_spans, values[len(keys) :])
+    }
+
+    results: List[Optional[song.Song]] = []
+    migrated: Dict[bool, Dict[str, bytes]] = {True: {}, False: {}}
+
+    for key, (media_info, scan_start), value in zip(keys, entries, values):
+        if value is None:
+            span = _find_span(
+                spans.get(_spans_key(media_info), []), scan_start, time_duration or 0
+            )
+            results.append(span.data_song if span else None)
+            continue
+
+        data_song = song.decode(value)
+        results.append(data_song)
+
+        if song.is_legacy(value):
+            migrated[bool(data_song)][key] = song.encode(data_song or None)
+
+    await _cache.set_many(migrated[True], ttl=SONG_TTL)
+    await _cache.set_many(migrated[False], ttl=SONG_EMPTY_TTL)
+
+    for data_song in results:
+        metrics.cache_lookup("song", data_song)
+
+    return results
+
+
+def _fingerprint_key(window_id: bytes) -> str:
+    return f"fingerprint-{window_id.hex()}"
+
+
+def _anchor_key(value: int) -> str:
+    return f"fingerprint-anchor-{value:08x}"
+
+
+def _decode_fingerprint(data: bytes) -> Tuple[np.ndarray, song.Song]:
+    # Before the binary encoding, the song was stored as JSON up to a newline.
+    if song.is_legacy(data):
+        data_song, data_fingerprint = data.split(b"\n", 1)
+        return fingerprint.from_bytes(data_fingerprint), song.decode(data_song)
+
+    (length,) = _FINGERPRINT_HEADER.unpack_from(data)
+    offset = _FINGERPRINT_HEADER.size
+
+    return (
+        fingerprint.from_bytes(data[offset + length :]),
+        song.decode(data[offset : offset + length]),
+    )
+
+
+async def set_fingerprint(data_fingerprint: np.ndarray, data_song: song.Song) -> None:
+    """
+    Remember which song some audio was identified as, by its fingerprint.
+
+    Args:
+        data_fingerprint (np.ndarray): Fingerprint of the audio, from
+            `fingerprint.compute`.
+        data_song (song.Song): The song that was identified.
+
+    Returns:
+        None.
+    """
+    window_id = fingerprint.digest(data_fingerprint)[:8]
+
+    value_song = song.encode(data_song)
+    value_encoded = (
+        _FINGERPRINT_HEADER.pack(len(value_song))
+        + value_song
+        + fingerprint.to_bytes(data_fingerprint)
+    )
+
+    await _cache.set(_fingerprint_key(window_id), value_encoded, ttl=FINGERPRINT_TTL)
+
+    data_anchors = fingerprint.anchors(data_fingerprint)
+    keys = [_anchor_key(value) for _, value in data_anchors]
+    buckets = await _cache.get_many(keys)
+
+    # Others may be writing to the same buckets, in which case one of the windows is
+    # lost from them. That's fine, as each window has plenty of other anchors.
+    items: Dict[str, bytes] = {}
+
+    for key, (position, _), bucket in zip(keys, data_anchors, buckets):
+        record = _ANCHOR_RECORD.pack(window_id, position)
+        bucket = items.get(key, bucket) or b""
+
+        items[key] = (record + bucket)[: _ANCHOR_RECORD.size * FINGERPRINT_BUCKET_SIZE]
+
+    await _cache.set_many(items, ttl=FINGERPRINT_TTL)
+
+
+async def get_from_fingerprint(data_fingerprint: np.ndarray) -> Optional[song.Song]:
+    """
+    Get the song that similar enough audio was identified as before.
+
+    Identical audio is looked up directly. Otherwise, windows sharing anchors with the
+    audio at the same alignment are compared with it, so re-encoded or differently
+    trimmed copies are found too.
+
+    Args:
+        data_fingerprint (np.ndarray): Fingerprint of the audio, from
+            `fingerprint.compute`.
+
+    Returns:
+        The identified song, or none.
+    """
+    window_id = fingerprint.digest(data_fingerprint)[:8]
+    data_exact = await _cache.get(_fingerprint_key(window_id))
+
+    if data_exact is not None:
+        metrics.cache_lookup("fingerprint", True)
+        return _decode_fingerprint(data_exact)[1]
+
+    data_anchors = fingerprint.anchors(data_fingerprint)
+    data_buckets = await _cache.get_many(
+        _anchor_key(value) for _, value in data_anchors
+    )
+
+    # Votes for each window and where the audio lines up in it.
+    votes: Counter = Counter()
+
+    for (position, _), bucket in zip(data_anchors, data_buckets):
+        for candidate_id, candidate_position in _ANCHOR_RECORD.iter_unpack(
+            bucket or b""
+        ):
+            votes[(candidate_id, candidate_position - position)] += 1
+
+    candidates = [
+        (candidate_id, offset)
+        for (candidate_id, offset), count in votes.most_common(FINGERPRINT_CANDIDATES)
+        if count >= FINGERPRINT_MIN_VOTES
+    ]
+    data_candidates = await _cache.get_many(
+        _fingerprint_key(candidate_id) for candidate_id, _ in candidates
+    )
+
+    for (_, offset), data_candidate in zip(candidates, data_candidates):
+        if data_candidate is None:
+            continue
+
+        candidate_fingerprint, data_song = _decode_fingerprint(data_candidate)
+        error_rate = fingerprint.bit_error_rate(
+            data_fingerprint, candidate_fingerprint, offset
+        )
+
+        if error_rate is not None and error_rate <= fingerprint.MATCH_THRESHOLD:
+            log.debug(f"Fingerprint matched with a bit error rate of {error_rate:.2f}")
+            metrics.cache_lookup("fingerprint", True)
+
+            return data_song
+
+    metrics.cache_lookup("fingerprint", None)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Counters for the in-memory tiers of the shared cache.
+
+    Returns:
+        The hits, misses, evictions, and sizes of the fallback and L1 caches.
+    """
+    return _cache.stats()
 
-    data_decoded = json.loads(data.decode("utf-8"))
 
-    return song.Song(**data_decoded)
+async def close() -> None:
+    """Stop health checking the shared cache, and close its connections."""
+    await _cache.close()
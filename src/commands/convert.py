@@ -1,13 +1,69 @@
-import asyncio
+import hashlib
 import os
+import time
 from tempfile import TemporaryDirectory
+from typing import Optional
 
+import aiohttp
 import discord
+import ffmpeg
 from discord import Enum, app_commands
 
-from .. import conversion, shazam
+from .. import cache, conversion, downloader, metrics, scheduler, store
+from ..exceptions import (
+    ConversionTimeoutException,
+    SchedulerBusyException,
+    TargetSizeUnreachableException,
+)
+from ..utility import seconds_to_timestamp
+
+# How long a conversion may run for, in seconds.
+CONVERT_TIMEOUT = float(os.getenv("CONVERT_TIMEOUT", 300))
+
+# How long Discord lets us respond to an interaction for, in seconds, and how much
+# of that to leave for uploading the result.
+INTERACTION_LIFETIME = 15 * 60
+INTERACTION_UPLOAD_MARGIN = 60
+
+# Upload limit when not in a guild, in bytes.
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+# How often to tell the user how far along the conversion is, in seconds.
+PROGRESS_INTERVAL = 5
+
+# How full the queue of conversions (see `scheduler.load`) has to be, before a
+# conversion joins it, for quality to be given up for speed so that the queue drains
+# instead of being rejected. With the default limits of 2 running and 8 queued,
+# that is when both slots are taken, and when 2 more are waiting for them.
+TIER_BALANCED_LOAD = float(os.getenv("CONVERT_TIER_BALANCED_LOAD", 0.25))
+TIER_FAST_LOAD = float(os.getenv("CONVERT_TIER_FAST_LOAD", 0.5))
+
+
+def _time_remaining(interaction: discord.Interaction) -> float:
+    """How long we have left to convert before the interaction expires, in seconds."""
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+    return INTERACTION_LIFETIME - INTERACTION_UPLOAD_MARGIN - elapsed
+
+
+def _speed_tier() -> conversion.SpeedTier:
+    """How fast to encode, from how many other conversions are running or waiting.
+    Must be called before the conversion takes its slot, so that it doesn't count
+    itself."""
+    load = scheduler.load(scheduler.JobClass.TRANSCODE)
 
+    if load >= TIER_FAST_LOAD:
+        return conversion.SpeedTier.FAST
 
+    if load >= TIER_BALANCED_LOAD:
+        return conversion.SpeedTier.BALANCED
+
+    return conversion.SpeedTier.SMALL
+
+
+# The settings for each speed tier are in `conversion.ENCODER_TIERS`, keyed by the
+# encoder that each of these formats is converted with (`conversion.VIDEO_ENCODERS`),
+# as that is where the rest of the encoder's options are chosen.
 class Formats(Enum):
     # audio
     mp3 = "mp3"
@@ -34,22 +90,139 @@ async def convert(
 ):
     await interaction.response.defer(thinking=True)
 
-    loop = asyncio.get_event_loop()
+    target_size = DEFAULT_UPLOAD_LIMIT
+
+    if interaction.guild is not None:
+        target_size = interaction.guild.filesize_limit
+
+    extension = f".{new_format.value}"
+    filename = f"bawt{extension}"
 
     with TemporaryDirectory() as path_temp:
-        file_in = os.path.join(path_temp, input_media.filename)
-        file_out = os.path.join(path_temp, f"bawt.{new_format.value}")
+        progress_last = time.monotonic()
 
-        await shazam.download_media(input_media.url, file_in)
+        async def _on_progress(progress: conversion.Progress):
+            nonlocal progress_last
 
-        await loop.run_in_executor(None, lambda: conversion.video(file_in, file_out))
+            if progress["out_time"] is None:
+                return
+
+            if time.monotonic() - progress_last < PROGRESS_INTERVAL:
+                return
+
+            progress_last = time.monotonic()
+
+            await interaction.edit_original_response(
+                content="Converting, done up to "
+                f"`{seconds_to_timestamp(progress['out_time'])}` so far..."
+            )
 
         try:
+            async with scheduler.admit(interaction.guild_id, interaction.user.id):
+                # Hashed as it is downloaded, to find earlier conversions of the same
+                # file by.
+                digest = hashlib.sha1()
+
+                with metrics.stage("download"):
+                    download = await downloader.download(
+                        input_media.url,
+                        os.path.join(path_temp, "input{ext}"),
+                        max_size=None,
+                        digest=digest,
+                    )
+
+                key = store.conversion_key(digest.hexdigest(), extension, target_size)
+
+                # We've converted and uploaded this before, so link to it instead.
+                attachment_url = await cache.get_attachment_url(key)
+
+                if attachment_url is not None:
+                    return await interaction.edit_original_response(
+                        content=attachment_url
+                    )
+
+                async def _convert(file_out: str):
+                    tier = _speed_tier()
+
+                    # Colors picked for the same file before, at another size.
+                    palettes = None
+
+                    if new_format == Formats.gif:
+                        palettes = await cache.get_palettes(
+                            digest.hexdigest(), conversion.GIF_COLORS
+                        )
+
+                    palettes_cached = set(palettes or ())
+
+                    async with scheduler.slot(scheduler.JobClass.TRANSCODE):
+                        with metrics.stage("transcode"):
+                            # Give up on the conversion once nobody can see the
+                            # result.
+                            await conversion.video(
+                                download["path"],
+                                file_out,
+                                timeout=min(
+                                    CONVERT_TIMEOUT, _time_remaining(interaction)
+                                ),
+                                on_progress=_on_progress,
+                                target_size=target_size,
+                                tier=tier,
+                                threads=conversion.encoder_threads(
+                                    scheduler.limit(scheduler.JobClass.TRANSCODE)
+                                ),
+                                palettes=palettes,
+                            )
+
+                    if palettes:
+                        await cache.set_palettes(
+                            digest.hexdigest(),
+                            {
+                                max_colors: data_palette
+                                for max_colors, data_palette in palettes.items()
+                                if max_colors not in palettes_cached
+                            },
+                        )
+
+                # Kept on disk afterwards, so that the same conversion isn't run
+                # again if it has to be uploaded again.
+                async with store.fetch_conversion(key, filename, _convert) as file_out:
+                    if file_out is None:
+                        return await interaction.edit_original_response(
+                            content="Sorry, I couldn't convert the file."
+                        )
+
+                    response = await _upload(interaction, file_out, filename)
+        except SchedulerBusyException:
+            return await interaction.edit_original_response(
+                content="Sorry, I'm busy right now. Please try again in a moment."
+            )
+        except TargetSizeUnreachableException:
+            return await interaction.edit_original_response(
+                content="Sorry, the file can't be made small enough to upload."
+            )
+        except ConversionTimeoutException:
+            return await interaction.edit_original_response(
+                content="Sorry, converting the file took too long."
+            )
+        except (ffmpeg.Error, aiohttp.ClientError):
+            return await interaction.edit_original_response(
+                content="Sorry, I couldn't convert the file."
+            )
+
+    if response is not None and response.attachments:
+        await cache.set_attachment_url(key, response.attachments[0].url)
+
+
+async def _upload(
+    interaction: discord.Interaction, file_path: str, filename: str
+) -> Optional[discord.InteractionMessage]:
+    try:
+        with metrics.stage("upload"):
+            return await interaction.edit_original_response(
+                content=None, attachments=[discord.File(file_path, filename=filename)]
+            )
+    except discord.HTTPException as e:
+        if e.status == 413:
             await interaction.edit_original_response(
-                attachments=[discord.File(file_out)]
+                content="Sorry, the file generated was too large."
             )
-        except discord.HTTPException as e:
-            if e.status == 413:
-                await interaction.edit_original_response(
-                    content="Sorry, the file generated was too large."
-                )
@@ -1,12 +1,14 @@
-import os
-from tempfile import TemporaryDirectory
 from typing import Optional
 
 import discord
 from discord import app_commands
 
-from .. import shazam
-from ..exceptions import InvalidLinkException
+from .. import cache, metrics, scheduler, shazam, store
+from ..exceptions import (
+    DownloadTooLargeException,
+    InvalidLinkException,
+    SchedulerBusyException,
+)
 
 
 @app_commands.command(
@@ -22,6 +24,18 @@ async def extract(
 ):
     await interaction.response.defer(thinking=True)
 
+    try:
+        async with scheduler.admit(interaction.guild_id, interaction.user.id):
+            await _extract(interaction, input_media, playlist_index)
+    except SchedulerBusyException:
+        await interaction.edit_original_response(
+            content="Sorry, I'm busy right now. Please try again in a moment."
+        )
+
+
+async def _extract(
+    interaction: discord.Interaction, input_media: str, playlist_index: int
+):
     try:
         data: Optional[dict] = await shazam.download_media(
             input_media, playlist_index=playlist_index, should_download=False
@@ -52,42 +66,51 @@ async def extract(
     if extractor in ("reddit", "instagram", "tiktok") or (
         file_size and file_size < 8e6
     ):
-        # TODO: Windows spits out an error about the file being used by another program
-        # when this context manager exits. Doesn't affect anything, just means that
-        # temporary stuff won't be deleted. Still annoying.
-        with TemporaryDirectory() as path_temp:
-            file_path = os.path.join(
-                path_temp,
-                "{0} - {1}.{2}".format(
-                    data["extractor_key"], data["id"], data.get("ext", "mp4")
-                ),
+        media_key = store.media_key(data["extractor_key"], data["id"], None)
+
+        # We've uploaded this before, so link to it instead of uploading it again.
+        attachment_url = await cache.get_attachment_url(media_key)
+
+        if attachment_url is not None:
+            return await interaction.edit_original_response(content=attachment_url)
+
+        filename = "{0} - {1}.{2}".format(
+            data["extractor_key"], data["id"], data.get("ext", "mp4")
+        )
+
+        # TODO: Issue with (at least) Instagram where there are mixed video/image
+        # slides. E.g., if a picture is first, and a video is second, the desired
+        # command is `/extract <link> 2`, but instead only the videos are detected
+        # and you will end up having to type `1` as the index.
+        async def _download(file_path: str):
+            await shazam.download_media_segmented(
+                input_media, file_path, playlist_index=playlist_index
             )
 
-            # TODO: Issue with (at least) Instagram where there are mixed video/image
-            # slides. E.g., if a picture is first, and a video is second, the desired
-            # command is `/extract <link> 2`, but instead only the videos are detected
-            # and you will end up having to type `1` as the index.
-            await shazam.download_media(
-                input_media,
-                output_path=file_path,
-                playlist_index=playlist_index,
-                should_download=True,
+        try:
+            # Kept on disk afterwards, so the same media isn't downloaded again.
+            async with store.fetch(media_key, filename, _download) as file_path:
+                # Validate that the file was downloaded successfully.
+                if file_path is None:
+                    return await interaction.edit_original_response(
+                        content="Sorry, I couldn't download the requested media right "
+                        "now. Maybe try again later."
+                    )
+
+                with metrics.stage("upload"):
+                    response = await interaction.edit_original_response(
+                        attachments=[discord.File(file_path, filename=filename)]
+                    )
+        except DownloadTooLargeException:
+            return await interaction.edit_original_response(
+                content="Sorry, the media is over the size limit, so I can't upload it."
             )
 
-            # Validate that the file was downloaded successfully.
-            if os.path.exists(file_path):
-                await interaction.edit_original_response(
-                    attachments=[discord.File(file_path)]
-                )
-            else:
-                await interaction.edit_original_response(
-                    content="Sorry, I couldn't download the requested media right now. "
-                    "Maybe try again later."
-                )
+        if response.attachments:
+            await cache.set_attachment_url(media_key, response.attachments[0].url)
 
     # Send the raw URL otherwise.
     else:
-        # TODO: Maybe cache the URL result, hash the given URL or something.
         message = (
             f"Here is your [video]({data.get('url')})! "
             "(sometimes video don't embed, if not you'll have to download them)"
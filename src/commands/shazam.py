@@ -2,8 +2,13 @@ from typing import Optional
 
 import discord
 
-from .. import shazam
-from ..exceptions import InvalidLinkException
+from .. import metrics, scheduler, shazam
+from ..exceptions import (
+    InvalidLinkException,
+    RecognitionUnavailableException,
+    SchedulerBusyException,
+)
+from ..utility import seconds_to_timestamp
 from typing import Optional
 
 from discord import app_commands
@@ -17,13 +22,23 @@ async def cmd_shazam(
     await interaction.response.defer(thinking=True)
 
     try:
-        song = await shazam.find_song(
-            input_link, time_start, playlist_index=playlist_index
-        )
+        async with scheduler.admit(interaction.guild_id, interaction.user.id):
+            song = await shazam.find_song(
+                input_link, time_start, playlist_index=playlist_index
+            )
     except InvalidLinkException:
         return await interaction.edit_original_response(
             content="Please provide a valid link."
         )
+    except SchedulerBusyException:
+        return await interaction.edit_original_response(
+            content="Sorry, I'm busy right now. Please try again in a moment."
+        )
+    except RecognitionUnavailableException:
+        return await interaction.edit_original_response(
+            content="Sorry, song recognition isn't available right now. Please try "
+            "again later."
+        )
 
     if not song:
         return await interaction.edit_original_response(
@@ -45,7 +60,8 @@ async def cmd_shazam(
     if song["release_year"]:
         embed.add_field(name="Released", value=song["release_year"], inline=False)
 
-    await interaction.edit_original_response(embed=embed)
+    with metrics.stage("respond"):
+        await interaction.edit_original_response(embed=embed)
 
 @app_commands.command(
     name="file", description="Try to find a song from the attachment."
@@ -78,6 +94,73 @@ async def cmd_shazam_link(
 ):
     return await cmd_shazam(interaction, input_media, time_start, playlist_index)
 
+@app_commands.command(
+    name="scan", description="Try to find every song in a long piece of media."
+)
+@app_commands.rename(
+    input_media="input",
+    time_start="time",
+    window_count="samples",
+    window_stride="interval",
+    playlist_index="index",
+)
+@app_commands.describe(
+    input_media="where to find the video/audio from.",
+    time_start="which timestamp to start scanning from.",
+    window_count="how many samples to take.",
+    window_stride="how many seconds apart each sample should be.",
+    playlist_index="which index to download from a playlist.",
+)
+async def cmd_shazam_scan(
+    interaction: discord.Interaction,
+    input_media: str,
+    time_start: int = 0,
+    window_count: app_commands.Range[int, 1, 20] = 8,
+    window_stride: app_commands.Range[int, 15, 600] = 60,
+    playlist_index: int = 1,
+):
+    await interaction.response.defer(thinking=True)
+
+    try:
+        async with scheduler.admit(interaction.guild_id, interaction.user.id):
+            tracklist = await shazam.scan_songs(
+                input_media,
+                time_start,
+                window_count=window_count,
+                window_stride=window_stride,
+                playlist_index=playlist_index,
+            )
+    except InvalidLinkException:
+        return await interaction.edit_original_response(
+            content="Please provide a valid link."
+        )
+    except SchedulerBusyException:
+        return await interaction.edit_original_response(
+            content="Sorry, I'm busy right now. Please try again in a moment."
+        )
+    except RecognitionUnavailableException:
+        return await interaction.edit_original_response(
+            content="Sorry, song recognition isn't available right now. Please try "
+            "again later."
+        )
+
+    if not tracklist:
+        return await interaction.edit_original_response(
+            content="Sorry, I couldn't find any songs."
+        )
+
+    embed = discord.Embed(
+        title="Tracklist",
+        description="\n".join(
+            f"`{seconds_to_timestamp(timestamp)}` {song['artist']} - {song['title']}"
+            for timestamp, song in tracklist
+        ),
+    )
+
+    with metrics.stage("respond"):
+        await interaction.edit_original_response(embed=embed)
+
+
 class ShazamGroup(app_commands.Group):
     def __init__(self):
         super().__init__(name="shazam", description="Find songs from media.")
@@ -85,3 +168,4 @@ class ShazamGroup(app_commands.Group):
 shazam_group = ShazamGroup()
 shazam_group.add_command(cmd_shazam_file)
 shazam_group.add_command(cmd_shazam_link)
+shazam_group.add_command(cmd_shazam_scan)
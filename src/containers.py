@@ -0,0 +1,590 @@
+"""Just enough parsing of media containers to find which bytes of a file hold a
+given stretch of time, so that only those have to be downloaded.
+
+Every function here works on bytes that were already fetched, and returns None (or
+nothing) when the data doesn't look the way it expects.
+"""
+
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# Matroska element IDs, with their length marker kept.
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_CUES = 0x1C53BB6B
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TIME = 0xB3
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_CLUSTER_POSITION = 0xF1
+MKV_CLUSTER = 0x1F43B675
+
+# Sizes with every bit set mean that the size is unknown, e.g., for live streams.
+MKV_UNKNOWN_SIZE = -1
+
+
+def sniff(head: bytes) -> Optional[str]:
+    """Guess the container of some media from its first few bytes.
+
+    Returns:
+        One of `mp4`, `matroska`, `ogg`, or `mpeg` (MP3 or ADTS frames), or None for
+        anything else.
+    """
+    if head[4:8] in (b"ftyp", b"styp", b"moov", b"free", b"skip", b"mdat"):
+        return "mp4"
+
+    if head[:4] == struct.pack(">I", EBML_HEADER):
+        return "matroska"
+
+    if head[:4] == b"OggS":
+        return "ogg"
+
+    if head[:3] == b"ID3" or (head[:1] == b"\xff" and head[1] & 0xE0 == 0xE0):
+        return "mpeg"
+
+
+# MP4 (ISO BMFF)
+
+
+class Box(NamedTuple):
+    type: bytes
+    offset: int
+    header_size: int
+    size: int
+
+
+def mp4_box(data: bytes, offset: int = 0, file_size: Optional[int] = None) -> Box:
+    """Read the header of the box starting at `offset`.
+
+    Args:
+        data (bytes): Holds at least the 16 bytes starting at `offset`.
+        offset (int): Where in `data` the box starts.
+        file_size (int): How large the whole file is, for boxes that run until the
+            end of it.
+    """
+    size, box_type = struct.unpack_from(">I4s", data, offset)
+    header_size = 8
+
+    if size == 1:
+        (size,) = struct.unpack_from(">Q", data, offset + 8)
+        header_size = 16
+    elif size == 0:
+        size = (file_size if file_size is not None else len(data)) - offset
+
+    return Box(box_type, offset, header_size, size)
+
+
+def mp4_children(data: bytes, offset: int = 0, end: Optional[int] = None):
+    """Iterate over the boxes in `data[offset:end]`."""
+    end = len(data) if end is None else end
+
+    while offset + 8 <= end:
+        box = mp4_box(data, offset, end)
+
+        if box.size < box.header_size or offset + box.size > end:
+            return
+
+        yield box
+        offset += box.size
+
+
+def _mp4_find(data: bytes, path: Tuple[bytes, ...], box: Box) -> Optional[Box]:
+    for child in mp4_children(
+        data, box.offset + box.header_size, box.offset + box.size
+    ):
+        if child.type == path[0]:
+            return child if len(path) == 1 else _mp4_find(data, path[1:], child)
+
+
+def _mp4_audio_track(moov: bytes) -> Optional[Box]:
+    box_moov = mp4_box(moov)
+
+    for trak in mp4_children(moov, box_moov.header_size, box_moov.size):
+        if trak.type != b"trak":
+            continue
+
+        hdlr = _mp4_find(moov, (b"mdia", b"hdlr"), trak)
+
+        # Full box header, then `pre_defined`, then the handler type.
+        if hdlr and moov[hdlr.offset + 16 : hdlr.offset + 20] == b"soun":
+            return trak
+
+
+def _mp4_body(data: bytes, box: Box) -> int:
+    """Where the fields of a full box start, past its version and flags."""
+    return box.offset + box.header_size + 4
+
+
+def mp4_is_fragmented(moov: bytes) -> bool:
+    return _mp4_find(moov, (b"mvex",), mp4_box(moov)) is not None
+
+
+def mp4_sample_range(moov: bytes, time_start: float, time_end: float):
+    """Find the bytes holding the audio samples between two times, using the sample
+    tables of a `moov` box.
+
+    Args:
+        moov (bytes): The whole `moov` box.
+        time_start (float): Start of the wanted audio, in seconds.
+        time_end (float): End of the wanted audio, in seconds.
+
+    Returns:
+        The first byte and the byte after the last one, as offsets into the file, or
+        None if there is no audio track, or the tables couldn't be read.
+    """
+    trak = _mp4_audio_track(moov)
+
+    if trak is None:
+        return
+
+    mdhd = _mp4_find(moov, (b"mdia", b"mdhd"), trak)
+    stbl = _mp4_find(moov, (b"mdia", b"minf", b"stbl"), trak)
+
+    if mdhd is None or stbl is None:
+        return
+
+    version = moov[mdhd.offset + mdhd.header_size]
+    (timescale,) = struct.unpack_from(
+        ">I", moov, _mp4_body(moov, mdhd) + (16 if version == 1 else 8)
+    )
+
+    tables = {
+        box.type: box
+        for box in mp4_children(
+            moov, stbl.offset + stbl.header_size, stbl.offset + stbl.size
+        )
+    }
+
+    if not {b"stts", b"stsc", b"stsz"} <= tables.keys():
+        return
+
+    # Decoding times of the samples, as runs of samples with the same duration.
+    stts = _mp4_body(moov, tables[b"stts"])
+    (count,) = struct.unpack_from(">I", moov, stts)
+    runs = struct.unpack_from(f">{count * 2}I", moov, stts + 4)
+
+    sample_first = sample_last = None
+    sample, time = 0, 0
+    tick_start, tick_end = time_start * timescale, time_end * timescale
+
+    for run_count, run_delta in zip(runs[::2], runs[1::2]):
+        run_end = time + run_count * run_delta
+
+        if sample_first is None and run_end > tick_start:
+            sample_first = sample + max(
+                0, int((tick_start - time) // max(run_delta, 1))
+            )
+
+        if run_end >= tick_end:
+            sample_last = sample + int((tick_end - time) // max(run_delta, 1))
+            break
+
+        sample, time = sample + run_count, run_end
+
+    if sample_first is None:
+        return
+
+    # Sizes of the samples, either all the same or listed one by one.
+    stsz = _mp4_body(moov, tables[b"stsz"])
+    sample_size, sample_count = struct.unpack_from(">II", moov, stsz)
+
+    if sample_last is None or sample_last >= sample_count:
+        sample_last = sample_count - 1
+
+    if sample_first > sample_last:
+        return
+
+    if sample_size:
+        sizes = None
+    else:
+        sizes = struct.unpack_from(f">{sample_count}I", moov, stsz + 8)
+
+    # Where each chunk of samples starts in the file.
+    if b"stco" in tables:
+        stco = _mp4_body(moov, tables[b"stco"])
+        (count,) = struct.unpack_from(">I", moov, stco)
+        chunk_offsets = struct.unpack_from(f">{count}I", moov, stco + 4)
+    elif b"co64" in tables:
+        co64 = _mp4_body(moov, tables[b"co64"])
+        (count,) = struct.unpack_from(">I", moov, co64)
+        chunk_offsets = struct.unpack_from(f">{count}Q", moov, co64 + 4)
+    else:
+        return
+
+    # Which chunks hold which samples, as runs of chunks with the same sample count.
+    stsc = _mp4_body(moov, tables[b"stsc"])
+    (count,) = struct.unpack_from(">I", moov, stsc)
+    entries = struct.unpack_from(f">{count * 3}I", moov, stsc + 4)
+
+    first_chunks = list(entries[::3]) + [len(chunk_offsets) + 1]
+    samples_per_chunk = entries[1::3]
+
+    def _offset(target: int) -> Optional[int]:
+        sample = 0
+
+        for index, per_chunk in enumerate(samples_per_chunk):
+            chunks = first_chunks[index + 1] - first_chunks[index]
+
+            if target < sample + chunks * per_chunk:
+                chunk = first_chunks[index] - 1 + (target - sample) // per_chunk
+                chunk_sample = sample + (chunk - first_chunks[index] + 1) * per_chunk
+
+                if sizes is None:
+                    skipped = (target - chunk_sample) * sample_size
+                else:
+                    skipped = sum(sizes[chunk_sample:target])
+
+                return chunk_offsets[chunk] + skipped
+
+            sample += chunks * per_chunk
+
+    offset_first = _offset(sample_first)
+    offset_last = _offset(sample_last)
+
+    if offset_first is None or offset_last is None:
+        return
+
+    offset_last += sample_size if sizes is None else sizes[sample_last]
+
+    return min(offset_first, offset_last), max(offset_first, offset_last)
+
+
+def mp4_sidx_range(
+    sidx: bytes, sidx_end: int, time_start: float, time_end: float
+) -> Optional[Tuple[int, int]]:
+    """Find the fragments holding the media between two times, using a `sidx` box.
+
+    Args:
+        sidx (bytes): The whole `sidx` box.
+        sidx_end (int): Where the box ends in the file, which the offsets of the
+            fragments are relative to.
+        time_start (float): Start of the wanted media, in seconds.
+        time_end (float): End of the wanted media, in seconds.
+
+    Returns:
+        The first byte and the byte after the last one, as offsets into the file.
+    """
+    box = mp4_box(sidx)
+    body = _mp4_body(sidx, box)
+    version = sidx[box.header_size]
+
+    _, timescale = struct.unpack_from(">II", sidx, body)
+
+    if version == 0:
+        time, offset = struct.unpack_from(">II", sidx, body + 8)
+        body += 16
+    else:
+        time, offset = struct.unpack_from(">QQ", sidx, body + 8)
+        body += 24
+
+    (count,) = struct.unpack_from(">H", sidx, body + 2)
+    offset += sidx_end
+
+    range_start = range_end = None
+
+    for index in range(count):
+        size, duration, _ = struct.unpack_from(">III", sidx, body + 4 + index * 12)
+        size &= 0x7FFFFFFF
+
+        end = (time + duration) / timescale
+
+        if range_start is None and end > time_start:
+            range_start = offset
+
+        if range_start is not None:
+            range_end = offset + size
+
+            if end >= time_end:
+                break
+
+        time += duration
+        offset += size
+
+    if range_start is None:
+        return
+
+    return range_start, range_end
+
+
+# Matroska (and WebM)
+
+
+def _vint(data: bytes, offset: int, keep_marker: bool) -> Tuple[int, int]:
+    first = data[offset]
+    length = 1
+
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+
+    if length > 8:
+        raise ValueError("Invalid EBML variable length integer")
+
+    value = int.from_bytes(data[offset : offset + length], "big")
+
+    if len(data) < offset + length:
+        raise IndexError("Variable length integer runs past the data")
+
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+
+        if value == (1 << (7 * length)) - 1:
+            value = MKV_UNKNOWN_SIZE
+
+    return value, length
+
+
+class Element(NamedTuple):
+    id: int
+    offset: int
+    header_size: int
+    size: int
+
+    @property
+    def data_offset(self) -> int:
+        return self.offset + self.header_size
+
+
+def ebml_element(data: bytes, offset: int = 0) -> Element:
+    """Read the header of the element starting at `offset`."""
+    element_id, length_id = _vint(data, offset, keep_marker=True)
+    size, length_size = _vint(data, offset + length_id, keep_marker=False)
+
+    return Element(element_id, offset, length_id + length_size, size)
+
+
+def ebml_children(data: bytes, offset: int, end: int) -> Iterator[Element]:
+    """Iterate over the elements in `data[offset:end]`, stopping at the first one
+    which isn't completely inside of it."""
+    while offset < min(end, len(data)):
+        try:
+            element = ebml_element(data, offset)
+        except (ValueError, IndexError):
+            return
+
+        yield element
+
+        if element.size == MKV_UNKNOWN_SIZE:
+            return
+
+        offset = element.data_offset + element.size
+
+
+def _ebml_uint(data: bytes, element: Element) -> int:
+    return int.from_bytes(
+        data[element.data_offset : element.data_offset + element.size], "big"
+    )
+
+
+class MatroskaHead(NamedTuple):
+    # Where the data of the segment starts, which positions are relative to.
+    segment_offset: int
+    timestamp_scale: int
+    # Where each top-level element listed in the seek head is, relative to the
+    # segment, keyed by its ID.
+    positions: Dict[int, int]
+    first_cluster: Optional[int]
+
+
+def matroska_head(head: bytes) -> Optional[MatroskaHead]:
+    """Read the seek head and segment info from the start of a Matroska file.
+
+    Args:
+        head (bytes): The first few kilobytes of the file.
+    """
+    elements = list(ebml_children(head, 0, len(head)))
+
+    if len(elements) < 2 or elements[0].id != EBML_HEADER:
+        return
+
+    segment = elements[1]
+
+    if segment.id != MKV_SEGMENT:
+        return
+
+    timestamp_scale = 1_000_000
+    positions: Dict[int, int] = {}
+    first_cluster = None
+
+    for element in ebml_children(head, segment.data_offset, len(head)):
+        if element.id == MKV_CLUSTER:
+            first_cluster = element.offset - segment.data_offset
+            break
+
+        if element.data_offset + element.size > len(head):
+            positions.setdefault(element.id, element.offset - segment.data_offset)
+            continue
+
+        if element.id == MKV_SEEK_HEAD:
+            for seek in ebml_children(
+                head, element.data_offset, element.data_offset + element.size
+            ):
+                if seek.id != MKV_SEEK:
+                    continue
+
+                seek_id = seek_position = None
+
+                for field in ebml_children(
+                    head, seek.data_offset, seek.data_offset + seek.size
+                ):
+                    if field.id == MKV_SEEK_ID:
+                        seek_id = _ebml_uint(head, field)
+                    elif field.id == MKV_SEEK_POSITION:
+                        seek_position = _ebml_uint(head, field)
+
+                if seek_id is not None and seek_position is not None:
+                    positions.setdefault(seek_id, seek_position)
+        elif element.id == MKV_INFO:
+            for field in ebml_children(
+                head, element.data_offset, element.data_offset + element.size
+            ):
+                if field.id == MKV_TIMESTAMP_SCALE:
+                    timestamp_scale = _ebml_uint(head, field)
+
+        positions.setdefault(element.id, element.offset - segment.data_offset)
+
+    return MatroskaHead(segment.data_offset, timestamp_scale, positions, first_cluster)
+
+
+def matroska_cues(cues: bytes) -> List[Tuple[int, int]]:
+    """Read the cue points out of a whole `Cues` element.
+
+    Returns:
+        The time of each cue point, and the position of its cluster relative to the
+        segment, in order of time.
+    """
+    element = ebml_element(cues)
+    points = []
+
+    for point in ebml_children(
+        cues, element.data_offset, element.data_offset + element.size
+    ):
+        if point.id != MKV_CUE_POINT:
+            continue
+
+        time = position = None
+
+        for field in ebml_children(
+            cues, point.data_offset, point.data_offset + point.size
+        ):
+            if field.id == MKV_CUE_TIME:
+                time = _ebml_uint(cues, field)
+            elif field.id == MKV_CUE_TRACK_POSITIONS and position is None:
+                for track_field in ebml_children(
+                    cues, field.data_offset, field.data_offset + field.size
+                ):
+                    if track_field.id == MKV_CUE_CLUSTER_POSITION:
+                        position = _ebml_uint(cues, track_field)
+
+        if time is not None and position is not None:
+            points.append((time, position))
+
+    return sorted(points)
+
+
+def matroska_cluster_range(
+    cues: List[Tuple[int, int]],
+    timestamp_scale: int,
+    time_start: float,
+    time_end: float,
+) -> Optional[Tuple[int, Optional[int]]]:
+    """Find the clusters holding the media between two times.
+
+    Returns:
+        The position of the first cluster and of the cluster after the last one,
+        relative to the segment, where the latter is None to read until the end.
+    """
+    if not cues:
+        return
+
+    scale = timestamp_scale / 1_000_000_000
+    position_start, position_end = cues[0][1], None
+
+    for time, position in cues:
+        if time * scale <= time_start:
+            position_start = position
+        elif time * scale > time_end and position > position_start:
+            position_end = position
+            break
+
+    return position_start, position_end
+
+
+# Ogg
+
+
+class Page(NamedTuple):
+    offset: int
+    size: int
+    granule: int
+    serial: int
+
+
+def ogg_pages(data: bytes, offset: int = 0) -> Iterator[Page]:
+    """Iterate over the complete pages found in `data`, resyncing on the capture
+    pattern, so `data` may start in the middle of a page."""
+    while True:
+        offset = data.find(b"OggS", offset)
+
+        if offset < 0 or offset + 27 > len(data):
+            return
+
+        version, _, granule, serial, _, _, segments = struct.unpack_from(
+            "<BBqIIIB", data, offset + 4
+        )
+        header_size = 27 + segments
+
+        if version != 0 or offset + header_size > len(data):
+            offset += 4
+            continue
+
+        size = header_size + sum(data[offset + 27 : offset + header_size])
+
+        if offset + size > len(data):
+            return
+
+        yield Page(offset, size, granule, serial)
+        offset += size
+
+
+class OggStream(NamedTuple):
+    serial: int
+    sample_rate: int
+    pre_skip: int
+    # Where the pages holding the codec headers end.
+    header_end: int
+
+    def time(self, granule: int) -> float:
+        return max(0, granule - self.pre_skip) / self.sample_rate
+
+
+def ogg_stream(head: bytes) -> Optional[OggStream]:
+    """Read the codec headers of the first Opus or Vorbis stream in an Ogg file.
+
+    Args:
+        head (bytes): The first few kilobytes of the file.
+    """
+    pages = list(ogg_pages(head))
+
+    if not pages:
+        return
+
+    first = pages[0]
+    packet = head[first.offset + 27 + head[first.offset + 26] :]
+
+    if packet.startswith(b"OpusHead"):
+        (pre_skip,) = struct.unpack_from("<H", packet, 10)
+        sample_rate = 48_000
+    elif packet.startswith(b"\x01vorbis"):
+        (sample_rate,) = struct.unpack_from("<I", packet, 12)
+        pre_skip = 0
+    else:
+        return
+
+    for page in pages[1:]:
+        if page.serial == first.serial and page.granule > 0:
+            return OggStream(first.serial, sample_rate, pre_skip, page.offset)
@@ -1,40 +1,1088 @@
+import asyncio
+import io
+import json
+import logging
+import math
 import os
+import resource
+import time
+import wave
+from enum import Enum
+from tempfile import TemporaryDirectory
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 import ffmpeg
 
+from .exceptions import ConversionTimeoutException, TargetSizeUnreachableException
 
-def video_to_gif(input_path: str, output_path: str) -> None:
+log = logging.getLogger(__name__)
+
+# Limits for every `ffmpeg` process we start, so that one runaway conversion can't
+# take over the host. Empty to leave them unlimited.
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", 0))
+FFMPEG_CPU_AFFINITY = [
+    int(cpu) for cpu in os.getenv("FFMPEG_CPU_AFFINITY", "").split(",") if cpu != ""
+]
+FFMPEG_MEMORY_LIMIT = int(os.getenv("FFMPEG_MEMORY_LIMIT", 0))
+
+
+class Progress(TypedDict):
+    out_time: Optional[float]
+    frames: int
+    total_size: int
+    fps: Optional[float]
+    speed: Optional[float]
+    is_done: bool
+
+
+def _limit_process() -> None:
+    """Applies the configured limits, in a child process before `ffmpeg` starts."""
+    if FFMPEG_NICE:
+        os.nice(FFMPEG_NICE)
+
+    if FFMPEG_CPU_AFFINITY:
+        os.sched_setaffinity(0, FFMPEG_CPU_AFFINITY)
+
+    if FFMPEG_MEMORY_LIMIT:
+        resource.setrlimit(
+            resource.RLIMIT_AS, (FFMPEG_MEMORY_LIMIT, FFMPEG_MEMORY_LIMIT)
+        )
+
+
+def _process_limits() -> Optional[Callable[[], None]]:
+    """`_limit_process` if any limits are configured, to be passed as `preexec_fn`.
+
+    Otherwise None, as running Python in the child between fork and exec isn't safe
+    while other threads are running, and keeps the faster `posix_spawn` from being
+    used.
+    """
+    if FFMPEG_NICE or FFMPEG_CPU_AFFINITY or FFMPEG_MEMORY_LIMIT:
+        return _limit_process
+
+
+async def _wait_process(
+    process: asyncio.subprocess.Process,
+    communicate: Awaitable[bytes],
+    timeout: Optional[float],
+) -> bytes:
+    """Waits for a process to finish communicating, killing it if it runs for longer
+    than the timeout or if the task waiting on it is cancelled.
+
+    Returns:
+        What `communicate` returned.
+
+    Raises:
+        ConversionTimeoutException: The process ran for longer than the timeout.
+    """
+    try:
+        return await asyncio.wait_for(communicate, timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+        log.warning(f"Killed a process after running for longer than {timeout}s")
+        raise ConversionTimeoutException
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+
+# Shazam signatures are generated from 16KHz mono audio, so there's no point in
+# sending it any more than that.
+SAMPLE_RATE = 16_000
+SAMPLE_CHANNELS = 1
+SAMPLE_WIDTH = 2
+
+# How long cutting a window of audio may take, in seconds. Windows are only a few
+# seconds long, so this is only reached by inputs which `ffmpeg` gets stuck on.
+SLICE_TIMEOUT = float(os.getenv("SLICE_TIMEOUT", 60))
+
+
+def pcm_to_wav(data: bytes) -> bytes:
+    """Wraps raw audio from `audio_slice` in a WAV header.
+
+    Args:
+        data (bytes): Signed 16-bit little endian mono PCM, at `SAMPLE_RATE`.
+
+    Returns:
+        The same audio as a WAV file.
+    """
+    buffer = io.BytesIO()
+
+    with wave.open(buffer, "wb") as file:
+        file.setnchannels(SAMPLE_CHANNELS)
+        file.setsampwidth(SAMPLE_WIDTH)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes(data)
+
+    return buffer.getvalue()
+
+
+async def audio_slice(
+    input_path: str,
+    time_start: Union[int, float],
+    time_duration: Union[int, float],
+    chunk_size: int = 64 * 1024,
+    timeout: Optional[float] = SLICE_TIMEOUT,
+) -> bytes:
+    """Cuts a window out of the audio of some media, without touching the disk.
+
+    The audio is downmixed and resampled for recognition, and `ffmpeg` writes it to
+    its standard output, which is read in chunks.
+
+    Args:
+        input_path (str): Path or URL of the media to take the audio from.
+        time_start (int): Where the window starts, in seconds.
+        time_duration (int): How long the window is, in seconds.
+        chunk_size (int): How many bytes to read from `ffmpeg` at a time.
+        timeout (float): How long cutting the window may take, in seconds. None to
+            let it take as long as it takes.
+
+    Returns:
+        Signed 16-bit little endian mono PCM, at `SAMPLE_RATE`.
+
+    Raises:
+        ConversionTimeoutException: Cutting the window took longer than the timeout.
+        ffmpeg.Error: The command failed.
+    """
+    cmd = (
+        ffmpeg.input(filename=input_path, ss=str(time_start), t=time_duration)
+        .output(
+            "pipe:",
+            format="s16le",
+            acodec="pcm_s16le",
+            ac=SAMPLE_CHANNELS,
+            ar=SAMPLE_RATE,
+            vn=None,
+        )
+        .global_args("-nostdin", "-loglevel", "error")
+    )
+
+    args = cmd.compile()
+    log.debug(" ".join(args))
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=_process_limits(),
+    )
+
+    data = bytearray()
+
+    async def _read_audio():
+        while chunk := await process.stdout.read(chunk_size):
+            data.extend(chunk)
+
+    # Both pipes are read at once, as `ffmpeg` stops writing either once the other
+    # is full.
+    async def _communicate():
+        _, stderr = await asyncio.gather(_read_audio(), process.stderr.read())
+        await process.wait()
+
+        return stderr
+
+    stderr = await _wait_process(process, _communicate(), timeout)
+
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", bytes(data), stderr)
+
+    return bytes(data)
+
+
+async def run_ffmpeg(
+    cmd,
+    timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Progress], Any]] = None,
+) -> None:
+    """Runs an `ffmpeg` command as a subprocess, without blocking the event loop.
+
+    The process is killed if it runs for longer than the timeout, or if the task
+    running it is cancelled, and it is started with the configured nice value, CPU
+    affinity and memory limit.
+
+    Args:
+        cmd: The `ffmpeg-python` output stream to run.
+        timeout (float): How long the command may run for, in seconds. None to let
+            it run for as long as it takes.
+        on_progress (Callable): Called with the progress that `ffmpeg` reports,
+            roughly every half a second. May be a coroutine function.
+
+    Returns:
+        None.
+
+    Raises:
+        ConversionTimeoutException: The command ran for longer than the timeout.
+        ffmpeg.Error: The command failed.
+    """
+    args = cmd.global_args(
+        "-nostdin", "-nostats", "-loglevel", "error", "-progress", "pipe:1"
+    ).compile()
+
+    log.debug(" ".join(args))
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=_process_limits(),
+    )
+
+    async def _read_progress():
+        progress: Dict[str, str] = {}
+
+        while line := await process.stdout.readline():
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            progress[key] = value
+
+            # Each block of progress ends with this key.
+            if key != "progress":
+                continue
+
+            if on_progress is not None:
+                result = on_progress(_parse_progress(progress))
+
+                if asyncio.iscoroutine(result):
+                    await result
+
+            progress = {}
+
+    async def _communicate():
+        _, stderr = await asyncio.gather(_read_progress(), process.stderr.read())
+        await process.wait()
+
+        return stderr
+
+    stderr = await _wait_process(process, _communicate(), timeout)
+
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
+
+
+def _parse_progress(progress: Dict[str, str]) -> Progress:
+    def _number(key: str) -> Optional[float]:
+        try:
+            return float(progress.get(key, "").rstrip("x"))
+        except ValueError:
+            return
+
+    # Despite its name, `out_time_ms` is also in microseconds.
+    out_time_us = _number("out_time_us") or _number("out_time_ms")
+
+    return Progress(
+        out_time=out_time_us / 1_000_000 if out_time_us is not None else None,
+        frames=int(_number("frame") or 0),
+        total_size=int(_number("total_size") or 0),
+        fps=_number("fps"),
+        speed=_number("speed"),
+        is_done=progress.get("progress") == "end",
+    )
+
+
+class MediaInfo(TypedDict):
+    duration: float
+    size: int
+    has_video: bool
+    has_audio: bool
+    width: int
+    height: int
+    fps: float
+    sample_rate: int
+    channels: int
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+    audio_bitrate: int
+
+
+def _parse_fraction(value: Optional[str]) -> float:
+    numerator, _, denominator = (value or "0").partition("/")
+
+    try:
+        if denominator:
+            return float(numerator) / float(denominator)
+
+        return float(numerator)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+
+# How long reading the format and streams of some media may take, in seconds.
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", 30))
+
+
+async def probe(input_path: str, timeout: Optional[float] = PROBE_TIMEOUT) -> dict:
+    """Gets information about the format and streams of some media with `ffprobe`.
+
+    Args:
+        input_path (str): Path or URL of the media to probe.
+        timeout (float): How long probing may take, in seconds. None to let it take
+            as long as it takes.
+
+    Returns:
+        The JSON output of `ffprobe`, with `format` and `streams` keys.
+
+    Raises:
+        ConversionTimeoutException: Probing took longer than the timeout.
+        ffmpeg.Error: The command failed.
+    """
+    args = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_format",
+        "-show_streams",
+        "-of",
+        "json",
+        input_path,
+    ]
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=_process_limits(),
+    )
+
+    stdout, stderr = await _wait_process(process, process.communicate(), timeout)
+
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffprobe", stdout, stderr)
+
+    return json.loads(stdout.decode("utf-8"))
+
+
+def media_info(data: dict) -> MediaInfo:
+    """Takes the output of `probe` and picks out what we need to plan an encode.
+
+    Args:
+        data (dict): The JSON output of `ffprobe`.
+
+    Returns:
+        The duration, size, and stream information of the media.
+    """
+    data_format: dict = data.get("format", {})
+    data_video: dict = {}
+    data_audio: dict = {}
+
+    for stream in data.get("streams", []):
+        # Album art in audio files shows up as a video stream.
+        if stream.get("disposition", {}).get("attached_pic"):
+            continue
+
+        if stream.get("codec_type") == "video" and not data_video:
+            data_video = stream
+        elif stream.get("codec_type") == "audio" and not data_audio:
+            data_audio = stream
+
+    duration = _parse_fraction(data_format.get("duration"))
+
+    if not duration:
+        duration = _parse_fraction(
+            data_video.get("duration") or data_audio.get("duration")
+        )
+
+    return MediaInfo(
+        duration=duration,
+        size=int(data_format.get("size") or 0),
+        has_video=bool(data_video),
+        has_audio=bool(data_audio),
+        width=int(data_video.get("width") or 0),
+        height=int(data_video.get("height") or 0),
+        fps=_parse_fraction(
+            data_video.get("avg_frame_rate") or data_video.get("r_frame_rate")
+        ),
+        sample_rate=int(data_audio.get("sample_rate") or 0),
+        channels=int(data_audio.get("channels") or 0),
+        video_codec=data_video.get("codec_name"),
+        audio_codec=data_audio.get("codec_name"),
+        audio_bitrate=int(data_audio.get("bit_rate") or 0),
+    )
+
+
+class EncodePlan(TypedDict):
+    width: Optional[int]
+    fps: Optional[float]
+    video_bitrate: Optional[int]
+    audio_bitrate: Optional[int]
+    sample_rate: Optional[int]
+    channels: Optional[int]
+    max_colors: Optional[int]
+    two_pass: bool
+    estimated_size: int
+
+
+# How much of the target size we aim for, leaving room for container overhead and
+# the encoder missing its bitrate.
+TARGET_MARGIN = 0.95
+
+# Lowest bitrates, in bits per second, that are still worth watching or listening to.
+MIN_VIDEO_BITRATE = 64_000
+MIN_AUDIO_BITRATE = 32_000
+
+AUDIO_BITRATES = (128_000, 96_000, 64_000, 48_000, 32_000)
+VIDEO_HEIGHTS = (1080, 720, 540, 480, 360, 240, 144)
+VIDEO_FPS = (30, 24, 15)
+
+# How many bits each pixel of each frame needs to look acceptable, by codec.
+MIN_BITS_PER_PIXEL = {".mp4": 0.06, ".webm": 0.045}
+
+# Above this many bits per pixel, quality is already capped by the CRF instead of
+# the bitrate, so a single pass is enough.
+CRF_BITS_PER_PIXEL = 0.15
+
+GIF_WIDTHS = (360, 320, 240, 180, 120)
+GIF_FPS = (15, 12, 10, 8)
+GIF_COLORS = (32, 16)
+
+# GIFs are cut off after this many seconds, as anything longer would be enormous.
+GIF_MAX_DURATION = float(os.getenv("GIF_MAX_DURATION", 60))
+
+# How wide frames are scaled to before the colors of a GIF are picked from them.
+# Only keyframes are used, which can be decoded without the frames around them, and
+# which encoders place at every scene change. A few small frames have much the same
+# colors as every frame at full size, and are far quicker to go through.
+GIF_PALETTE_WIDTH = 160
+
+# Short clips, or ones encoded with few keyframes, may not have enough of them to
+# pick colors from, in which case every frame is decoded and this many a second of
+# them are used instead.
+GIF_PALETTE_MIN_KEYFRAMES = 4
+GIF_PALETTE_FPS = 2
+
+# Roughly how many bytes each pixel of each frame takes up in a GIF with 32 colors,
+# with bayer dithering. Corrected by what the first attempt actually produces.
+GIF_BYTES_PER_PIXEL = 0.1
+
+# FLAC usually compresses to around this much of the raw PCM size.
+FLAC_RATIO = 0.6
+FLAC_SAMPLE_RATES = (48_000, 44_100, 32_000, 22_050)
+
+
+def _even(value: float) -> int:
+    return max(2, int(value) // 2 * 2)
+
+
+def _plan(**kwargs) -> EncodePlan:
+    plan = EncodePlan(
+        width=None,
+        fps=None,
+        video_bitrate=None,
+        audio_bitrate=None,
+        sample_rate=None,
+        channels=None,
+        max_colors=None,
+        two_pass=False,
+        estimated_size=0,
+    )
+    plan.update(kwargs)
+
+    return plan
+
+
+def plan_encode(
+    info: MediaInfo,
+    extension: str,
+    target_size: int,
+    gif_bytes_per_pixel: float = GIF_BYTES_PER_PIXEL,
+) -> EncodePlan:
+    """Works out how to encode some media, so that it ends up smaller than a target
+    size on the first try.
+
+    Args:
+        info (MediaInfo): Information about the media to encode, from `media_info`.
+        extension (str): Extension of the output, e.g., `.mp4`.
+        target_size (int): Size the output must fit in, in bytes.
+        gif_bytes_per_pixel (float): Estimated bytes per pixel per frame of a GIF.
+
+    Returns:
+        The resolution, frame rate, bitrates, and colors to encode with.
+
+    Raises:
+        TargetSizeUnreachableException: Even the lowest quality would be too large.
+    """
+    duration = info["duration"]
+    budget = target_size * TARGET_MARGIN
+
+    if duration <= 0:
+        raise TargetSizeUnreachableException
+
+    if extension == ".gif":
+        return _plan_gif(info, budget, gif_bytes_per_pixel)
+
+    if extension == ".flac":
+        return _plan_flac(info, budget)
+
+    bitrate_total = budget * 8 / duration
+
+    audio_bitrate = None
+
+    if info["has_audio"]:
+        # Audio shouldn't take up more than a fifth of the bitrate of a video.
+        share = 0.2 if info["has_video"] and extension != ".mp3" else 1
+        audio_bitrate = next(
+            (b for b in AUDIO_BITRATES if b <= bitrate_total * share),
+            MIN_AUDIO_BITRATE,
+        )
+
+        if bitrate_total < MIN_AUDIO_BITRATE:
+            raise TargetSizeUnreachableException
+
+    if extension == ".mp3" or not info["has_video"]:
+        # Give any spare room to the audio, up to what is worth having for MP3s.
+        audio_bitrate = int(min(bitrate_total, 192_000))
+
+        return _plan(
+            audio_bitrate=audio_bitrate,
+            estimated_size=int(audio_bitrate * duration / 8),
+        )
+
+    video_bitrate = int(bitrate_total - (audio_bitrate or 0))
+
+    if video_bitrate < MIN_VIDEO_BITRATE:
+        raise TargetSizeUnreachableException
+
+    min_bpp = MIN_BITS_PER_PIXEL.get(extension, 0.06)
+    source_fps = info["fps"] or VIDEO_FPS[0]
+    aspect = info["width"] / info["height"] if info["height"] else 16 / 9
+
+    heights = [h for h in VIDEO_HEIGHTS if h <= info["height"]] or [VIDEO_HEIGHTS[-1]]
+
+    # Prefer lowering the resolution over the frame rate, which is only lowered once
+    # we're at the lowest resolution. If nothing looks acceptable, the lowest of
+    # both is used anyway; it still fits, it will just look worse.
+    candidates = [(height, min(source_fps, VIDEO_FPS[0])) for height in heights]
+    candidates += [(heights[-1], min(source_fps, fps)) for fps in VIDEO_FPS[1:]]
+
+    for height, fps in candidates:
+        width = _even(height * aspect)
+        bpp = video_bitrate / (width * height * fps)
+
+        if bpp >= min_bpp:
+            break
+
+    return _plan(
+        width=width if width < info["width"] else None,
+        fps=fps if fps < source_fps else None,
+        video_bitrate=video_bitrate,
+        audio_bitrate=audio_bitrate,
+        two_pass=bpp < CRF_BITS_PER_PIXEL,
+        estimated_size=int((video_bitrate + (audio_bitrate or 0)) * duration / 8),
+    )
+
+
+def _plan_flac(info: MediaInfo, budget: float) -> EncodePlan:
+    source_rate = info["sample_rate"] or FLAC_SAMPLE_RATES[0]
+    source_channels = info["channels"] or 2
+
+    rates = [rate for rate in FLAC_SAMPLE_RATES if rate <= source_rate]
+    channels = sorted({source_channels, 1}, reverse=True)
+
+    for channel_count in channels:
+        for rate in rates or [source_rate]:
+            estimate = info["duration"] * rate * channel_count * 2 * FLAC_RATIO
+
+            if estimate <= budget:
+                return _plan(
+                    sample_rate=rate if rate < source_rate else None,
+                    channels=channel_count if channel_count < source_channels else None,
+                    estimated_size=int(estimate),
+                )
+
+    raise TargetSizeUnreachableException
+
+
+def _plan_gif(info: MediaInfo, budget: float, bytes_per_pixel: float) -> EncodePlan:
+    source_fps = info["fps"] or GIF_FPS[0]
+    aspect = info["height"] / info["width"] if info["width"] else 9 / 16
+
+    widths = [w for w in GIF_WIDTHS if w <= info["width"]] or [GIF_WIDTHS[-1]]
+
+    for width in widths:
+        for fps in GIF_FPS:
+            fps = min(fps, source_fps)
+
+            for colors in GIF_COLORS:
+                # Fewer colors compress better, roughly by how many bits they need.
+                factor = bytes_per_pixel * math.log2(colors) / math.log2(GIF_COLORS[0])
+                pixels = width * _even(width * aspect) * fps * info["duration"]
+                estimate = pixels * factor
+
+                if estimate <= budget:
+                    return _plan(
+                        width=width,
+                        fps=fps,
+                        max_colors=colors,
+                        estimated_size=int(estimate),
+                    )
+
+    raise TargetSizeUnreachableException
+
+
+# Codecs that each container can hold as they are, by their `ffprobe` names.
+CONTAINER_CODECS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    ".mp4": {
+        "video": ("h264", "hevc", "av1", "mpeg4"),
+        "audio": ("aac", "mp3", "alac", "opus", "flac"),
+    },
+    ".webm": {"video": ("vp8", "vp9", "av1"), "audio": ("vorbis", "opus")},
+    ".mp3": {"video": (), "audio": ("mp3",)},
+    ".flac": {"video": (), "audio": ("flac",)},
+}
+
+# Bitrate to encode audio at when only the audio has to be converted.
+COPY_AUDIO_BITRATE = 128_000
+
+
+class CopyPlan(TypedDict):
+    copy_video: bool
+    copy_audio: bool
+    options: Dict[str, Any]
+    estimated_size: int
+
+
+def plan_copy(
+    info: MediaInfo, extension: str, target_size: Optional[int] = None
+) -> Optional[CopyPlan]:
+    """Works out whether some media can be converted without re-encoding its video,
+    by copying the streams that the new container can already hold.
+
+    Args:
+        info (MediaInfo): Information about the media to convert, from `media_info`.
+        extension (str): Extension of the output, e.g., `.mp4`.
+        target_size (int): Size the output must fit in, in bytes, if any.
+
+    Returns:
+        Which streams to copy, and the `ffmpeg` output options to do so, or None if
+        the video has to be re-encoded (or the result wouldn't fit).
+    """
+    codecs = CONTAINER_CODECS.get(extension)
+
+    if codecs is None:
+        return
+
+    is_audio_only = not codecs["video"]
+
+    copy_video = info["has_video"] and info["video_codec"] in codecs["video"]
+    copy_audio = info["has_audio"] and info["audio_codec"] in codecs["audio"]
+
+    # Re-encoding the video is the expensive part, so once that has to happen there
+    # is nothing to gain here.
+    if is_audio_only and not copy_audio:
+        return
+
+    if not is_audio_only and info["has_video"] and not copy_video:
+        return
+
+    if not info["has_video"] and not info["has_audio"]:
+        return
+
+    options: Dict[str, Any] = {}
+    estimated_size = info["size"]
+
+    if copy_video and not is_audio_only:
+        options["c:v"] = "copy"
+
+    if copy_audio:
+        options["c:a"] = "copy"
+    elif info["has_audio"] and not is_audio_only:
+        options["c:a"] = AUDIO_ENCODERS[extension]
+        options["b:a"] = COPY_AUDIO_BITRATE
+
+        if info["audio_bitrate"]:
+            estimated_size += int(
+                (COPY_AUDIO_BITRATE - info["audio_bitrate"]) * info["duration"] / 8
+            )
+
+    if is_audio_only and info["audio_bitrate"]:
+        estimated_size = int(info["audio_bitrate"] * info["duration"] / 8)
+
+    if extension == ".mp4":
+        # Lets players start before the whole file has been downloaded.
+        options["movflags"] = "+faststart"
+
+    if target_size is not None and estimated_size > target_size * TARGET_MARGIN:
+        return
+
+    return CopyPlan(
+        copy_video=copy_video and not is_audio_only,
+        copy_audio=copy_audio,
+        options=options,
+        estimated_size=estimated_size,
+    )
+
+
+async def gif_palette(
+    input_path: str,
+    output_path: str,
+    max_colors: int,
+    timeout: Optional[float] = None,
+) -> None:
+    """Picks the colors to make a video into a GIF with, from a few frames of it.
+
+    The keyframes are used if there are at least `GIF_PALETTE_MIN_KEYFRAMES` of
+    them, otherwise `GIF_PALETTE_FPS` frames from every second.
+
+    Args:
+        input_path (str): Path to the video.
+        output_path (str): Path to save the palette to, as a PNG.
+        max_colors (int): How many colors the palette may have.
+        timeout (float): How long picking the colors may take, in seconds.
+
+    Returns:
+        None.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    # The frames are also sent nowhere, before the palette, so that the progress
+    # counts how many keyframes were used rather than the single palette.
+    frames = (
+        ffmpeg.input(input_path, t=GIF_MAX_DURATION, skip_frame="nokey")
+        .video.filter("scale", GIF_PALETTE_WIDTH, -1)
+        .split()
+    )
+    cmd = ffmpeg.merge_outputs(
+        frames[0].output("-", format="null"),
+        frames[1].filter("palettegen", max_colors=max_colors).output(output_path),
+    ).overwrite_output()
+
+    keyframes = 0
+
+    def _count_keyframes(progress: Progress) -> None:
+        nonlocal keyframes
+        keyframes = progress["frames"]
+
+    await run_ffmpeg(cmd, timeout, on_progress=_count_keyframes)
+
+    if keyframes < GIF_PALETTE_MIN_KEYFRAMES:
+        cmd = (
+            ffmpeg.input(input_path, t=GIF_MAX_DURATION)
+            .video.filter("fps", GIF_PALETTE_FPS)
+            .filter("scale", GIF_PALETTE_WIDTH, -1)
+            .filter("palettegen", max_colors=max_colors)
+            .output(output_path)
+            .overwrite_output()
+        )
+
+        await run_ffmpeg(
+            cmd, deadline - time.monotonic() if deadline is not None else None
+        )
+
+
+async def video_to_gif(
+    input_path: str,
+    output_path: str,
+    timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Progress], Any]] = None,
+    plan: Optional[EncodePlan] = None,
+    palettes: Optional[Dict[int, bytes]] = None,
+) -> None:
     """Tries to convert a given video to a GIF and compresses it.
 
+    The palette is picked first by `gif_palette`, so that the frames can then be
+    converted as they are decoded rather than all being held until the palette is
+    known. Only the first `GIF_MAX_DURATION` seconds are converted.
+
     Args:
         input_path (str): Path to the media we should use as an input.
         output_path (str): Path to save the output media to.
+        timeout (float): How long the conversion may take, in seconds.
+        on_progress (Callable): Called with the progress of the conversion.
+        plan (EncodePlan): The width, frame rate, and colors to use, from
+            `plan_encode`. Defaults to 360px, 15 FPS, and 32 colors.
+        palettes (dict): Palettes already picked for this video, as PNGs, by how
+            many colors they could have. A palette that has to be picked is added
+            to it, so that converting the same video again at another size doesn't
+            have to go through it again.
 
     Returns:
         None.
     """
+    width = (plan and plan["width"]) or 360
+    fps = (plan and plan["fps"]) or 15
+    max_colors = (plan and plan["max_colors"]) or 32
 
-    # 360px width, automatically configure height, and cap to 15 FPS.
-    split = (
-        ffmpeg.input(input_path)
-        .video.filter("scale", 360, -1, flags="lanczos")
-        .filter("fps", fps=15)
-        .split()
-    )
+    deadline = time.monotonic() + timeout if timeout is not None else None
 
-    (
-        ffmpeg.filter(
-            [split[1], split[0].filter("palettegen", max_colors=32)],
-            "paletteuse",
-            dither="bayer",
+    with TemporaryDirectory() as path_temp:
+        path_palette = os.path.join(path_temp, "palette.png")
+        if palettes is not None and max_colors in palettes:
+            with open(path_palette, "wb") as file:
+                file.write(palettes[max_colors])
+        else:
+            await gif_palette(input_path, path_palette, max_colors, timeout)
+
+            if palettes is not None:
+                with open(path_palette, "rb") as file:
+                    palettes[max_colors] = file.read()
+
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                raise ConversionTimeoutException
+
+        # Automatically configure height, keeping the aspect ratio. Frames are
+        # dropped before scaling, so that dropped frames aren't scaled for nothing.
+        video = (
+            ffmpeg.input(input_path, t=GIF_MAX_DURATION)
+            .video.filter("fps", fps=fps)
+            .filter("scale", width, -1, flags="lanczos")
         )
-        .output(output_path)
-        .overwrite_output()
-        .run(quiet=True)
-    )
 
+        cmd = (
+            ffmpeg.filter(
+                [video, ffmpeg.input(path_palette).video],
+                "paletteuse",
+                dither="bayer",
+            )
+            .output(output_path)
+            .overwrite_output()
+        )
+
+        await run_ffmpeg(cmd, timeout, on_progress)
+
+
+async def mux(
+    input_paths: List[str], output_path: str, timeout: Optional[float] = None
+) -> None:
+    """Joins streams that were downloaded separately, such as Reddit's video and
+    audio, into one file without re-encoding them.
+
+    Args:
+        input_paths (list): Paths to the media to take every stream from.
+        output_path (str): Path to save the output media to.
+        timeout (float): How long joining them may take, in seconds.
+
+    Returns:
+        None.
+    """
+    cmd = ffmpeg.output(
+        *[ffmpeg.input(input_path) for input_path in input_paths],
+        output_path,
+        c="copy",
+    ).overwrite_output()
+
+    await run_ffmpeg(cmd, timeout)
+
+
+# Encoders to use for each output, when the size has to be controlled.
+VIDEO_ENCODERS = {".mp4": "libx264", ".webm": "libvpx-vp9"}
+AUDIO_ENCODERS = {".mp4": "aac", ".webm": "libopus", ".mp3": "libmp3lame"}
+
+
+class SpeedTier(Enum):
+    """How much quality (for the same size) to give up to encode faster."""
+
+    FAST = "fast"
+    BALANCED = "balanced"
+    SMALL = "small"
+
+
+# Settings for each encoder in each tier. x264's default (`medium`) sits between
+# `fast` and `slow`, which is only used while nothing else is waiting. VP9's default
+# is far slower than we can afford in any tier, encoding a 720p video at around an
+# eighth of realtime on one core. Splitting each frame into columns of tiles, and
+# encoding rows at once within them, lets VP9 make use of more than one thread.
+ENCODER_TIERS: Dict[str, Dict[SpeedTier, Dict[str, Any]]] = {
+    "libx264": {
+        SpeedTier.FAST: {"preset": "veryfast"},
+        SpeedTier.BALANCED: {"preset": "fast"},
+        SpeedTier.SMALL: {"preset": "slow"},
+    },
+    "libvpx-vp9": {
+        SpeedTier.FAST: {
+            "deadline": "realtime",
+            "cpu-used": 8,
+            "row-mt": 1,
+            "tile-columns": 2,
+        },
+        SpeedTier.BALANCED: {
+            "deadline": "good",
+            "cpu-used": 4,
+            "row-mt": 1,
+            "tile-columns": 2,
+        },
+        SpeedTier.SMALL: {
+            "deadline": "good",
+            "cpu-used": 2,
+            "row-mt": 1,
+            "tile-columns": 2,
+        },
+    },
+}
+
+
+def encoder_threads(jobs: int) -> int:
+    """How many threads each encoder should use, when `jobs` of them share the
+    cores that `ffmpeg` may run on."""
+    cores = len(FFMPEG_CPU_AFFINITY) or os.cpu_count() or 1
+    return max(1, cores // max(1, jobs))
+
+
+def _encoder_options(
+    extension: str, tier: SpeedTier, threads: Optional[int]
+) -> Dict[str, Any]:
+    """The video encoder for an output, and its settings for the given tier."""
+    encoder = VIDEO_ENCODERS.get(extension)
+
+    if encoder is None:
+        return {}
+
+    options: Dict[str, Any] = {"c:v": encoder, **ENCODER_TIERS[encoder][tier]}
+
+    if threads:
+        options["threads"] = threads
+
+    return options
+
+
+def _can_two_pass(extension: str, tier: SpeedTier) -> bool:
+    """Whether the video encoder for an output can encode in two passes in the
+    given tier, which VP9 can't in realtime."""
+    encoder = VIDEO_ENCODERS.get(extension)
+
+    if encoder is None:
+        return True
+
+    return ENCODER_TIERS[encoder][tier].get("deadline") != "realtime"
+
+
+def _encode_options(
+    extension: str,
+    plan: EncodePlan,
+    tier: SpeedTier = SpeedTier.SMALL,
+    threads: Optional[int] = None,
+) -> Dict[str, Any]:
+    options: Dict[str, Any] = {}
+    filters = []
+
+    if plan["width"]:
+        filters.append(f"scale={plan['width']}:-2")
+
+    if plan["fps"]:
+        filters.append(f"fps={plan['fps']}")
+
+    if filters:
+        options["vf"] = ",".join(filters)
+
+    if plan["video_bitrate"]:
+        options.update(_encoder_options(extension, tier, threads))
+        options["b:v"] = plan["video_bitrate"]
+
+        # Not every player (including Discord's) can play anything else.
+        options["pix_fmt"] = "yuv420p"
+
+        # Let the quality decide the bitrate, but never go over the budget. VP9 does
+        # this by itself when given a CRF along with a bitrate.
+        if not plan["two_pass"] and extension == ".webm":
+            options["crf"] = 31
+        elif not plan["two_pass"]:
+            options["crf"] = 23
+            options["maxrate"] = plan["video_bitrate"]
+            options["bufsize"] = plan["video_bitrate"] * 2
+
+    if plan["audio_bitrate"]:
+        options["c:a"] = AUDIO_ENCODERS.get(extension, "aac")
+        options["b:a"] = plan["audio_bitrate"]
+
+        # Opus otherwise goes well over its bitrate for simple audio.
+        if options["c:a"] == "libopus":
+            options["vbr"] = "constrained"
+
+    if plan["sample_rate"]:
+        options["ar"] = plan["sample_rate"]
+
+    if plan["channels"]:
+        options["ac"] = plan["channels"]
+
+    return options
+
+
+async def _video_planned(
+    input_path: str,
+    output_path: str,
+    plan: EncodePlan,
+    timeout: Optional[float],
+    on_progress: Optional[Callable[[Progress], Any]],
+    info: Optional[MediaInfo] = None,
+    tier: SpeedTier = SpeedTier.SMALL,
+    threads: Optional[int] = None,
+) -> None:
+    _, extension = os.path.splitext(output_path)
+
+    # A single pass may go over the budget, but `video` tries again if it does.
+    if plan["two_pass"] and not _can_two_pass(extension, tier):
+        plan = _plan(**{**plan, "two_pass": False})
+
+    options = _encode_options(extension, plan, tier, threads)
+
+    # Only the video needs converting if the audio already fits in the container,
+    # and in the bitrate we planned for it.
+    if (
+        info is not None
+        and plan["audio_bitrate"]
+        and extension in CONTAINER_CODECS
+        and info["audio_codec"] in CONTAINER_CODECS[extension]["audio"]
+        and 0 < info["audio_bitrate"] <= plan["audio_bitrate"]
+    ):
+        options["c:a"] = "copy"
+        del options["b:a"]
+        options.pop("vbr", None)
+
+    if not plan["two_pass"]:
+        cmd = ffmpeg.input(input_path).output(output_path, **options)
+        return await run_ffmpeg(cmd.overwrite_output(), timeout, on_progress)
 
-def video(input_path: str, output_path: str) -> None:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    with TemporaryDirectory() as path_temp:
+        options["passlogfile"] = os.path.join(path_temp, "pass")
+
+        # The first pass only analyses the video, so skip the audio and the output.
+        options_first = {
+            key: value for key, value in options.items() if not key.endswith(":a")
+        }
+
+        cmd = ffmpeg.input(input_path).output(
+            os.devnull, format="null", an=None, **{"pass": 1}, **options_first
+        )
+        await run_ffmpeg(cmd.overwrite_output(), timeout, on_progress)
+
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                raise ConversionTimeoutException
+
+        cmd = ffmpeg.input(input_path).output(output_path, **{"pass": 2}, **options)
+        await run_ffmpeg(cmd.overwrite_output(), timeout, on_progress)
+
+
+# How many times to encode again when an estimate turned out to be too optimistic.
+TARGET_ATTEMPTS = 3
+
+
+async def video(
+    input_path: str,
+    output_path: str,
+    timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Progress], Any]] = None,
+    target_size: Optional[int] = None,
+    tier: SpeedTier = SpeedTier.SMALL,
+    threads: Optional[int] = None,
+    palettes: Optional[Dict[int, bytes]] = None,
+) -> None:
     """Tries to convert the input video into the format specified by the
     extension of the output path.
 
@@ -44,13 +1092,120 @@ def video(input_path: str, output_path: str) -> None:
     Args:
         input_path (str): Path to the media we should use as an input.
         output_path (str): Path to save the output media to.
+        timeout (float): How long the conversion may take, in seconds.
+        on_progress (Callable): Called with the progress of the conversion.
+        target_size (int): Size the output must fit in, in bytes. The bitrate,
+            resolution, frame rate, and colors are chosen to fit it.
+        tier (SpeedTier): How much quality to give up to encode the video faster.
+        threads (int): How many threads the video encoder may use, or None to let
+            it decide.
+        palettes (dict): Palettes already picked for the input, when converting to
+            a GIF. See `video_to_gif`.
 
     Returns:
         None.
+
+    Raises:
+        TargetSizeUnreachableException: The output can't be made to fit the target
+            size. Raised before encoding whenever it can be worked out up front.
     """
     _, extension = os.path.splitext(output_path)
 
+    if target_size is None and extension == ".gif":
+        return await video_to_gif(
+            input_path, output_path, timeout, on_progress, palettes=palettes
+        )
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    info = media_info(
+        await probe(
+            input_path,
+            min(PROBE_TIMEOUT, timeout) if timeout is not None else PROBE_TIMEOUT,
+        )
+    )
+
+    # Only the start of a long video is made into a GIF.
     if extension == ".gif":
-        return video_to_gif(input_path, output_path)
+        info["duration"] = min(info["duration"], GIF_MAX_DURATION)
+
+    # Remuxing (and converting the audio at most) takes milliseconds, compared to
+    # the seconds that re-encoding the video would.
+    plan_remux = plan_copy(info, extension, target_size)
+
+    if plan_remux is not None:
+        cmd = ffmpeg.input(input_path)
+        streams = []
+
+        if plan_remux["copy_video"]:
+            streams.append(cmd["v:0"])
+
+        if info["has_audio"]:
+            streams.append(cmd["a:0"])
+
+        options = plan_remux["options"]
+        log.debug(f"Remuxing {input_path} with {options}")
+
+        await run_ffmpeg(
+            ffmpeg.output(*streams, output_path, **options).overwrite_output(),
+            timeout,
+            on_progress,
+        )
+
+        if target_size is None or os.path.getsize(output_path) <= target_size:
+            return
+
+        log.debug("Remuxed output was too large, converting it instead")
+
+    if target_size is None:
+        options = _encoder_options(extension, tier, threads)
+        cmd = ffmpeg.input(input_path).output(output_path, **options)
+
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+
+        return await run_ffmpeg(cmd.overwrite_output(), timeout, on_progress)
+
+    gif_bytes_per_pixel = GIF_BYTES_PER_PIXEL
+    scale = 1.0
+
+    for _ in range(TARGET_ATTEMPTS):
+        plan = plan_encode(
+            info, extension, int(target_size * scale), gif_bytes_per_pixel
+        )
+
+        log.debug(f"Encoding {input_path} to fit {target_size} bytes with {plan}")
+
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                raise ConversionTimeoutException
+
+        if extension == ".gif":
+            await video_to_gif(
+                input_path, output_path, timeout, on_progress, plan, palettes
+            )
+        else:
+            await _video_planned(
+                input_path,
+                output_path,
+                plan,
+                timeout,
+                on_progress,
+                info,
+                tier,
+                threads,
+            )
+
+        size = os.path.getsize(output_path)
+
+        if size <= target_size:
+            return
+
+        log.debug(f"Encoded {size} bytes, estimated {plan['estimated_size']}")
+
+        # Learn from how far off the estimate was, and aim lower next time.
+        gif_bytes_per_pixel *= size / max(plan["estimated_size"], 1) * 1.1
+        scale *= target_size / size * 0.95
 
-    (ffmpeg.input(input_path).output(output_path).run(quiet=True))
+    raise TargetSizeUnreachableException
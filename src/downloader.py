@@ -0,0 +1,316 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+from contextlib import suppress
+from typing import Dict, List, Optional, Tuple, TypedDict
+
+import aiofiles
+import aiohttp
+
+from .exceptions import DownloadTooLargeException
+
+log = logging.getLogger(__name__)
+
+# Connection limits of the shared session, in total and for each host.
+HTTP_CONNECTIONS = int(os.getenv("HTTP_CONNECTIONS", 64))
+HTTP_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_CONNECTIONS_PER_HOST", 8))
+
+# How long idle connections are kept open for re-use, in seconds.
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 30))
+
+# Largest file we are willing to download, in bytes.
+DOWNLOAD_MAX_SIZE = int(os.getenv("DOWNLOAD_MAX_SIZE", 100 * 1024 * 1024))
+
+# How much of a download is held in memory at a time, in bytes.
+CHUNK_SIZE = 64 * 1024
+
+# How many ranges of a file are downloaded at once by `download_segmented`. These
+# count towards `HTTP_CONNECTIONS_PER_HOST`, which no host goes over.
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", 4))
+
+# Smallest range worth opening another connection for, in bytes.
+SEGMENT_MIN_SIZE = 1024 * 1024
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Get the session shared by the whole process, so that connections to the same
+    hosts are pooled and kept alive between requests.
+
+    Returns:
+        The shared session, created if it doesn't exist yet.
+    """
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS,
+            limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=30),
+        )
+
+    return _session
+
+
+async def close() -> None:
+    """Close the shared session and all of its connections."""
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+class Download(TypedDict):
+    path: str
+    content_type: str
+    size: int
+    total_size: Optional[int]
+    is_partial: bool
+
+
+def _total_size(resp: aiohttp.ClientResponse) -> Optional[int]:
+    # For partial responses, e.g., `bytes 0-1023/146515`.
+    content_range = resp.headers.get("Content-Range", "")
+    _, _, total = content_range.rpartition("/")
+
+    if total.isdigit():
+        return int(total)
+
+    if resp.status == 200 and resp.content_length is not None:
+        return resp.content_length
+
+
+async def download(
+    link: str,
+    output_path: str,
+    max_size: Optional[int] = DOWNLOAD_MAX_SIZE,
+    byte_range: Optional[Tuple[int, Optional[int]]] = None,
+    chunk_size: int = CHUNK_SIZE,
+    headers: Optional[Dict[str, str]] = None,
+    digest: Optional["hashlib._Hash"] = None,
+) -> Download:
+    """Downloads a file from a URL to the given path, a chunk at a time.
+
+    Args:
+        link (str): Where to download the file from.
+        output_path (str): Where to save the file to. An `{ext}` placeholder is
+            replaced with the extension matching the file's content type.
+        max_size (int): Largest number of bytes to download. The download is aborted
+            as soon as it is known to be larger. None for no limit.
+        byte_range (tuple): First and last byte (inclusive) to download, where the
+            last byte can be None to download until the end.
+        chunk_size (int): How many bytes to read and write at a time.
+        headers (dict): Extra headers to send, e.g., those yt-dlp says are needed.
+        digest (hashlib._Hash): Hash to update with each chunk as it is written, so
+            that the file doesn't have to be read again to hash it.
+
+    Returns:
+        Where the file was saved to, its content type, how many bytes were written,
+        and the size of the whole file if it is known.
+
+    Raises:
+        DownloadTooLargeException: The file is larger than `max_size`.
+    """
+    headers = dict(headers or {})
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+
+    async with get_session().get(link, headers=headers) as resp:
+        resp.raise_for_status()
+
+        mime = resp.headers.get("Content-Type", "audio/mp3").split(";")[0]
+        path = output_path.format(ext=mimetypes.guess_extension(mime) or "")
+
+        # The server ignored the range, so we'll have to skip to it ourselves.
+        skip = 0
+        remaining = None
+
+        if byte_range is not None and resp.status != 206:
+            log.debug(f"Range requests aren't supported for {link}")
+
+            skip = byte_range[0]
+
+            if byte_range[1] is not None:
+                remaining = byte_range[1] - byte_range[0] + 1
+
+        if max_size is not None and resp.content_length is not None:
+            if resp.content_length - skip > max_size and (
+                remaining is None or remaining > max_size
+            ):
+                raise DownloadTooLargeException
+
+        size = 0
+
+        try:
+            async with aiofiles.open(path, "wb") as file:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    if skip:
+                        chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+
+                    if remaining is not None:
+                        chunk = chunk[:remaining]
+                        remaining -= len(chunk)
+
+                    size += len(chunk)
+
+                    if max_size is not None and size > max_size:
+                        raise DownloadTooLargeException
+
+                    await file.write(chunk)
+
+                    if digest is not None:
+                        digest.update(chunk)
+
+                    if remaining == 0:
+                        break
+        except BaseException:
+            # Never created if opening it failed, which mustn't hide why.
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+            raise
+
+        return Download(
+            path=path,
+            content_type=mime,
+            size=size,
+            total_size=_total_size(resp),
+            is_partial=byte_range is not None,
+        )
+
+
+def _segments(size: int, count: int) -> List[Tuple[int, int]]:
+    """Split a file into at most `count` ranges of at least `SEGMENT_MIN_SIZE`
+    bytes, as the first and last byte (inclusive) of each."""
+    count = max(1, min(count, size // SEGMENT_MIN_SIZE))
+    bounds = [size * index // count for index in range(count + 1)]
+
+    return [(start, end - 1) for start, end in zip(bounds, bounds[1:])]
+
+
+async def _download_segment(
+    link: str,
+    path: str,
+    byte_range: Tuple[int, int],
+    headers: Dict[str, str],
+    chunk_size: int,
+) -> None:
+    start, end = byte_range
+    headers = {**headers, "Range": f"bytes={start}-{end}"}
+
+    async with get_session().get(link, headers=headers) as resp:
+        resp.raise_for_status()
+
+        if resp.status != 206:
+            raise aiohttp.ClientPayloadError(f"Range {start}-{end} wasn't honoured")
+
+        # Each segment writes to its own part of the file, which is already the
+        # full size.
+        async with aiofiles.open(path, "r+b") as file:
+            await file.seek(start)
+
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                chunk = chunk[: end + 1 - start]
+                start += len(chunk)
+
+                await file.write(chunk)
+
+                if start > end:
+                    break
+
+    if start <= end:
+        raise aiohttp.ClientPayloadError(f"Range ended {end + 1 - start} bytes early")
+
+
+async def download_segmented(
+    link: str,
+    output_path: str,
+    max_size: Optional[int] = DOWNLOAD_MAX_SIZE,
+    segments: int = DOWNLOAD_SEGMENTS,
+    chunk_size: int = CHUNK_SIZE,
+    headers: Optional[Dict[str, str]] = None,
+) -> Download:
+    """Downloads a file from a URL to the given path, fetching several ranges of it
+    at once over separate connections, which is much quicker from CDNs which are
+    slow for each connection.
+
+    Files from servers without range requests, or which are too small to be worth
+    splitting up, are downloaded as a whole by `download`.
+
+    Args:
+        link (str): Where to download the file from.
+        output_path (str): Where to save the file to. An `{ext}` placeholder is
+            replaced with the extension matching the file's content type.
+        max_size (int): Largest number of bytes to download. None for no limit.
+        segments (int): How many ranges to download at once.
+        chunk_size (int): How many bytes to read and write at a time.
+        headers (dict): Extra headers to send, e.g., those yt-dlp says are needed.
+
+    Returns:
+        Where the file was saved to, its content type, how many bytes were written,
+        and the size of the whole file.
+
+    Raises:
+        DownloadTooLargeException: The file is larger than `max_size`.
+    """
+    headers = dict(headers or {})
+
+    # Asking for the first byte tells us both how large the file is, and whether
+    # the server supports range requests.
+    async with get_session().get(
+        link, headers={**headers, "Range": "bytes=0-0"}
+    ) as resp:
+        resp.raise_for_status()
+
+        mime = resp.headers.get("Content-Type", "video/mp4").split(";")[0]
+        size = _total_size(resp) if resp.status == 206 else None
+
+    if size is None or size < 2 * SEGMENT_MIN_SIZE or segments <= 1:
+        return await download(
+            link, output_path, max_size, chunk_size=chunk_size, headers=headers
+        )
+
+    if max_size is not None and size > max_size:
+        raise DownloadTooLargeException
+
+    path = output_path.format(ext=mimetypes.guess_extension(mime) or "")
+
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+    tasks = [
+        asyncio.ensure_future(
+            _download_segment(link, path, byte_range, headers, chunk_size)
+        )
+        for byte_range in _segments(size, segments)
+    ]
+
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other segments before removing the file they're writing to.
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+        raise
+
+    return Download(
+        path=path, content_type=mime, size=size, total_size=size, is_partial=False
+    )
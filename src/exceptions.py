@@ -6,3 +6,22 @@ class BotException(Exception):
 class InvalidLinkException(BotException):
     """Provided link was not a valid URL."""
 
+
+class SchedulerBusyException(BotException):
+    """Too many jobs are already queued, so this one was rejected."""
+
+
+class ConversionTimeoutException(BotException):
+    """Converting the media took longer than it was allowed to."""
+
+
+class TargetSizeUnreachableException(BotException):
+    """The media can't be encoded small enough to fit the target size."""
+
+
+class DownloadTooLargeException(BotException):
+    """The file being downloaded is larger than we are willing to download."""
+
+
+class RecognitionUnavailableException(BotException):
+    """The recognition service has been failing, so requests to it are paused."""
@@ -0,0 +1,144 @@
+"""Local audio fingerprints, so that audio which was already recognized can be
+matched again without asking Shazam, even when it was re-encoded or cut a little
+differently.
+
+Based on Haitsma and Kalker's "A Highly Robust Audio Fingerprinting System", with
+frames scaled for the 16 kHz audio that is sliced for recognition. Each frame of
+audio becomes a 32-bit sub-fingerprint, and two windows match when few enough bits
+differ between them at some alignment.
+"""
+
+import hashlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .conversion import SAMPLE_RATE
+
+# Length of each frame, and how far apart frames start, in samples.
+FRAME_SIZE = 2048
+HOP_SIZE = 256
+
+# Frequency bands compared between frames, in Hz. One bit comes from each pair of
+# neighbouring bands.
+BAND_COUNT = 33
+BAND_LOW = 300
+BAND_HIGH = 2000
+
+# Windows quieter than this (in the RMS of 16-bit samples) aren't fingerprinted, as
+# silence fingerprints the same no matter where it comes from.
+MIN_RMS = 100
+
+# One in this many sub-fingerprints is used as an anchor to look up candidates by.
+# These are picked by their value rather than position, so the same ones are picked
+# in windows which start at different times.
+ANCHOR_MODULUS = 16
+
+# Sub-fingerprints which are too common to be worth looking up.
+ANCHOR_IGNORED = (0x00000000, 0xFFFFFFFF)
+
+# Largest share of bits which may differ for two windows to match. Unrelated audio
+# differs in about half of them, but different songs in the same key and tempo can
+# come within 0.36 at their best alignment. A re-encoded copy differs in about 0.2.
+MATCH_THRESHOLD = 0.3
+
+# How many sub-fingerprints two windows need to overlap by to be compared, which is
+# about four seconds. Shorter overlaps let unrelated audio line up by chance.
+MATCH_OVERLAP = 256
+
+
+def _band_edges(sample_rate: int) -> np.ndarray:
+    edges = np.geomspace(BAND_LOW, BAND_HIGH, BAND_COUNT + 1)
+    return np.round(edges * FRAME_SIZE / sample_rate).astype(np.intp)
+
+
+def compute(data: bytes, sample_rate: int = SAMPLE_RATE) -> Optional[np.ndarray]:
+    """Fingerprint some audio.
+
+    Args:
+        data (bytes): Signed 16-bit little endian mono PCM.
+        sample_rate (int): Sample rate of the audio.
+
+    Returns:
+        A 32-bit sub-fingerprint for each frame, or None if the audio is too short
+        or too quiet to fingerprint.
+    """
+    samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+
+    if len(samples) < FRAME_SIZE + HOP_SIZE * MATCH_OVERLAP:
+        return
+
+    if np.sqrt(np.mean(samples**2)) < MIN_RMS:
+        return
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    power = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE), axis=1)) ** 2
+
+    edges = _band_edges(sample_rate)
+    energy = np.add.reduceat(power[:, : edges[-1]], edges[:-1], axis=1)
+
+    # Whether the difference in energy between neighbouring bands grew since the
+    # last frame.
+    difference = energy[:, :-1] - energy[:, 1:]
+    bits = (difference[1:] - difference[:-1]) > 0
+
+    weights = np.left_shift(np.uint64(1), np.arange(32, dtype=np.uint64))
+    return (bits.astype(np.uint64) @ weights).astype(np.uint32)
+
+
+def digest(data_fingerprint: np.ndarray) -> bytes:
+    """A hash of the exact fingerprint, for finding identical audio."""
+    return hashlib.sha1(data_fingerprint.astype("<u4").tobytes()).digest()
+
+
+def anchors(data_fingerprint: np.ndarray) -> List[Tuple[int, int]]:
+    """Pick the sub-fingerprints used to look up candidate matches.
+
+    Returns:
+        The position and value of each anchor.
+    """
+    mixed = (data_fingerprint.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(
+        0xFFFFFFFF
+    )
+    positions = np.nonzero((mixed >> np.uint64(24)) % ANCHOR_MODULUS == 0)[0]
+
+    return [
+        (int(position), int(data_fingerprint[position]))
+        for position in positions
+        if int(data_fingerprint[position]) not in ANCHOR_IGNORED
+    ]
+
+
+def bit_error_rate(
+    data_a: np.ndarray, data_b: np.ndarray, offset: int
+) -> Optional[float]:
+    """The share of bits which differ between two fingerprints.
+
+    Args:
+        data_a (np.ndarray): The first fingerprint.
+        data_b (np.ndarray): The second fingerprint.
+        offset (int): Position in `data_b` that the start of `data_a` lines up with.
+
+    Returns:
+        The share of differing bits where they overlap, or None if they don't
+        overlap by enough to tell.
+    """
+    start_a, start_b = max(0, -offset), max(0, offset)
+    length = min(len(data_a) - start_a, len(data_b) - start_b)
+
+    if length < MATCH_OVERLAP:
+        return
+
+    xor = np.bitwise_xor(
+        data_a[start_a : start_a + length], data_b[start_b : start_b + length]
+    )
+
+    return float(np.unpackbits(xor.view(np.uint8)).sum()) / (length * 32)
+
+
+def to_bytes(data_fingerprint: np.ndarray) -> bytes:
+    return data_fingerprint.astype("<u4").tobytes()
+
+
+def from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype="<u4").astype(np.uint32)
@@ -0,0 +1,406 @@
+"""Offline song recognition against a local library, by pairs of spectrogram peaks
+("landmarks") in the style of Wang's "An Industrial-Strength Audio Search
+Algorithm".
+
+The strongest peaks of each song's spectrogram are paired with a few peaks shortly
+after them, and each pair is hashed from both frequencies and the time between them.
+Audio is recognized by looking up its own pairs, and finding the song where the most
+of them line up at the same offset.
+
+The library is indexed ahead of time, using a process for each core:
+
+    python3 -m src.landmark path/to/library --output data/landmarks.npz
+"""
+
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import ffmpeg
+import numpy as np
+
+from . import scheduler
+from .api import song
+from .conversion import SAMPLE_RATE
+from .recognition import Recognizer
+
+log = logging.getLogger(__name__)
+
+# Length of each frame of the spectrogram, and how far apart frames start, in
+# samples.
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+
+# Range of frequency bins that peaks are picked from, about 250 Hz to 4 kHz.
+BIN_LOW = 16
+BIN_HIGH = 256
+
+# How far around a point (in bins and frames) it must be the loudest to be a peak,
+# and how many of the loudest peaks are kept for each second of audio.
+PEAK_RADIUS_BINS = 10
+PEAK_RADIUS_FRAMES = 8
+PEAKS_PER_SECOND = 30
+
+# Each peak is paired with up to this many of the peaks after it, which are at most
+# this many frames later and bins away.
+FAN_OUT = 5
+TARGET_FRAMES = 63
+TARGET_BINS = 64
+
+# How many pairs need to line up with a song for it to be a match.
+MIN_MATCHES = 10
+
+# Pairs which appear this many times in the library say little about which song
+# they came from, so they are ignored.
+MAX_HASH_HITS = 1000
+
+# Extensions of the files in a library which are indexed.
+EXTENSIONS = (".mp3", ".m4a", ".flac", ".ogg", ".opus", ".wav", ".webm", ".aac")
+
+
+def _max_filter(data: np.ndarray, radius: int, axis: int) -> np.ndarray:
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (radius, radius)
+
+    padded = np.pad(data, pad, constant_values=-np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1, axis)
+
+    return windows.max(axis=-1)
+
+
+def peaks(samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the strongest peaks in the spectrogram of some audio.
+
+    Args:
+        samples (np.ndarray): Mono audio at `SAMPLE_RATE`.
+
+    Returns:
+        The frame and frequency bin of each peak, ordered by frame.
+    """
+    if len(samples) < FRAME_SIZE:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE), axis=1))
+    spectrum = np.log(spectrum[:, BIN_LOW:BIN_HIGH] + 1e-6)
+
+    local_max = _max_filter(spectrum, PEAK_RADIUS_BINS, axis=1)
+    local_max = _max_filter(local_max, PEAK_RADIUS_FRAMES, axis=0)
+
+    times, bins = np.nonzero((spectrum == local_max) & np.isfinite(spectrum))
+    strengths = spectrum[times, bins]
+
+    # Keep the loudest of each second, so quiet passages still have some.
+    frames_per_second = SAMPLE_RATE // HOP_SIZE
+    keep = []
+
+    for second in range(0, len(spectrum), frames_per_second):
+        indices = np.nonzero((times >= second) & (times < second + frames_per_second))
+        indices = indices[0]
+
+        order = np.argsort(strengths[indices])[::-1][:PEAKS_PER_SECOND]
+        keep.append(indices[order])
+
+    keep = np.sort(np.concatenate(keep))
+
+    return times[keep], bins[keep] + BIN_LOW
+
+
+def hashes(times: np.ndarray, bins: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Pair up peaks and hash each pair.
+
+    Args:
+        times (np.ndarray): The frame of each peak, in order.
+        bins (np.ndarray): The frequency bin of each peak.
+
+    Returns:
+        The hash of each pair, and the frame of its first peak.
+    """
+    count = np.zeros(len(times), np.int64)
+    pairs_hash, pairs_time = [], []
+
+    # Peaks are ordered by time, so the ones after each are found by stepping along.
+    for step in range(1, FAN_OUT * 4):
+        first = np.arange(len(times) - step)
+        second = first + step
+
+        frames = times[second] - times[first]
+        valid = (
+            (frames > 0)
+            & (frames <= TARGET_FRAMES)
+            & (np.abs(bins[second] - bins[first]) <= TARGET_BINS)
+            & (count[first] < FAN_OUT)
+        )
+
+        first, second = first[valid], second[valid]
+        count[first] += 1
+
+        pairs_hash.append(bins[first] << 15 | bins[second] << 6 | frames[valid])
+        pairs_time.append(times[first])
+
+    if not pairs_hash:
+        return np.empty(0, np.uint32), np.empty(0, np.uint32)
+
+    return (
+        np.concatenate(pairs_hash).astype(np.uint32),
+        np.concatenate(pairs_time).astype(np.uint32),
+    )
+
+
+def _decode(path: str) -> np.ndarray:
+    data, _ = (
+        ffmpeg.input(path)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+
+    return np.frombuffer(data, dtype="<i2").astype(np.float32)
+
+
+def _read_song(path: str) -> song.Song:
+    tags: Dict[str, str] = {}
+
+    # Songs without tags (or which can't be probed) are named after their file.
+    try:
+        tags = ffmpeg.probe(path).get("format", {}).get("tags", {})
+    except (ffmpeg.Error, OSError):
+        pass
+
+    tags = {key.lower(): value for key, value in tags.items()}
+
+    return song.Song(
+        title=tags.get("title") or os.path.splitext(os.path.basename(path))[0],
+        artist=tags.get("artist") or "Unknown",
+        album=tags.get("album"),
+        album_art=None,
+        label=tags.get("publisher") or tags.get("label"),
+        release_year=(tags.get("date") or "")[:4] or None,
+    )
+
+
+def _index_file(path: str) -> Tuple[song.Song, np.ndarray, np.ndarray]:
+    return _read_song(path), *hashes(*peaks(_decode(path)))
+
+
+class LandmarkIndex:
+    """Pairs of peaks from every song in a library, sorted by their hash.
+
+    Args:
+        songs (list): Each song in the library.
+        pair_hashes (np.ndarray): The hash of each pair.
+        pair_songs (np.ndarray): Which song each pair is from.
+        pair_times (np.ndarray): Which frame of the song each pair starts at.
+    """
+
+    def __init__(
+        self,
+        songs: List[song.Song],
+        pair_hashes: np.ndarray,
+        pair_songs: np.ndarray,
+        pair_times: np.ndarray,
+    ):
+        order = np.argsort(pair_hashes, kind="stable")
+
+        self.songs = songs
+        self.pair_hashes = pair_hashes[order]
+        self.pair_songs = pair_songs[order]
+        self.pair_times = pair_times[order]
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    @classmethod
+    def build(
+        cls, paths: List[str], processes: Optional[int] = None
+    ) -> "LandmarkIndex":
+        """Index the songs at the given paths, a process for each core.
+
+        Files which can't be decoded are skipped.
+        """
+        songs: List[song.Song] = []
+        parts_hash, parts_song, parts_time = [], [], []
+
+        with ProcessPoolExecutor(processes) as executor:
+            for path, future in [
+                (path, executor.submit(_index_file, path)) for path in paths
+            ]:
+                try:
+                    data_song, pair_hashes, pair_times = future.result()
+                except ffmpeg.Error:
+                    log.warning(f"Failed to decode {path}, skipping it")
+                    continue
+
+                parts_hash.append(pair_hashes)
+                parts_song.append(np.full(len(pair_hashes), len(songs), np.uint32))
+                parts_time.append(pair_times)
+                songs.append(data_song)
+
+        if not songs:
+            return cls([], *[np.empty(0, np.uint32)] * 3)
+
+        return cls(
+            songs,
+            np.concatenate(parts_hash),
+            np.concatenate(parts_song),
+            np.concatenate(parts_time),
+        )
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                songs=np.array(json.dumps(self.songs)),
+                pair_hashes=self.pair_hashes,
+                pair_songs=self.pair_songs,
+                pair_times=self.pair_times,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "LandmarkIndex":
+        with np.load(path) as data:
+            return cls(
+                json.loads(str(data["songs"])),
+                data["pair_hashes"],
+                data["pair_songs"],
+                data["pair_times"],
+            )
+
+    def match(self, samples: np.ndarray) -> Optional[Tuple[int, float, int]]:
+        """Find the song that some audio is from.
+
+        Args:
+            samples (np.ndarray): Mono audio at `SAMPLE_RATE`.
+
+        Returns:
+            The index of the song, how far into it the audio starts in seconds, and
+            how many pairs lined up, or None if nothing matched.
+        """
+        query_hashes, query_times = hashes(*peaks(samples))
+
+        left = np.searchsorted(self.pair_hashes, query_hashes, "left")
+        right = np.searchsorted(self.pair_hashes, query_hashes, "right")
+        hits = right - left
+
+        common = hits > MAX_HASH_HITS
+        hits[common] = 0
+
+        if hits.sum() == 0:
+            return
+
+        # Every entry of the index which shares a hash with the audio.
+        starts = np.repeat(left - np.cumsum(hits) + hits, hits)
+        positions = np.arange(hits.sum()) + starts
+
+        offsets = self.pair_times[positions].astype(np.int64) - np.repeat(
+            query_times, hits
+        )
+        keys = self.pair_songs[positions].astype(np.int64) << 32 | (offsets + 2**31)
+
+        values, counts = np.unique(keys, return_counts=True)
+        best = np.argmax(counts)
+
+        if counts[best] < MIN_MATCHES:
+            return
+
+        index = int(values[best] >> 32)
+        offset = int((values[best] & 0xFFFFFFFF) - 2**31) * HOP_SIZE / SAMPLE_RATE
+
+        return index, offset, int(counts[best])
+
+
+def _to_response(data_song: song.Song, index: int, offset: float) -> dict:
+    """Shape a song like a response from Shazam, which `song.create` reads."""
+    metadata = [
+        {"title": title, "text": data_song[key]}
+        for title, key in (
+            ("Album", "album"),
+            ("Label", "label"),
+            ("Released", "release_year"),
+        )
+        if data_song.get(key)
+    ]
+
+    return {
+        "matches": [{"id": str(index), "offset": offset}],
+        "track": {
+            "title": data_song["title"],
+            "subtitle": data_song["artist"],
+            "images": (
+                {"coverart": data_song["album_art"]} if data_song["album_art"] else {}
+            ),
+            "sections": [{"type": "SONG", "metadata": metadata}],
+        },
+    }
+
+
+class LandmarkRecognizer(Recognizer):
+    """Recognizes songs from a local library, which is loaded when first needed.
+
+    Args:
+        index_path (str): Where the library was indexed to.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._index: Optional[LandmarkIndex] = None
+
+    @property
+    def index(self) -> LandmarkIndex:
+        if self._index is None:
+            self._index = LandmarkIndex.load(self.index_path)
+            log.info(f"Loaded {len(self._index)} songs from {self.index_path}")
+
+        return self._index
+
+    def recognize_sync(self, data: bytes) -> dict:
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+        result = self.index.match(samples)
+
+        if result is None:
+            return {"matches": []}
+
+        index, offset, _ = result
+
+        return _to_response(self.index.songs[index], index, offset)
+
+    async def recognize(self, data: bytes) -> dict:
+        return await scheduler.run(scheduler.JobClass.SLICE, self.recognize_sync, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("library", help="folder of songs to index")
+    parser.add_argument("--output", default="data/landmarks.npz")
+    parser.add_argument(
+        "--processes", type=int, default=None, help="defaults to the number of cores"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] [%(name)s] %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.library)
+        for name in names
+        if name.lower().endswith(EXTENSIONS)
+    )
+
+    index = LandmarkIndex.build(paths, args.processes)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    index.save(args.output)
+
+    log.info(f"Indexed {len(index)} songs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Counters and latency histograms for each stage of the bot's work, which can be
+served to Prometheus in its text format.
+
+Recording is a couple of list increments, so it is always on. Everything is
+recorded from the event loop, so there is no locking.
+
+Stages timed by `stage` are `extract`, `cache_get`, `cache_set`, `download`,
+`slice_fetch` (fetching the part of the media a window needs), `slice_wait` (waiting
+for a slot to slice in), `slice`, `fingerprint`, `recognize`, `transcode`, `upload`,
+and `respond`.
+"""
+
+import functools
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Address and port to serve `/metrics` on, or a blank port to not serve them at all.
+# Only reachable from this machine unless the host is changed.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0) or None
+
+# Upper bounds of the histogram buckets, in seconds. Stages range from cache hits
+# taking a millisecond to transcodes taking minutes.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+PREFIX = "mediautility"
+
+T = TypeVar("T")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    """Counts how many observations fall into each bucket, for each combination of
+    labels.
+
+    Args:
+        name (str): Name of the metric, without the prefix.
+        description (str): Shown as the metric's help text.
+        label_names (tuple): Names of the labels each observation is given.
+        buckets (tuple): Upper bounds of the buckets, in ascending order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = BUCKETS,
+    ):
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+
+        # For each combination of labels, the count in each bucket (the last being
+        # everything past the largest bound) and the sum of observations.
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._counts.get(labels)
+
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe how long the block took, in seconds, whether or not it raised."""
+        time_start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - time_start, *labels)
+
+    def count(self, *labels: str) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        for labels, counts in sorted(self._counts.items()):
+            total = 0
+
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                label = _labels(self.label_names, labels, le=str(bound))
+                lines.append(f"{self.name}_bucket{label} {total}")
+
+            label = _labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label} {self._sums[labels]}")
+            lines.append(f"{self.name}_count{label} {total}")
+
+        return lines
+
+
+class Counter:
+    """Counts events, for each combination of labels.
+
+    Args:
+        name (str): Name of the metric, without the prefix or `_total` suffix.
+        description (str): Shown as the metric's help text.
+        label_names (tuple): Names of the labels each event is given.
+    """
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = f"{PREFIX}_{name}_total"
+        self.description = description
+        self.label_names = label_names
+
+        self._counts: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._counts[labels] = self._counts.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._counts.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+
+        for labels, count in sorted(self._counts.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {count}")
+
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time spent in each stage of handling a request.", ("stage",)
+)
+
+COMMAND_SECONDS = Histogram(
+    "command_seconds",
+    "Time taken to handle each command, from when it was received.",
+    ("command", "outcome"),
+)
+
+CACHE_LOOKUPS = Counter(
+    "cache_lookups",
+    "Cache lookups of each kind, and whether they found something, found that "
+    "nothing was there (negative), or missed.",
+    ("kind", "result"),
+)
+
+
+def stage(name: str):
+    """Time a `with` block as one of the stages of handling a request."""
+    return STAGE_SECONDS.time(name)
+
+
+def timed(name: str):
+    """Time each call of a coroutine function as one of the stages of handling a
+    request. See `stage`."""
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs) -> T:
+            with STAGE_SECONDS.time(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def cache_lookup(kind: str, data: Any) -> None:
+    """Count a cache lookup from what it returned: None for a miss, something empty
+    for a negative, and anything else for a hit."""
+    if data is None:
+        result = "miss"
+    elif not data:
+        result = "negative"
+    else:
+        result = "hit"
+
+    CACHE_LOOKUPS.inc(kind, result)
+
+
+def _gauges(name: str, stats: Dict[str, Any]) -> List[str]:
+    """Numeric values of a (possibly nested) dictionary of stats, as untyped
+    metrics named after their keys."""
+    lines = []
+
+    for key, value in stats.items():
+        key = f"{name}_{key}"
+
+        if isinstance(value, dict):
+            lines.extend(_gauges(key, value))
+        elif isinstance(value, (int, float)):
+            lines.append(f"{key} {value}")
+
+    return lines
+
+
+def _collect() -> List[str]:
+    # Imported here, as they record into this module.
+    from . import cache, recognition, scheduler, shazam, store
+
+    stats_scheduler = scheduler.stats()
+    lines = [
+        f"# HELP {PREFIX}_jobs Jobs of each class running, or waiting to.",
+        f"# TYPE {PREFIX}_jobs gauge",
+    ]
+
+    for job_class in scheduler.JobClass:
+        for state in ("running", "queued"):
+            label = _labels(("job_class", "state"), (job_class.value, state))
+            value = stats_scheduler[job_class.value][state]
+            lines.append(f"{PREFIX}_jobs{label} {value}")
+
+    lines.extend(_gauges(f"{PREFIX}_jobs_rejected", stats_scheduler["rejected"]))
+    lines.extend(_gauges(f"{PREFIX}_jobs_cpu", stats_scheduler["cpu"]))
+    lines.extend(_gauges(f"{PREFIX}_cache", cache.stats()))
+    lines.extend(_gauges(f"{PREFIX}_media_store", store.stats()))
+    lines.extend(_gauges(f"{PREFIX}_conversion_store", store.conversion_stats()))
+    lines.extend(_gauges(f"{PREFIX}_shazam", shazam.in_flight_stats()))
+    lines.extend(_gauges(f"{PREFIX}_recognition", recognition.stats()))
+
+    return lines
+
+
+def render() -> str:
+    """Every metric, in Prometheus' text format."""
+    lines = [
+        *STAGE_SECONDS.render(),
+        *COMMAND_SECONDS.render(),
+        *CACHE_LOOKUPS.render(),
+        *_collect(),
+    ]
+
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(
+    host: str = METRICS_HOST, port: Optional[int] = METRICS_PORT
+) -> Optional[web.AppRunner]:
+    """Serve the metrics at `/metrics`, if a port was given.
+
+    Returns:
+        The running server, to be cleaned up when closing, or None.
+    """
+    if port is None:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    log.info(f"Serving metrics on {host}:{port}")
+
+    return runner
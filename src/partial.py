@@ -0,0 +1,560 @@
+"""Fetches only the bytes of a direct media link needed to cut a window out of it,
+rather than letting `ffmpeg` stream (or us download) the whole thing.
+
+Containers with an index (MP4 sample tables or `sidx`, Matroska cues) are written
+to a sparse file, with the headers and window at their original offsets, so that
+`ffmpeg` can seek in it as it would in the original. Ogg pages are found by
+bisection, and MP3 frames by the average bitrate, and written to a smaller file of
+their own. Anything else falls back to estimating where the window is from the
+average bitrate too.
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from tempfile import TemporaryDirectory
+from typing import AsyncIterator, List, Optional, Tuple, TypedDict
+
+import aiofiles
+import aiohttp
+
+from . import containers, downloader
+
+log = logging.getLogger(__name__)
+
+# How much of the start of the file is fetched to find out what it is.
+HEAD_SIZE = 64 * 1024
+
+# How much is fetched at a time while bisecting an Ogg file.
+PROBE_SIZE = 32 * 1024
+
+# Extra audio fetched on either side of the window, in seconds, so that seeking to
+# the nearest keyframe or page never falls outside of it.
+WINDOW_PADDING = 2
+
+# Extra audio fetched on either side when the window is only estimated from the
+# bitrate, as a fraction of the time into the media, and at least in seconds.
+ESTIMATE_PADDING = 0.05
+ESTIMATE_PADDING_MIN = 10
+
+# Elements referred to by the Matroska seek head larger than this aren't fetched,
+# and the window isn't fetched partially at all.
+MATROSKA_ELEMENT_MAX = 1024 * 1024
+
+# How many top-level MP4 boxes are read before giving up on finding the index.
+MP4_BOXES_MAX = 64
+
+# How much of the end of a fragmented MP4 file is fetched, to hold the `mfro` box.
+MP4_TAIL_SIZE = 16
+
+# How many probes are made while bisecting an Ogg file.
+OGG_PROBES_MAX = 16
+
+# The largest an Ogg page can be, in bytes.
+OGG_PAGE_MAX = 65_307
+
+
+class Window(TypedDict):
+    path: str
+    # The time in the media that the start of the file corresponds to.
+    time_offset: float
+    bytes_fetched: int
+
+
+class RangesUnsupportedException(Exception):
+    """The server ignored a range request."""
+
+
+class _RangeFile:
+    """A local copy of a remote file, filled in one range at a time."""
+
+    def __init__(self, link: str, path: str):
+        self.link = link
+        self.path = path
+
+        self.size: int = 0
+        self.bytes_fetched: int = 0
+
+        self._file = None
+        self._fetched: List[Tuple[int, int]] = []
+
+    async def open(self) -> bytes:
+        """Fetch the start of the file and create the local copy.
+
+        Returns:
+            The first `HEAD_SIZE` bytes.
+
+        Raises:
+            RangesUnsupportedException: The server doesn't support range requests.
+        """
+        headers = {"Range": f"bytes=0-{HEAD_SIZE - 1}"}
+
+        async with downloader.get_session().get(self.link, headers=headers) as resp:
+            resp.raise_for_status()
+
+            if resp.status != 206:
+                # Don't let the rest of the file be read to re-use the connection.
+                resp.close()
+                raise RangesUnsupportedException
+
+            _, _, size = resp.headers.get("Content-Range", "").rpartition("/")
+
+            if not size.isdigit():
+                resp.close()
+                raise RangesUnsupportedException
+
+            head = await resp.read()
+
+        self.size = int(size)
+        self.bytes_fetched += len(head)
+
+        self._file = await aiofiles.open(self.path, "wb")
+        await self._file.truncate(self.size)
+
+        await self._write(0, head)
+
+        return head
+
+    async def close(self) -> None:
+        if self._file is not None:
+            await self._file.close()
+
+    async def _write(self, start: int, data: bytes) -> None:
+        await self._file.seek(start)
+        await self._file.write(data)
+
+        self._fetched.append((start, start + len(data)))
+
+    async def read(self, start: int, end: int) -> bytes:
+        """Fetch the bytes from `start` up to `end`, unless they already were, and
+        read them back from the local copy."""
+        start, end = max(0, start), min(end, self.size)
+
+        if start >= end:
+            return b""
+
+        await self.fetch(start, end)
+        await self._file.flush()
+
+        async with aiofiles.open(self.path, "rb") as file:
+            await file.seek(start)
+            return await file.read(end - start)
+
+    async def fetch(self, start: int, end: int) -> None:
+        """Fetch the bytes from `start` up to `end`, skipping any that were already,
+        without reading them back."""
+        start, end = max(0, start), min(end, self.size)
+
+        for fetched_start, fetched_end in sorted(self._fetched):
+            if fetched_end <= start:
+                continue
+
+            if fetched_start >= end:
+                break
+
+            if start < fetched_start:
+                await self._fetch(start, fetched_start)
+
+            start = max(start, fetched_end)
+
+        if start < end:
+            await self._fetch(start, end)
+
+    async def _fetch(self, start: int, end: int) -> None:
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+
+        async with downloader.get_session().get(self.link, headers=headers) as resp:
+            resp.raise_for_status()
+
+            if resp.status != 206:
+                resp.close()
+                raise RangesUnsupportedException
+
+            data = await resp.read()
+
+        self.bytes_fetched += len(data)
+        await self._write(start, data)
+
+
+async def fetch_window(
+    link: str,
+    output_path: str,
+    time_start: float,
+    time_duration: float,
+    duration: Optional[float] = None,
+) -> Optional[Window]:
+    """Fetch the parts of a direct media link needed to cut a window out of it.
+
+    Args:
+        link (str): Where the media is, which must be a direct link to it.
+        output_path (str): Where to save the partial file.
+        time_start (float): Where the window starts, in seconds.
+        time_duration (float): How long the window is, in seconds.
+        duration (float): How long the media is, in seconds, if known. Used to
+            estimate where the window is when the container has no index.
+
+    Returns:
+        The partial file, and the time that the start of it corresponds to, or None
+        if the server or container doesn't allow for fetching only part of it.
+    """
+    file = _RangeFile(link, output_path)
+
+    try:
+        head = await file.open()
+    except RangesUnsupportedException:
+        log.debug(f"Range requests aren't supported for {link}")
+        return
+
+    time_end = time_start + time_duration
+
+    try:
+        # A playlist of the media rather than the media itself (HLS or DASH), which
+        # only `ffmpeg` knows how to follow.
+        if _is_manifest(head):
+            log.debug(f"{link} is a manifest, not the media")
+            return
+
+        if file.size <= HEAD_SIZE:
+            return Window(path=output_path, time_offset=0, bytes_fetched=file.size)
+
+        container = containers.sniff(head)
+        byte_range = None
+
+        if container == "ogg":
+            return await _ogg_window(file, head, time_start, time_end)
+
+        if container == "mpeg" and duration:
+            return await _mpeg_window(file, duration, time_start, time_end)
+
+        if container == "mp4":
+            byte_range = await _mp4_range(file, head, time_start, time_end)
+        elif container == "matroska":
+            byte_range = await _matroska_range(file, head, time_start, time_end)
+
+        if byte_range is None and duration:
+            byte_range = _estimate_range(file.size, duration, time_start, time_end)
+
+        if byte_range is None:
+            log.debug(f"Can't find the window in {link} ({container})")
+            return
+
+        await file.fetch(*byte_range)
+    except RangesUnsupportedException:
+        return
+    finally:
+        await file.close()
+
+    return Window(path=output_path, time_offset=0, bytes_fetched=file.bytes_fetched)
+
+
+def _is_manifest(head: bytes) -> bool:
+    head = head.lstrip()
+
+    if head.startswith(b"<?xml"):
+        head = head[head.find(b"?>") + 2 :].lstrip()
+
+    return head.startswith((b"#EXTM3U", b"<MPD"))
+
+
+def _estimate_range(
+    size: int, duration: float, time_start: float, time_end: float
+) -> Tuple[int, int]:
+    padding = max(ESTIMATE_PADDING_MIN, time_start * ESTIMATE_PADDING)
+    byte_rate = size / duration
+
+    return (
+        int((time_start - padding) * byte_rate),
+        int((time_end + padding) * byte_rate),
+    )
+
+
+async def _mpeg_window(
+    file: _RangeFile, duration: float, time_start: float, time_end: float
+) -> Window:
+    """Write the estimated window to a file of its own, as `ffmpeg` reads MP3 files
+    from the start to seek in them accurately. Frames can be decoded from anywhere
+    in the stream, so the start of the file isn't needed."""
+    range_start, range_end = _estimate_range(file.size, duration, time_start, time_end)
+    range_start = max(0, range_start)
+
+    data = await file.read(range_start, range_end)
+    path = f"{file.path}.raw"
+
+    async with aiofiles.open(path, "wb") as output:
+        await output.write(data)
+
+    return Window(
+        path=path,
+        time_offset=range_start * duration / file.size,
+        bytes_fetched=file.bytes_fetched,
+    )
+
+
+async def _mp4_range(
+    file: _RangeFile, head: bytes, time_start: float, time_end: float
+) -> Optional[Tuple[int, int]]:
+    """Find the window using the sample tables, or the segment index of fragmented
+    files. Every top-level box header up to the index is fetched as well, since
+    `ffmpeg` walks them to find the index itself."""
+    offset = 0
+    moov = sidx = None
+    sidx_end = 0
+
+    for _ in range(MP4_BOXES_MAX):
+        if offset + 8 > file.size:
+            break
+
+        header = await file.read(offset, offset + 16)
+        box = containers.mp4_box(header, 0, file.size - offset)
+
+        if box.size < box.header_size:
+            return
+
+        if box.type == b"moov":
+            moov = await file.read(offset, offset + box.size)
+        elif box.type == b"sidx" and sidx is None:
+            sidx = await file.read(offset, offset + box.size)
+            sidx_end = offset + box.size
+        elif box.type in (b"mdat", b"moof") and moov is not None:
+            break
+
+        offset += box.size
+
+    if moov is None:
+        return
+
+    window_start = max(0, time_start - WINDOW_PADDING)
+    window_end = time_end + WINDOW_PADDING
+
+    if not containers.mp4_is_fragmented(moov):
+        return containers.mp4_sample_range(moov, window_start, window_end)
+
+    if sidx is None:
+        return
+
+    byte_range = containers.mp4_sidx_range(sidx, sidx_end, window_start, window_end)
+
+    # `ffmpeg` reads the size of the `mfra` box at the end of the file, to tell if
+    # the index covers the rest of it. Otherwise it reads every fragment.
+    await file.fetch(file.size - MP4_TAIL_SIZE, file.size)
+
+    return byte_range
+
+
+async def _matroska_range(
+    file: _RangeFile, head: bytes, time_start: float, time_end: float
+) -> Optional[Tuple[int, int]]:
+    """Find the window using the cues. Every other element in the seek head is
+    fetched as well, since `ffmpeg` reads them while opening the file."""
+    data_head = containers.matroska_head(head)
+
+    if data_head is None or containers.MKV_CUES not in data_head.positions:
+        return
+
+    cues = None
+
+    for element_id, position in data_head.positions.items():
+        if element_id == containers.MKV_CLUSTER:
+            continue
+
+        offset = data_head.segment_offset + position
+        element = containers.ebml_element(await file.read(offset, offset + 16))
+
+        if element.size == containers.MKV_UNKNOWN_SIZE:
+            return
+
+        if element.header_size + element.size > MATROSKA_ELEMENT_MAX:
+            return
+
+        data = await file.read(offset, offset + element.header_size + element.size)
+
+        if element_id == containers.MKV_CUES:
+            cues = containers.matroska_cues(data)
+
+    cluster_range = containers.matroska_cluster_range(
+        cues,
+        data_head.timestamp_scale,
+        max(0, time_start - WINDOW_PADDING),
+        time_end + WINDOW_PADDING,
+    )
+
+    if cluster_range is None:
+        return
+
+    # `ffmpeg` reads the first cluster while opening the file.
+    if data_head.first_cluster is not None:
+        offset = data_head.segment_offset + data_head.first_cluster
+        await file.fetch(offset, offset + HEAD_SIZE)
+
+    cluster_start, cluster_end = cluster_range
+
+    return (
+        data_head.segment_offset + cluster_start,
+        file.size if cluster_end is None else data_head.segment_offset + cluster_end,
+    )
+
+
+async def _ogg_probe(
+    file: _RangeFile, stream: containers.OggStream, offset: int, last: bool = False
+) -> Optional[containers.Page]:
+    """The first (or last) page of the stream with a time, starting from `offset`."""
+    probe_size = PROBE_SIZE
+
+    # Pages can be up to 64 KiB, so look further if none fit in the first probe.
+    while True:
+        data = await file.read(offset, offset + probe_size)
+        found = None
+
+        for page in containers.ogg_pages(data):
+            if page.serial == stream.serial and page.granule >= 0:
+                found = page._replace(offset=offset + page.offset)
+
+                if not last:
+                    break
+
+        if found is not None:
+            return found
+
+        if probe_size >= OGG_PAGE_MAX * 2 or offset + probe_size >= file.size:
+            return
+
+        probe_size *= 4
+
+
+async def _ogg_window(
+    file: _RangeFile, head: bytes, time_start: float, time_end: float
+) -> Optional[Window]:
+    """Bisect the pages for the window, then write the codec headers and the pages
+    of the window to a file of their own, as Ogg has no index to seek with."""
+    stream = containers.ogg_stream(head)
+
+    if stream is None:
+        return
+
+    last = await _ogg_probe(file, stream, file.size - PROBE_SIZE, last=True)
+
+    if last is None:
+        return
+
+    window_start = max(0, time_start - WINDOW_PADDING)
+    window_end = time_end + WINDOW_PADDING
+
+    # Pages starting at `low` or before end before the target. Pages starting at
+    # `high` or after end after it, and the first of those ends at `high_end`.
+    low, low_time = stream.header_end, 0.0
+    high, high_time = last.offset, stream.time(last.granule)
+
+    for target in (window_start, window_end):
+        low_target, low_target_time = low, low_time
+        high_target, high_target_time = high, high_time
+        high_end = file.size
+
+        for _ in range(OGG_PROBES_MAX):
+            if high_target - low_target <= PROBE_SIZE or target >= high_target_time:
+                break
+
+            # Close enough, as the window is padded anyway.
+            if target == window_start and target - low_target_time <= WINDOW_PADDING:
+                break
+
+            if target == window_end and high_target_time - target <= WINDOW_PADDING:
+                break
+
+            # Interpolate rather than halve, as the bitrate is usually close to
+            # constant; but never probe right next to the bounds.
+            ratio = (target - low_target_time) / max(
+                high_target_time - low_target_time, 1e-6
+            )
+            ratio = min(max(ratio, 0.05), 0.95)
+
+            offset = low_target + int((high_target - low_target) * ratio)
+            page = await _ogg_probe(file, stream, offset)
+
+            if page is None or page.offset >= high_target:
+                high_target = offset
+                continue
+
+            page_time = stream.time(page.granule)
+
+            if page_time <= target:
+                low_target, low_target_time = page.offset, page_time
+            else:
+                high_target, high_target_time = page.offset, page_time
+                high_end = page.offset + page.size
+
+        if target == window_start:
+            low, low_time = low_target, low_target_time
+        elif target >= high_target_time:
+            high = file.size
+        else:
+            high = high_end
+
+    data = await file.read(low, high)
+    pages = [
+        page for page in containers.ogg_pages(data) if page.serial == stream.serial
+    ]
+
+    # The first page only tells us where its own audio ends, which is where the
+    # audio of the next page starts.
+    if len(pages) < 2:
+        return
+
+    time_offset = stream.time(pages[0].granule) if low > stream.header_end else 0
+
+    path = f"{file.path}.ogg"
+
+    async with aiofiles.open(path, "wb") as output:
+        await output.write(head[: stream.header_end])
+
+        for page in pages[1:] if low > stream.header_end else pages:
+            await output.write(data[page.offset : page.offset + page.size])
+
+    return Window(path=path, time_offset=time_offset, bytes_fetched=file.bytes_fetched)
+
+
+@asynccontextmanager
+async def window(
+    link: str,
+    time_start: float,
+    time_duration: float,
+    duration: Optional[float] = None,
+) -> AsyncIterator[Tuple[str, float]]:
+    """Where `ffmpeg` should read a window of some media from, only fetching the
+    parts of it that are needed when possible.
+
+    Args:
+        link (str): Path or URL of the media.
+        time_start (float): Where the window starts, in seconds.
+        time_duration (float): How long the window is, in seconds.
+        duration (float): How long the media is, in seconds, if known.
+
+    Returns:
+        Where to read the media from, and the time that the start of it corresponds
+        to. This is the link itself, and 0, if it can't be fetched partially.
+    """
+    if not link.startswith(("http://", "https://")):
+        yield link, 0
+        return
+
+    with TemporaryDirectory() as path_temp:
+        data_window = None
+
+        try:
+            data_window = await fetch_window(
+                link,
+                os.path.join(path_temp, "window"),
+                time_start,
+                time_duration,
+                duration,
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+            log.warning(f"Failed to fetch the window of {link}: {exc!r}")
+
+        if data_window is None:
+            yield link, 0
+            return
+
+        log.debug(f"Fetched {data_window['bytes_fetched']} bytes of {link}")
+
+        yield data_window["path"], data_window["time_offset"]
@@ -0,0 +1,601 @@
+"""Client for the song recognition service which paces requests, so that we stay
+under its rate limits and back off together when we don't.
+
+Requests wait for a token from a token bucket and a slot from a concurrency limit
+which grows while requests succeed, and halves whenever the service throttles us or
+fails. Failed requests are retried after a jittered backoff, and after enough
+failures in a row a circuit breaker opens so that callers fail straight away rather
+than queueing behind a service which is down.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import statistics
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+)
+
+import aiohttp
+from shazamio import Shazam
+from shazamio.exceptions import FailedDecodeJson
+from shazamio.interfaces.client import HTTPClientInterface
+from shazamio.utils import validate_json
+
+from . import downloader
+from .conversion import pcm_to_wav
+from .exceptions import RecognitionUnavailableException
+
+log = logging.getLogger(__name__)
+
+# Requests per second which may be sent on average, and how many may be sent at once
+# after being idle. A rate of 0 disables the token bucket.
+RECOGNIZE_RATE = float(os.getenv("RECOGNIZE_RATE", 5))
+RECOGNIZE_BURST = int(os.getenv("RECOGNIZE_BURST", 10))
+
+# Bounds for how many requests may be in flight at once, which adapts between them.
+RECOGNIZE_CONCURRENCY_MIN = int(os.getenv("RECOGNIZE_CONCURRENCY_MIN", 1))
+RECOGNIZE_CONCURRENCY_MAX = int(os.getenv("RECOGNIZE_CONCURRENCY_MAX", 8))
+
+# How many times a failed request is retried, and the bounds of the backoff between
+# attempts, in seconds.
+RECOGNIZE_RETRIES = int(os.getenv("RECOGNIZE_RETRIES", 3))
+RECOGNIZE_BACKOFF_BASE = float(os.getenv("RECOGNIZE_BACKOFF_BASE", 0.5))
+RECOGNIZE_BACKOFF_MAX = float(os.getenv("RECOGNIZE_BACKOFF_MAX", 10))
+
+# How many failures in a row open the circuit breaker, and how long it stays open for
+# before letting a request through to test the service again, in seconds.
+BREAKER_THRESHOLD = int(os.getenv("RECOGNIZE_BREAKER_THRESHOLD", 5))
+BREAKER_RESET = float(os.getenv("RECOGNIZE_BREAKER_RESET", 30))
+
+# Which recognizers to use, separated by `+` to try them in order. Either `shazam`,
+# or `local` for the library indexed by `python3 -m src.landmark`.
+RECOGNIZER = os.getenv("RECOGNIZER", "shazam")
+LANDMARK_INDEX = os.getenv("LANDMARK_INDEX", "data/landmarks.npz")
+
+# How many of the most recent timings are kept for the stats.
+TIMINGS_MAX = 1024
+
+
+class UpstreamException(Exception):
+    """The recognition service responded with an error.
+
+    Args:
+        status (int): The HTTP status of the response.
+        retry_after (float): How long the service asked us to wait, in seconds.
+    """
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"Recognition service responded with {status}")
+
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def is_throttled(self) -> bool:
+        return self.status == 429
+
+
+# Errors which mean the service is struggling, rather than that the request was bad.
+RETRYABLE_ERRORS = (
+    UpstreamException,
+    FailedDecodeJson,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+def _retry_after(resp: aiohttp.ClientResponse) -> Optional[float]:
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return
+
+
+class HTTPClient(HTTPClientInterface):
+    """Sends each request once over the shared session, raising on errors instead of
+    retrying them, so that `RecognitionClient` can pace the retries."""
+
+    async def request(self, method: str, url: str, *args, **kwargs) -> Any:
+        async with downloader.get_session().request(method, url, **kwargs) as resp:
+            if resp.status == 429 or resp.status >= 500:
+                raise UpstreamException(resp.status, _retry_after(resp))
+
+            return await validate_json(resp, *args)
+
+
+class TokenBucket:
+    """Hands out tokens at a steady rate, with room to save up a burst of them.
+
+    Args:
+        rate (float): How many tokens are added each second, 0 for no limit.
+        burst (int): How many tokens can be saved up.
+        clock (Callable): Where to get the current time from, in seconds.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+
+        self._clock = clock
+        self._tokens: float = burst
+        self._updated = clock()
+
+        # Waiters take turns, so that tokens are handed out in order.
+        self._lock = asyncio.Lock()
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def _refill(self) -> None:
+        now = self._clock()
+
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+
+        async with self._lock:
+            self._refill()
+
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+
+            self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for a while, such as when we are asked to wait."""
+        if self.rate <= 0:
+            return
+
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class AdaptiveLimiter:
+    """Limits how many requests are in flight, raising the limit by one for each
+    limit's worth of successes and halving it on failure.
+
+    Args:
+        initial (int): The limit to start with.
+        minimum (int): The lowest the limit may go.
+        maximum (int): The highest the limit may go.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self.limit: float = max(minimum, min(maximum, initial))
+        self.in_flight: int = 0
+
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_failure(self) -> None:
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stops requests to a failing service for a while, then lets one through to see
+    whether it has recovered.
+
+    Args:
+        threshold (int): How many failures in a row open the breaker.
+        reset_timeout (float): How long the breaker stays open for, in seconds.
+        clock (Callable): Where to get the current time from, in seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        reset_timeout: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self._clock = clock
+        self._failures: int = 0
+        self._opened_at: Optional[float] = None
+        self._is_probing: bool = False
+
+        self.opened: int = 0
+
+    @property
+    def state(self) -> BreakerState:
+        if self._opened_at is None:
+            return BreakerState.CLOSED
+
+        if self._clock() - self._opened_at < self.reset_timeout:
+            return BreakerState.OPEN
+
+        return BreakerState.HALF_OPEN
+
+    def check(self) -> bool:
+        """Make sure a request may be sent.
+
+        Returns:
+            Whether the request is testing whether the service has recovered, in
+            which case it must be recorded or released.
+
+        Raises:
+            RecognitionUnavailableException: The breaker is open, or another request
+                is already testing whether the service has recovered.
+        """
+        state = self.state
+
+        if state == BreakerState.OPEN:
+            raise RecognitionUnavailableException
+
+        if state == BreakerState.HALF_OPEN:
+            if self._is_probing:
+                raise RecognitionUnavailableException
+
+            self._is_probing = True
+            return True
+
+        return False
+
+    def release(self) -> None:
+        """Give up on testing the service without a result, such as when the request
+        itself was bad, so that another request may test it instead."""
+        self._is_probing = False
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            log.info("Recognition service recovered, closing the circuit breaker")
+
+        self._failures = 0
+        self._opened_at = None
+        self._is_probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+
+        if self._is_probing or (
+            self._opened_at is None and self._failures >= self.threshold
+        ):
+            log.warning("Recognition service is failing, opening the circuit breaker")
+
+            self._opened_at = self._clock()
+            self._is_probing = False
+            self.opened += 1
+
+
+def _summarize(timings: Deque[float]) -> Dict[str, float]:
+    if not timings:
+        return {"count": 0}
+
+    ordered = sorted(timings)
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+class RecognitionClient:
+    """Sends requests to the recognition service, pacing and retrying them.
+
+    Args:
+        func (Callable): Sends a single request, such as `Shazam.recognize`.
+        rate (float): Requests per second which may be sent on average, 0 for no
+            limit.
+        burst (int): How many requests may be sent at once after being idle.
+        concurrency_min (int): The lowest the concurrency limit may go.
+        concurrency_max (int): The highest the concurrency limit may go, and where it
+            starts.
+        retries (int): How many times a failed request is retried.
+        backoff_base (float): The longest wait before the first retry, in seconds,
+            doubling for each retry after it.
+        backoff_max (float): The longest wait before any retry, in seconds.
+        breaker_threshold (int): How many failures in a row open the circuit
+            breaker.
+        breaker_reset (float): How long the circuit breaker stays open for, in
+            seconds.
+        clock (Callable): Where to get the current time from, in seconds.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[bytes], Awaitable[dict]],
+        rate: float = RECOGNIZE_RATE,
+        burst: int = RECOGNIZE_BURST,
+        concurrency_min: int = RECOGNIZE_CONCURRENCY_MIN,
+        concurrency_max: int = RECOGNIZE_CONCURRENCY_MAX,
+        retries: int = RECOGNIZE_RETRIES,
+        backoff_base: float = RECOGNIZE_BACKOFF_BASE,
+        backoff_max: float = RECOGNIZE_BACKOFF_MAX,
+        breaker_threshold: int = BREAKER_THRESHOLD,
+        breaker_reset: float = BREAKER_RESET,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.func = func
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.limiter = AdaptiveLimiter(
+            concurrency_max, concurrency_min, concurrency_max
+        )
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset, clock)
+
+        self._clock = clock
+
+        self._queue_waits: Deque[float] = deque(maxlen=TIMINGS_MAX)
+        self._latencies: Deque[float] = deque(maxlen=TIMINGS_MAX)
+
+        self.requests: int = 0
+        self.successes: int = 0
+        self.failures: int = 0
+        self.throttled: int = 0
+        self.retried: int = 0
+        self.rejected: int = 0
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter", so that requests which failed together don't retry together.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def _attempt(self, data: bytes) -> dict:
+        try:
+            is_probe = self.breaker.check()
+        except RecognitionUnavailableException:
+            self.rejected += 1
+            raise
+
+        time_queued = self._clock()
+
+        try:
+            async with self.limiter.slot():
+                await self.bucket.acquire()
+
+                # The breaker may have opened while this was queued.
+                if self.breaker.state == BreakerState.OPEN:
+                    self.rejected += 1
+                    raise RecognitionUnavailableException
+
+                time_sent = self._clock()
+                self._queue_waits.append(time_sent - time_queued)
+
+                self.requests += 1
+
+                try:
+                    result = await self.func(data)
+                except RETRYABLE_ERRORS as exc:
+                    self.failures += 1
+
+                    if isinstance(exc, UpstreamException) and exc.is_throttled:
+                        self.throttled += 1
+
+                        if exc.retry_after is not None:
+                            self.bucket.pause(exc.retry_after)
+
+                    self.limiter.on_failure()
+                    self.breaker.record_failure()
+
+                    raise
+                finally:
+                    self._latencies.append(self._clock() - time_sent)
+        except BaseException:
+            if is_probe:
+                self.breaker.release()
+
+            raise
+
+        self.successes += 1
+
+        self.limiter.on_success()
+        self.breaker.record_success()
+
+        return result
+
+    async def recognize(self, data: bytes) -> dict:
+        """Recognize some audio, retrying if the service fails.
+
+        Args:
+            data (bytes): The audio, in any format the service accepts.
+
+        Returns:
+            The response from the service.
+
+        Raises:
+            RecognitionUnavailableException: The service has been failing, and isn't
+                being sent any requests for now.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._attempt(data)
+            except RETRYABLE_ERRORS as exc:
+                if attempt == self.retries:
+                    raise
+
+                log.debug(f"Recognition attempt {attempt + 1} failed: {exc!r}")
+
+            self.retried += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+        raise AssertionError("unreachable")
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for requests to the service, along with how long they waited to
+        be sent and how long the service took to respond, in seconds.
+
+        Returns:
+            The counters, current limits, and timing summaries.
+        """
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "throttled": self.throttled,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "tokens": self.bucket.tokens,
+            "breaker": self.breaker.state.value,
+            "breaker_opened": self.breaker.opened,
+            "queue_wait": _summarize(self._queue_waits),
+            "latency": _summarize(self._latencies),
+        }
+
+
+class Recognizer(ABC):
+    """Something which can recognize songs from audio."""
+
+    @abstractmethod
+    async def recognize(self, data: bytes) -> dict:
+        """Recognize some audio.
+
+        Args:
+            data (bytes): Signed 16-bit little endian mono PCM, at `SAMPLE_RATE`.
+
+        Returns:
+            A response shaped like Shazam's, with a list of `matches` and, if any
+            were found, the `track` they were for.
+        """
+        raise NotImplementedError
+
+
+class ShazamRecognizer(Recognizer):
+    """Recognizes songs with Shazam, through a client which paces the requests."""
+
+    def __init__(self, client: RecognitionClient):
+        self.client = client
+
+    async def recognize(self, data: bytes) -> dict:
+        return await self.client.recognize(pcm_to_wav(data))
+
+
+class TieredRecognizer(Recognizer):
+    """Tries each recognizer in turn, until one of them finds a match.
+
+    Args:
+        tiers (list): The recognizers, cheapest first.
+    """
+
+    def __init__(self, tiers: List[Recognizer]):
+        self.tiers = tiers
+
+    async def recognize(self, data: bytes) -> dict:
+        result: dict = {"matches": []}
+
+        for tier in self.tiers:
+            result = await tier.recognize(data)
+
+            if result.get("matches"):
+                break
+
+        return result
+
+
+_shazam = Shazam(http_client=HTTPClient())
+
+_client = RecognitionClient(_shazam.recognize)
+
+
+def create_recognizer(name: str) -> Recognizer:
+    """Create the recognizers with the given names, tried in order.
+
+    Args:
+        name (str): Recognizers separated by `+`, each either `shazam` or `local`
+            (the library indexed to `LANDMARK_INDEX`).
+
+    Returns:
+        The recognizer, or one trying each of them in turn.
+    """
+    tiers: List[Recognizer] = []
+
+    for tier in name.split("+"):
+        if tier == "shazam":
+            tiers.append(ShazamRecognizer(_client))
+        elif tier == "local":
+            # Imported here, as it depends on this module.
+            from .landmark import LandmarkRecognizer
+
+            tiers.append(LandmarkRecognizer(LANDMARK_INDEX))
+        else:
+            raise ValueError(f"Unknown recognizer {tier!r}")
+
+    return tiers[0] if len(tiers) == 1 else TieredRecognizer(tiers)
+
+
+_recognizer: Optional[Recognizer] = None
+
+
+def get_recognizer() -> Recognizer:
+    """The recognizer used by `recognize`, which is `RECOGNIZER` unless it was
+    replaced with `set_recognizer`."""
+    global _recognizer
+
+    if _recognizer is None:
+        _recognizer = create_recognizer(RECOGNIZER)
+
+    return _recognizer
+
+
+def set_recognizer(recognizer: Optional[Recognizer]) -> None:
+    """Replace the recognizer used by `recognize`, or None to go back to the
+    configured one."""
+    global _recognizer
+    _recognizer = recognizer
+
+
+async def recognize(data: bytes) -> dict:
+    """Recognize some audio with the shared recognizer. See `Recognizer.recognize`."""
+    return await get_recognizer().recognize(data)
+
+
+def stats() -> Dict[str, Any]:
+    """Counters and timings for the shared Shazam client. See
+    `RecognitionClient.stats`."""
+    return _client.stats()
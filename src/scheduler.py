@@ -0,0 +1,297 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .exceptions import SchedulerBusyException
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class JobClass(Enum):
+    EXTRACT = "extract"
+    SLICE = "slice"
+    TRANSCODE = "transcode"
+    RECOGNIZE = "recognize"
+
+
+# When waiting for a CPU slot, jobs with a lower value go first, so that slicing a
+# few seconds of audio never waits behind a long transcode.
+PRIORITIES: Dict[JobClass, int] = {
+    JobClass.EXTRACT: 0,
+    JobClass.RECOGNIZE: 0,
+    JobClass.SLICE: 1,
+    JobClass.TRANSCODE: 2,
+}
+
+# Jobs which keep a CPU core busy, and so share the CPU slots between them.
+CPU_BOUND = (JobClass.SLICE, JobClass.TRANSCODE)
+
+
+class PriorityLimiter:
+    """Limits how many holders there may be at once, like a semaphore, except that
+    waiters with a lower priority value are given a slot first.
+
+    Args:
+        limit (int): How many holders there may be at once.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+
+        self._active: int = 0
+        self._order = itertools.count()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0) -> None:
+        if self._active < self.limit and not self.waiting:
+            self._active += 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # We were handed a slot just as we were cancelled, so pass it on.
+            if future.done() and not future.cancelled():
+                self.release()
+
+            raise
+
+    def release(self) -> None:
+        self._active -= 1
+
+        while self._waiters:
+            *_, future = heapq.heappop(self._waiters)
+
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+                break
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0) -> AsyncIterator[None]:
+        await self.acquire(priority)
+
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Scheduler:
+    """Runs jobs with separate concurrency limits for each class of job, and rejects
+    them straight away once too many are queued.
+
+    Args:
+        limits (dict): How many jobs of each class may run at once.
+        queue_limits (dict): How many jobs of each class may be running or waiting at
+            once, before any more are rejected.
+        cpu_slots (int): How many CPU bound jobs may run at once, across all classes.
+        guild_limit (int): How many commands each guild may have running at once.
+        user_limit (int): How many commands each user may have running at once.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[JobClass, int],
+        queue_limits: Dict[JobClass, int],
+        cpu_slots: int,
+        guild_limit: int = 4,
+        user_limit: int = 2,
+    ):
+        self.limits = limits
+        self.queue_limits = queue_limits
+        self.guild_limit = guild_limit
+        self.user_limit = user_limit
+
+        self._limiters = {
+            job_class: PriorityLimiter(limit) for job_class, limit in limits.items()
+        }
+        self._cpu = PriorityLimiter(cpu_slots)
+
+        # Each class gets its own threads, so that a slow class can't take up the
+        # threads of another.
+        self._executors = {
+            job_class: ThreadPoolExecutor(
+                max_workers=limit, thread_name_prefix=f"job-{job_class.value}"
+            )
+            for job_class, limit in limits.items()
+        }
+
+        self._queued: Counter[JobClass] = Counter()
+        self._guilds: Counter[Hashable] = Counter()
+        self._users: Counter[Hashable] = Counter()
+
+        self.rejected: Counter[str] = Counter()
+
+    def load(self, job_class: JobClass) -> float:
+        """How full the queue of a class of job is, from 0 (idle) to 1 (full)."""
+        return self._queued[job_class] / self.queue_limits[job_class]
+
+    @asynccontextmanager
+    async def slot(self, job_class: JobClass) -> AsyncIterator[None]:
+        """Wait for a slot to run a job of the given class in.
+
+        Raises:
+            SchedulerBusyException: Too many jobs of this class are already queued.
+        """
+        if self._queued[job_class] >= self.queue_limits[job_class]:
+            self.rejected[job_class.value] += 1
+            log.warning(f"Rejected {job_class.value} job, the queue is full")
+
+            raise SchedulerBusyException
+
+        priority = PRIORITIES[job_class]
+        self._queued[job_class] += 1
+
+        try:
+            async with self._limiters[job_class].slot(priority):
+                if job_class in CPU_BOUND:
+                    async with self._cpu.slot(priority):
+                        yield
+                else:
+                    yield
+        finally:
+            self._queued[job_class] -= 1
+
+    async def run(self, job_class: JobClass, func: Callable[..., T], *args) -> T:
+        """Run a blocking function in the threads of the given class of job.
+
+        Raises:
+            SchedulerBusyException: Too many jobs of this class are already queued.
+        """
+        loop = asyncio.get_event_loop()
+
+        async with self.slot(job_class):
+            return await loop.run_in_executor(
+                self._executors[job_class], functools.partial(func, *args)
+            )
+
+    @asynccontextmanager
+    async def admit(
+        self, guild_id: Optional[int], user_id: Optional[int]
+    ) -> AsyncIterator[None]:
+        """Admit a command from a guild and user, if neither are over their limits.
+
+        Raises:
+            SchedulerBusyException: The guild or user has too many commands running.
+        """
+        if guild_id is not None and self._guilds[guild_id] >= self.guild_limit:
+            self.rejected["guild"] += 1
+            raise SchedulerBusyException
+
+        if user_id is not None and self._users[user_id] >= self.user_limit:
+            self.rejected["user"] += 1
+            raise SchedulerBusyException
+
+        self._guilds[guild_id] += 1
+        self._users[user_id] += 1
+
+        try:
+            yield
+        finally:
+            self._guilds[guild_id] -= 1
+            self._users[user_id] -= 1
+
+            if self._guilds[guild_id] <= 0:
+                del self._guilds[guild_id]
+
+            if self._users[user_id] <= 0:
+                del self._users[user_id]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        stats = {
+            job_class.value: {
+                "running": limiter.active,
+                "queued": self._queued[job_class],
+            }
+            for job_class, limiter in self._limiters.items()
+        }
+
+        stats["cpu"] = {"running": self._cpu.active, "waiting": self._cpu.waiting}
+        stats["rejected"] = dict(self.rejected)
+
+        return stats
+
+
+def _limit_from_env(job_class: JobClass, prefix: str, default: int) -> int:
+    return int(os.getenv(f"{prefix}_{job_class.value.upper()}", default))
+
+
+_scheduler = Scheduler(
+    limits={
+        JobClass.EXTRACT: _limit_from_env(JobClass.EXTRACT, "JOBS", 4),
+        JobClass.SLICE: _limit_from_env(JobClass.SLICE, "JOBS", 4),
+        JobClass.TRANSCODE: _limit_from_env(JobClass.TRANSCODE, "JOBS", 2),
+        JobClass.RECOGNIZE: _limit_from_env(JobClass.RECOGNIZE, "JOBS", 4),
+    },
+    queue_limits={
+        JobClass.EXTRACT: _limit_from_env(JobClass.EXTRACT, "JOBS_QUEUE", 32),
+        JobClass.SLICE: _limit_from_env(JobClass.SLICE, "JOBS_QUEUE", 32),
+        JobClass.TRANSCODE: _limit_from_env(JobClass.TRANSCODE, "JOBS_QUEUE", 8),
+        JobClass.RECOGNIZE: _limit_from_env(JobClass.RECOGNIZE, "JOBS_QUEUE", 32),
+    },
+    cpu_slots=int(os.getenv("JOBS_CPU", os.cpu_count() or 1)),
+    guild_limit=int(os.getenv("JOBS_PER_GUILD", 4)),
+    user_limit=int(os.getenv("JOBS_PER_USER", 2)),
+)
+
+
+def slot(job_class: JobClass):
+    """Wait for a slot to run a job of the given class in, using the shared
+    scheduler. See `Scheduler.slot`."""
+    return _scheduler.slot(job_class)
+
+
+async def run(job_class: JobClass, func: Callable[..., T], *args) -> T:
+    """Run a blocking function as a job of the given class, using the shared
+    scheduler. See `Scheduler.run`."""
+    return await _scheduler.run(job_class, func, *args)
+
+
+def admit(guild_id: Optional[int], user_id: Optional[int]):
+    """Admit a command from a guild and user, using the shared scheduler. See
+    `Scheduler.admit`."""
+    return _scheduler.admit(guild_id, user_id)
+
+
+def load(job_class: JobClass) -> float:
+    return _scheduler.load(job_class)
+
+
+def limit(job_class: JobClass) -> int:
+    """How many jobs of a class may run at once in the shared scheduler."""
+    return _scheduler.limits[job_class]
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return _scheduler.stats()
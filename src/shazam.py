@@ -1,43 +1,66 @@
 import asyncio
-import mimetypes
 import os
+from contextlib import AsyncExitStack, asynccontextmanager
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypedDict,
+)
 import logging
 
-import aiofiles
 import aiohttp
-import ffmpeg
-from shazamio import Shazam
 from yt_dlp import YoutubeDL
 
-from . import cache
+from . import (
+    cache,
+    conversion,
+    downloader,
+    fingerprint,
+    metrics,
+    partial,
+    recognition,
+    scheduler,
+)
 from .api import song
-from .exceptions import InvalidLinkException
-from .utility import timestamp_from_extractor, uri_validator
+from .exceptions import InvalidLinkException, RecognitionUnavailableException
+from .singleflight import SingleFlight
+from .utility import normalize_url, timestamp_from_extractor, uri_validator
 
-_shazam = Shazam()
+# Coalesces concurrent `find_song` calls for the same media.
+_in_flight = SingleFlight()
 
 log = logging.getLogger(__name__)
 
+# How many of each stage of `find_songs` may run at the same time by default.
+BULK_EXTRACT_CONCURRENCY = 8
+BULK_SLICE_CONCURRENCY = 4
+BULK_RECOGNIZE_CONCURRENCY = 4
 
-async def download_file(link: str, output_path: str) -> None:
+
+async def download_file(link: str, output_path: str) -> str:
     """Downloads a file from a URL to the given path.
 
     Args:
         link (str): Where to download the media from. In this case it will be downloaded
             directly.
+        output_path (str): Where to save the file to. An `{ext}` placeholder is
+            replaced with the extension matching the file's content type.
 
     Returns:
-        None.
+        Where the file was saved to.
+
+    Raises:
+        DownloadTooLargeException: The file is larger than `DOWNLOAD_MAX_SIZE`.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(link) as resp:
-            mime = resp.headers.get("Content-Type", "audio/mp3")
-            path = output_path.format(ext=mimetypes.guess_extension(mime))
+    with metrics.stage("download"):
+        data_download = await downloader.download(link, output_path)
 
-            async with aiofiles.open(path, "wb") as file:
-                await file.write(await resp.content.read())
+    return data_download["path"]
 
 
 async def download_media(
@@ -46,6 +69,7 @@ async def download_media(
     file_format: Optional[str] = None,
     playlist_index: int = 1,
     should_download: bool = True,
+    use_cache: bool = True,
 ) -> Optional[dict]:
     """Downloads a given piece of media to a path. If no YoutubeDL information is found,
         it is downloaded directly instead.
@@ -63,11 +87,20 @@ async def download_media(
             videos or pictures), which one should be downloaded.
         should_download (bool): Whether the file should be downloaded alongside getting
             the JSON data.
+        use_cache (bool): Whether previously extracted data may be used when the file
+            is not being downloaded. Only a subset of the fields is cached.
 
     Returns:
         Any JSON data that YoutubeDL is able to find, can also be None.
     """
-    loop = asyncio.get_event_loop()
+    use_cache = use_cache and not should_download
+
+    if use_cache:
+        data_cached = await cache.get_extract_info(link, playlist_index, file_format)
+
+        if data_cached is not None:
+            return data_cached
+
     opts = {
         "quiet": True,
         "outtmpl": output_path,
@@ -77,18 +110,108 @@ async def download_media(
     if file_format:
         opts["format"] = file_format
 
-    with YoutubeDL(opts) as dl:
-        data = await loop.run_in_executor(
-            None, lambda: dl.extract_info(link, download=should_download)
+    # Downloading extracts the information too, but takes far longer.
+    stage = "download" if should_download else "extract"
+
+    with YoutubeDL(opts) as dl, metrics.stage(stage):
+        data = await scheduler.run(
+            scheduler.JobClass.EXTRACT,
+            lambda: dl.extract_info(link, download=should_download),
         )
 
-        if data is None:
-            return
+    if data is None:
+        return
+
+    if data.get("entries"):
+        data = data["entries"][0]
+
+    if use_cache:
+        await cache.set_extract_info(link, data, playlist_index, file_format)
+
+    return data
 
-        if data.get("entries"):
-            return data["entries"][0]
 
-        return data
+def _is_direct(data_format: dict) -> bool:
+    """Whether a format is a single file which can be fetched over HTTP, rather than
+    a stream of fragments (e.g., HLS or DASH)."""
+    return bool(data_format.get("url")) and data_format.get("protocol") in (
+        "http",
+        "https",
+    )
+
+
+async def download_media_segmented(
+    link: str, output_path: str, playlist_index: int = 1
+) -> Optional[dict]:
+    """Downloads a given piece of media to a path like `download_media`, except that
+    direct links are downloaded a few ranges at a time over separate connections,
+    and separate video and audio (e.g., Reddit's) are downloaded at the same time
+    and then joined without re-encoding.
+
+    Anything else, or anything the CDN won't let us download ourselves, is
+    downloaded by YoutubeDL instead.
+
+    Args:
+        link (str): Where to download the media from.
+        output_path (str): Where to save the file to.
+        playlist_index (int): For playlists, which one should be downloaded.
+
+    Returns:
+        Any JSON data that YoutubeDL is able to find, can also be None.
+
+    Raises:
+        DownloadTooLargeException: The media is larger than `DOWNLOAD_MAX_SIZE`.
+    """
+    data = await download_media(
+        link, playlist_index=playlist_index, should_download=False, use_cache=False
+    )
+
+    if data is None:
+        return
+
+    data_formats = data.get("requested_formats") or [data]
+
+    if not all(map(_is_direct, data_formats)):
+        return await download_media(
+            link, output_path=output_path, playlist_index=playlist_index
+        )
+
+    try:
+        with metrics.stage("download"):
+            if len(data_formats) == 1:
+                await downloader.download_segmented(
+                    data_formats[0]["url"],
+                    output_path,
+                    headers=data_formats[0].get("http_headers"),
+                )
+                return data
+
+            with TemporaryDirectory() as path_temp:
+                paths = [
+                    os.path.join(path_temp, f"{index}.{data_format.get('ext', 'mp4')}")
+                    for index, data_format in enumerate(data_formats)
+                ]
+
+                await asyncio.gather(
+                    *[
+                        downloader.download_segmented(
+                            data_format["url"],
+                            path,
+                            headers=data_format.get("http_headers"),
+                        )
+                        for data_format, path in zip(data_formats, paths)
+                    ]
+                )
+
+                await conversion.mux(paths, output_path)
+    except aiohttp.ClientError as exc:
+        log.warning(f"Couldn't download {link} ourselves, using YoutubeDL: {exc!r}")
+
+        return await download_media(
+            link, output_path=output_path, playlist_index=playlist_index
+        )
+
+    return data
 
 
 async def find_song(
@@ -100,6 +223,9 @@ async def find_song(
 ) -> Optional[song.Song]:
     """Try to find a song from the given media.
 
+    Concurrent calls for the same media and timestamp are coalesced, so only one of
+    them actually downloads and recognizes the audio.
+
     Args:
         link (str): Where to download the media from. Can generally be any social media
             or direct media link.
@@ -118,76 +244,555 @@ async def find_song(
     if not uri_validator(link):
         raise InvalidLinkException
 
-    loop = asyncio.get_event_loop()
+    # While the media is still being extracted we don't know its ID yet, so the best
+    # we can do is coalesce on the link itself.
+    key_link = (
+        "link",
+        normalize_url(link),
+        time_start,
+        time_duration,
+        playlist_index,
+        use_cache,
+    )
+
+    return await _in_flight.run(
+        key_link,
+        lambda: _find_song(link, time_start, time_duration, playlist_index, use_cache),
+    )
+
+
+async def _find_song(
+    link: str,
+    time_start: Optional[int],
+    time_duration: int,
+    playlist_index: int,
+    use_cache: bool,
+) -> Optional[song.Song]:
+    data_media = await download_media(
+        link,
+        file_format="worstaudio/worst",
+        playlist_index=playlist_index,
+        should_download=False,
+        use_cache=use_cache,
+    )
+
+    time_start = _resolve_time_start(link, data_media, time_start)
+
+    # Check for existing cache in Redis.
+    if data_media and use_cache:
+        maybe_song = await cache.get_from_info(data_media, time_start, time_duration)
+
+        if maybe_song is not None:
+            if len(maybe_song.keys()) == 0:
+                return
+
+            return maybe_song
+
+    async def _recognize():
+        async with _media_source(link, data_media, playlist_index) as source:
+            return await _recognize_window(
+                source, data_media, time_start, time_duration, use_cache
+            )
+
+    if data_media is None:
+        return await _recognize()
+
+    # Different links (e.g., short and long YouTube links) can point to the same
+    # media, which we only know about once it has been extracted.
+    return await _in_flight.run(
+        _media_key(data_media, time_start, time_duration), _recognize
+    )
+
+
+def _resolve_time_start(
+    link: str, data_media: Optional[dict], time_start: Optional[int]
+) -> int:
+    # Some extractors have a `&t=` query parameter to denote the timestamp.
+    # If we're not provided an explicit timestamp, try to get it from here
+    # instead.
+    if data_media and time_start is None:
+        time_start = timestamp_from_extractor(link, data_media["extractor_key"])
+
+    # Fallback value if we don't find anything from the extractor.
+    if time_start is None:
+        time_start = 0
+
+    return time_start
+
+
+def _media_key(data_media: dict, time_start: int, time_duration: int) -> tuple:
+    return (data_media["extractor_key"], data_media["id"], time_start, time_duration)
+
+
+@asynccontextmanager
+async def _media_source(
+    link: str, data_media: Optional[dict], playlist_index: int
+) -> AsyncIterator[str]:
+    """Where `ffmpeg` should read the media from, downloading it first if needed."""
+
+    # Some services don't allow chunked downloads as required later by the
+    # `ss` argument of the `ffmpeg` command.
+    should_download = "tiktok" in link
+
+    if not should_download:
+        yield data_media["url"] if data_media else link
+        return
 
     with TemporaryDirectory() as path_temp:
-        # Download the file to the temporary path.
-        data_media = await download_media(
+        path_audio_input = os.path.join(path_temp, "input.ogg")
+
+        await download_media(
             link,
+            output_path=path_audio_input,
             file_format="worstaudio/worst",
             playlist_index=playlist_index,
-            should_download=False,
         )
 
-        # Some extractors have a `&t=` query parameter to denote the timestamp.
-        # If we're not provided an explicit timestamp, try to get it from here
-        # instead.
-        if data_media and time_start is None:
-            time_start = timestamp_from_extractor(link, data_media["extractor_key"])
+        yield path_audio_input
+
+
+async def _recognize_window(
+    source: str,
+    data_media: Optional[dict],
+    time_start: int,
+    time_duration: int,
+    use_cache: bool,
+) -> Optional[song.Song]:
+    data_audio = await _slice_window(source, data_media, time_start, time_duration)
+
+    # Started past the end of the media.
+    if not data_audio:
+        return
+
+    return await _recognize_audio(
+        data_audio, data_media, time_start, time_duration, use_cache
+    )
+
+
+async def _slice_window(
+    source: str,
+    data_media: Optional[dict],
+    time_start: int,
+    time_duration: int,
+) -> bytes:
+    duration = data_media.get("duration") if data_media else None
+
+    # Fetching, waiting for a slot, and slicing are timed apart, so that a slow
+    # host or a busy scheduler doesn't look like slow slicing.
+    async with AsyncExitStack() as stack:
+        source_window, time_offset = source, 0
+
+        # Only fetch the parts of the media that the window needs, where possible.
+        # Streams of fragments (e.g., HLS or DASH) are left for `ffmpeg` to follow.
+        if data_media is None or _is_direct(data_media):
+            with metrics.stage("slice_fetch"):
+                source_window, time_offset = await stack.enter_async_context(
+                    partial.window(source, time_start, time_duration, duration)
+                )
+
+        with metrics.stage("slice_wait"):
+            await stack.enter_async_context(scheduler.slot(scheduler.JobClass.SLICE))
+
+        with metrics.stage("slice"):
+            return await conversion.audio_slice(
+                source_window, time_start - time_offset, time_duration
+            )
+
+
+async def _recognize_audio(
+    data_audio: bytes,
+    data_media: Optional[dict],
+    time_start: int,
+    time_duration: int,
+    use_cache: bool,
+) -> Optional[song.Song]:
+    data_fingerprint = None
+
+    # The same audio may have been recognized before, uploaded somewhere else.
+    if use_cache:
+        with metrics.stage("fingerprint"):
+            data_fingerprint = await scheduler.run(
+                scheduler.JobClass.SLICE, fingerprint.compute, data_audio
+            )
+
+    if data_fingerprint is not None:
+        data_song = await cache.get_from_fingerprint(data_fingerprint)
+
+        if data_song is not None:
+            if data_media is not None:
+                await cache.set_song_from_info(
+                    data_media, data_song, time_start, time_duration
+                )
+
+            return data_song
+
+    with metrics.stage("recognize"):
+        async with scheduler.slot(scheduler.JobClass.RECOGNIZE):
+            data_shazam = await recognition.recognize(data_audio)
+
+    if data_media and use_cache and len(data_shazam["matches"]) == 0:
+        await cache.set_empty_from_info(data_media, time_start, time_duration)
+        return
+
+    data_song = song.create(data_shazam)
+
+    if use_cache and data_media is not None:
+        # How far into the song the window was, so that the rest of the song before
+        # it is cached too.
+        song_offset = data_shazam["matches"][0].get("offset", 0)
+
+        await cache.set_song_from_info(
+            data_media, data_song, time_start, time_duration, song_offset
+        )
+
+    if data_fingerprint is not None and data_song is not None:
+        await cache.set_fingerprint(data_fingerprint, data_song)
+
+    return data_song
+
+
+async def scan_songs(
+    link: str,
+    time_start: int = 0,
+    window_count: int = 8,
+    window_stride: int = 60,
+    time_duration: int = 15,
+    concurrency: int = 3,
+    playlist_index: int = 1,
+    use_cache: bool = True,
+) -> List[Tuple[int, song.Song]]:
+    """Try to find every song in a long piece of media, such as a mix.
+
+    The media is only extracted once, after which windows are cut from it at regular
+    intervals and recognized concurrently. Each window is cached the same way as
+    `find_song`, so looking up any of them afterwards is free.
+
+    Args:
+        link (str): Where to download the media from. Can generally be any social media
+            or direct media link.
+        time_start (int): Where the first window starts, in seconds.
+        window_count (int): How many windows to scan.
+        window_stride (int): How far apart the start of each window is, in seconds.
+        time_duration (int): How long each sample sent to Shazam should be, in seconds.
+        concurrency (int): How many windows may be recognized at the same time.
+        playlist_index (int): For playlists (such as Instagram posts with multiple
+            videos or pictures), which one should be downloaded.
+        use_cache (bool): Whether we should look in the cache for previous searches,
+            provided the same extractor, ID, and start time.
+
+    Returns:
+        Each song that was found along with the time it was first found at, in order.
+
+    Raises:
+        InvalidLinkException: The link isn't a valid URI.
+        RecognitionUnavailableException: Nothing was found, as recognition wasn't
+            available for any of the windows that weren't cached.
+    """
+    log.info(f"Scanning link: {link}")
+
+    if not uri_validator(link):
+        raise InvalidLinkException
+
+    data_media = await download_media(
+        link,
+        file_format="worstaudio/worst",
+        playlist_index=playlist_index,
+        should_download=False,
+        use_cache=use_cache,
+    )
 
-        # Fallback value if we don't find anything from the extractor.
-        if time_start is None:
-            time_start = 0
+    windows = [time_start + index * window_stride for index in range(window_count)]
 
-        # Check for existing cache in Redis.
-        if data_media and use_cache:
-            maybe_song = await cache.get_from_info(data_media, time_start)
+    if data_media and data_media.get("duration"):
+        windows = [window for window in windows if window < data_media["duration"]]
 
+    results: Dict[int, Optional[song.Song]] = {}
+
+    if data_media and use_cache:
+        maybe_songs = await cache.get_many_from_info(data_media, windows, time_duration)
+
+        for window, maybe_song in zip(windows, maybe_songs):
             if maybe_song is not None:
-                if len(maybe_song.keys()) == 0:
-                    return
+                results[window] = maybe_song or None
 
-                return maybe_song
+    windows_pending = [window for window in windows if window not in results]
 
-        path_audio_input = os.path.join(path_temp, "input.ogg")
-        path_audio_output = os.path.join(path_temp, "output.ogg")
+    if windows_pending:
+        semaphore = asyncio.Semaphore(concurrency)
 
-        # Some services don't allow chunked downloads as required later by the
-        # `ss` argument of the `ffmpeg` command.
-        should_download = "tiktok" in link
+        async with _media_source(link, data_media, playlist_index) as source:
 
-        if should_download:
-            await download_media(
-                link,
-                output_path=path_audio_input,
-                file_format="worstaudio/worst",
-                playlist_index=playlist_index,
+            async def _scan_window(window: int) -> Optional[song.Song]:
+                async with semaphore:
+
+                    def _recognize():
+                        return _recognize_window(
+                            source, data_media, window, time_duration, use_cache
+                        )
+
+                    if data_media is None:
+                        return await _recognize()
+
+                    return await _in_flight.run(
+                        _media_key(data_media, window, time_duration), _recognize
+                    )
+
+            found = await asyncio.gather(
+                *[_scan_window(window) for window in windows_pending],
+                return_exceptions=True,
+            )
+
+        for window, result in zip(windows_pending, found):
+            if isinstance(result, Exception):
+                log.warning(f"Failed to scan window at {window}s: {result!r}")
+                result = None
+
+            results[window] = result
+
+        # Otherwise it would look like there were no songs to find.
+        if not any(results.values()) and all(
+            isinstance(result, RecognitionUnavailableException) for result in found
+        ):
+            raise RecognitionUnavailableException
+
+    return _dedupe_tracklist(sorted(results.items()))
+
+
+class BulkResult(TypedDict):
+    index: int
+    link: str
+    time_start: Optional[int]
+    song: Optional[song.Song]
+    error: Optional[str]
+
+
+class _BulkJob:
+    """A link working its way through the stages of `find_songs`."""
+
+    def __init__(
+        self, index: int, link: str, time_start: Optional[int], playlist_index: int
+    ):
+        self.index = index
+        self.link = link
+        self.time_start = time_start
+        self.playlist_index = playlist_index
+
+        self.data_media: Optional[dict] = None
+        self.data_audio: bytes = b""
+
+    @property
+    def key(self) -> tuple:
+        """Jobs with the same key are for the same window of the same media."""
+        if self.data_media is None:
+            return ("link", normalize_url(self.link), self.time_start)
+
+        return (
+            self.data_media["extractor_key"],
+            self.data_media["id"],
+            self.time_start,
+        )
+
+
+async def find_songs(
+    requests: Iterable[Tuple[str, Optional[int], int]],
+    time_duration: int = 15,
+    extract_concurrency: int = BULK_EXTRACT_CONCURRENCY,
+    slice_concurrency: int = BULK_SLICE_CONCURRENCY,
+    recognize_concurrency: int = BULK_RECOGNIZE_CONCURRENCY,
+    use_cache: bool = True,
+) -> AsyncIterator[BulkResult]:
+    """Try to find songs for many links at once.
+
+    Anything already cached is looked up in one go up front. The rest is extracted,
+    sliced, and recognized in separate stages, each with their own concurrency, so
+    that audio which is ready to be recognized never waits behind slow extractions.
+    Links which turn out to be the same media are only recognized once.
+
+    Args:
+        requests (Iterable): Each link, with the time at which we should search for a
+            song at (or None to use the link's own), and which item of a playlist
+            should be used.
+        time_duration (int): How long each sample sent to Shazam should be, in seconds.
+        extract_concurrency (int): How many links may be extracted at the same time.
+        slice_concurrency (int): How many windows may be sliced at the same time.
+        recognize_concurrency (int): How many windows may be recognized at the same
+            time.
+        use_cache (bool): Whether we should look in the cache for previous searches,
+            provided the same extractor, ID, and start time.
+
+    Yields:
+        The result for each link, in the order they finish.
+    """
+    jobs = [
+        _BulkJob(index, link, time_start, playlist_index)
+        for index, (link, time_start, playlist_index) in enumerate(requests)
+    ]
+
+    results: asyncio.Queue[BulkResult] = asyncio.Queue()
+
+    def _finish(
+        jobs_done: List[_BulkJob],
+        data_song: Optional[song.Song] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        for job in jobs_done:
+            results.put_nowait(
+                BulkResult(
+                    index=job.index,
+                    link=job.link,
+                    time_start=job.time_start,
+                    song=data_song or None,
+                    error=error,
+                )
             )
+
+    jobs_pending = []
+
+    for job in jobs:
+        if uri_validator(job.link):
+            jobs_pending.append(job)
         else:
-            path_audio_input = data_media["url"] if data_media else link
+            _finish([job], error="invalid link")
 
-        def _download_media():
-            cmd = ffmpeg.input(
-                filename=path_audio_input,
-                ss=(str(time_start)),
-                t=time_duration,
-            ).output(path_audio_output, vn=None)
-            
-            log.debug(" ".join(cmd.compile()))
+    if use_cache and jobs_pending:
+        data_medias = await cache.get_many_extract_info(
+            [(job.link, job.playlist_index, "worstaudio/worst") for job in jobs_pending]
+        )
 
-            cmd.run(quiet=True)
+        for job, data_media in zip(jobs_pending, data_medias):
+            job.data_media = data_media
+
+            if data_media is not None:
+                job.time_start = _resolve_time_start(
+                    job.link, data_media, job.time_start
+                )
+
+        jobs_extracted = [job for job in jobs_pending if job.data_media is not None]
+        maybe_songs = await cache.get_songs(
+            [(job.data_media, job.time_start) for job in jobs_extracted],
+            time_duration,
+        )
+
+        for job, maybe_song in zip(jobs_extracted, maybe_songs):
+            if maybe_song is not None:
+                _finish([job], maybe_song)
+                jobs_pending.remove(job)
 
-        await loop.run_in_executor(None, lambda: _download_media())
+    # Jobs for the same media wait on whichever of them got there first.
+    jobs_waiting: Dict[tuple, List[_BulkJob]] = {}
 
-        data_shazam = await _shazam.recognize(path_audio_output)
+    queue_extract: asyncio.Queue[_BulkJob] = asyncio.Queue()
+    queue_slice: asyncio.Queue[_BulkJob] = asyncio.Queue(slice_concurrency * 2)
+    queue_recognize: asyncio.Queue[_BulkJob] = asyncio.Queue(recognize_concurrency * 2)
 
-        if data_media and use_cache and len(data_shazam["matches"]) == 0:
-            await cache.set_empty_from_info(data_media, time_start)
+    async def _extract(job: _BulkJob) -> None:
+        if job.data_media is None:
+            job.data_media = await download_media(
+                job.link,
+                file_format="worstaudio/worst",
+                playlist_index=job.playlist_index,
+                should_download=False,
+                use_cache=use_cache,
+            )
+            job.time_start = _resolve_time_start(
+                job.link, job.data_media, job.time_start
+            )
+
+            if job.data_media and use_cache:
+                maybe_song = await cache.get_from_info(
+                    job.data_media, job.time_start, time_duration
+                )
+
+                if maybe_song is not None:
+                    return _finish([job], maybe_song)
+
+        if job.key in jobs_waiting:
+            jobs_waiting[job.key].append(job)
             return
 
-        data_song = song.create(data_shazam)
+        jobs_waiting[job.key] = [job]
+        await queue_slice.put(job)
+
+    async def _slice(job: _BulkJob) -> None:
+        async with _media_source(job.link, job.data_media, job.playlist_index) as src:
+            job.data_audio = await _slice_window(
+                src, job.data_media, job.time_start, time_duration
+            )
 
-        if use_cache and data_media is not None:
-            await cache.set_from_info(data_media, data_shazam, time_start)
+        # Started past the end of the media.
+        if not job.data_audio:
+            return _finish(jobs_waiting.pop(job.key))
 
-        return data_song
+        await queue_recognize.put(job)
+
+    async def _recognize(job: _BulkJob) -> None:
+        data_song = await _recognize_audio(
+            job.data_audio, job.data_media, job.time_start, time_duration, use_cache
+        )
+        _finish(jobs_waiting.pop(job.key), data_song)
+
+    async def _worker(queue: asyncio.Queue, stage) -> None:
+        while True:
+            job = await queue.get()
+
+            try:
+                await stage(job)
+            except Exception as exc:
+                log.warning(f"Failed to find a song for {job.link}: {exc!r}")
+
+                _finish(jobs_waiting.pop(job.key, [job]), error=repr(exc))
+
+    for job in jobs_pending:
+        queue_extract.put_nowait(job)
+
+    workers = [
+        asyncio.ensure_future(_worker(queue, stage))
+        for queue, stage, concurrency in (
+            (queue_extract, _extract, extract_concurrency),
+            (queue_slice, _slice, slice_concurrency),
+            (queue_recognize, _recognize, recognize_concurrency),
+        )
+        for _ in range(concurrency)
+    ]
+
+    try:
+        for _ in range(len(jobs)):
+            yield await results.get()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def _dedupe_tracklist(
+    windows: List[Tuple[int, Optional[song.Song]]]
+) -> List[Tuple[int, song.Song]]:
+    """Collapse windows that found the same song as the last one into one entry."""
+    tracklist: List[Tuple[int, song.Song]] = []
+
+    for window, data_song in windows:
+        if not data_song:
+            continue
+
+        if tracklist:
+            _, data_song_last = tracklist[-1]
+
+            if (data_song["title"], data_song["artist"]) == (
+                data_song_last["title"],
+                data_song_last["artist"],
+            ):
+                continue
+
+        tracklist.append((window, data_song))
+
+    return tracklist
+
+
+def in_flight_stats() -> dict:
+    """How many `find_song` calls are running, and how many were coalesced.
+
+    Returns:
+        The number of distinct calls in flight, and coalesced calls since startup.
+    """
+    return _in_flight.stats()
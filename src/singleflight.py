@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single piece of work.
+
+    The first caller for a key starts the work as its own task, and anybody else
+    asking for the same key while it is still running awaits that task instead of
+    starting another. Once the task finishes the key is forgotten, so later calls
+    will run the work again (or, more likely, hit the cache it populated).
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+        # How many calls were served by work that somebody else started.
+        self.coalesced: int = 0
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Run `func`, or wait for an identical call that is already running.
+
+        Args:
+            key (Hashable): Identifies the work; calls with equal keys are coalesced.
+            func (Callable): Creates the coroutine doing the actual work. Only called
+                if nothing is in flight for `key`.
+
+        Returns:
+            Whatever the shared call returned. Exceptions are raised to every caller.
+        """
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.coalesced += 1
+            log.debug(f"Coalesced call for {key} ({self.coalesced} total)")
+
+        # Shield the shared task, so that one caller being cancelled (e.g., the
+        # interaction timing out) doesn't cancel the work for everybody else.
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # Retrieve the exception so that asyncio doesn't warn about it never being
+        # retrieved when every caller was cancelled before it finished.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
@@ -0,0 +1,267 @@
+"""Keeps downloaded media on disk, so that the same post doesn't have to be
+downloaded again each time somebody asks for it, and likewise for the output of
+conversions.
+
+Files are named after a hash of what they are (the extractor, ID, and format), are
+only moved into place once they have been completely written, and the least
+recently used are removed once the store grows past its budget.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from .singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+# Where downloaded media is kept, and how many bytes of it may be kept. 0 disables
+# the store, so that everything is downloaded to a temporary directory instead.
+MEDIA_STORE_PATH = os.getenv("MEDIA_STORE_PATH", "data/media")
+MEDIA_STORE_BYTES = int(os.getenv("MEDIA_STORE_BYTES", 2 * 1024 * 1024 * 1024))
+
+# The same, for the output of `/convert`.
+CONVERSION_STORE_PATH = os.getenv("CONVERSION_STORE_PATH", "data/conversions")
+CONVERSION_STORE_BYTES = int(os.getenv("CONVERSION_STORE_BYTES", 1024 * 1024 * 1024))
+
+# Downloads in progress, which are moved into the store once they finish.
+_TEMP_DIRECTORY = ".tmp"
+
+
+def media_key(extractor_key: str, media_id: str, file_format: Optional[str]) -> str:
+    """What a piece of media is stored under."""
+    key = "/".join([extractor_key, media_id, file_format or "default"])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def conversion_key(digest: str, extension: str, target_size: Optional[int]) -> str:
+    """What the output of a conversion is stored under.
+
+    Args:
+        digest (str): Hash of the contents of the input.
+        extension (str): Extension being converted to, e.g., `.mp4`.
+        target_size (int): Size the output had to fit in, in bytes, if any.
+    """
+    key = "/".join(["conversion", digest, extension, str(target_size or 0)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class MediaStore:
+    """Media files on disk, with the least recently used removed once they take up
+    more than `max_bytes` between them.
+
+    Args:
+        root (str): Directory to keep the files in.
+        max_bytes (int): How many bytes of files may be kept.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+
+        # Size of each file, from least to most recently used.
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes: int = 0
+        self._is_loaded: bool = False
+
+        # Files being read, which mustn't be removed until they are done with.
+        self._pinned: Counter[str] = Counter()
+        self._in_flight = SingleFlight()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _load(self) -> None:
+        """Find the files kept by a previous run, oldest first."""
+        if self._is_loaded:
+            return
+
+        self._is_loaded = True
+
+        # Anything left in here was interrupted part way through.
+        shutil.rmtree(os.path.join(self.root, _TEMP_DIRECTORY), ignore_errors=True)
+        os.makedirs(os.path.join(self.root, _TEMP_DIRECTORY), exist_ok=True)
+
+        found = []
+
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+
+        log.info(f"Found {len(self._entries)} stored files, {self._bytes} bytes")
+
+        self._evict()
+
+    def _evict(self) -> None:
+        for key in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+
+            if self._pinned[key]:
+                continue
+
+            self._bytes -= self._entries.pop(key)
+            self.evictions += 1
+
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[str]:
+        """Where a file is stored, marking it as recently used.
+
+        Returns:
+            The path to the file, or None if it isn't stored.
+        """
+        self._load()
+
+        if key not in self._entries:
+            return
+
+        path = self._path(key)
+
+        # The modification time is what orders the files after a restart.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._bytes -= self._entries.pop(key)
+            return
+
+        self._entries.move_to_end(key)
+
+        return path
+
+    def put(self, key: str, path: str) -> str:
+        """Move a completely written file into the store, replacing any that was
+        stored under the same key.
+
+        Returns:
+            Where the file is now stored.
+        """
+        self._load()
+
+        size = os.path.getsize(path)
+        path_stored = self._path(key)
+
+        # Renaming is atomic, so the file is never seen half written.
+        os.replace(path, path_stored)
+
+        self._bytes += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
+
+        return path_stored
+
+    async def _download(
+        self, key: str, filename: str, func: Callable[[str], Awaitable[None]]
+    ) -> Optional[str]:
+        path_temp = mkdtemp(dir=os.path.join(self.root, _TEMP_DIRECTORY))
+
+        try:
+            path_download = os.path.join(path_temp, filename)
+            await func(path_download)
+
+            if not os.path.exists(path_download):
+                return
+
+            return self.put(key, path_download)
+        finally:
+            shutil.rmtree(path_temp, ignore_errors=True)
+
+    @asynccontextmanager
+    async def fetch(
+        self, key: str, filename: str, func: Callable[[str], Awaitable[None]]
+    ) -> AsyncIterator[Optional[str]]:
+        """Get a stored file, downloading it first if it isn't stored yet. The file
+        is kept until the block exits, even if the store fills up meanwhile.
+
+        Args:
+            key (str): What the file is stored under, from `media_key`.
+            filename (str): Name to download the file as.
+            func (Callable): Downloads the file to the path it is given.
+
+        Returns:
+            Where the file is, or None if nothing was downloaded.
+        """
+        if self.max_bytes <= 0:
+            with TemporaryDirectory() as path_temp:
+                path = os.path.join(path_temp, filename)
+                await func(path)
+
+                yield path if os.path.exists(path) else None
+                return
+
+        # Pinned from the start, so that a file larger than the whole store is kept
+        # long enough to be used once.
+        self._pinned[key] += 1
+
+        try:
+            path = self.get(key)
+
+            if path is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+                # Everybody asking for the same media at once shares the download.
+                path = await self._in_flight.run(
+                    key, lambda: self._download(key, filename, func)
+                )
+
+            yield path
+        finally:
+            self._pinned[key] -= 1
+
+            if self._pinned[key] <= 0:
+                del self._pinned[key]
+
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_store = MediaStore(MEDIA_STORE_PATH, MEDIA_STORE_BYTES)
+_conversions = MediaStore(CONVERSION_STORE_PATH, CONVERSION_STORE_BYTES)
+
+
+def fetch(key: str, filename: str, func: Callable[[str], Awaitable[None]]):
+    """Get a file from the shared store, downloading it first if needed. See
+    `MediaStore.fetch`."""
+    return _store.fetch(key, filename, func)
+
+
+def stats() -> Dict[str, int]:
+    return _store.stats()
+
+
+def fetch_conversion(key: str, filename: str, func: Callable[[str], Awaitable[None]]):
+    """Get the output of a conversion, running it first if it isn't stored. See
+    `MediaStore.fetch`."""
+    return _conversions.fetch(key, filename, func)
+
+
+def conversion_stats() -> Dict[str, int]:
+    return _conversions.stats()
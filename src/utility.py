@@ -9,6 +9,10 @@ second_multiplier = [
     86_400,  # days
 ]
 
+# Query parameters that only track where a link was shared from, and never change
+# which piece of media it points to.
+tracking_parameters = ("fbclid", "feature", "igshid", "si")
+
 
 def timestamp_to_seconds(timestamp: str) -> int:
     """Try to convert a timestamp string (e.g., 3:45) to seconds.
@@ -32,6 +36,24 @@ def timestamp_to_seconds(timestamp: str) -> int:
     return total_seconds
 
 
+def seconds_to_timestamp(seconds: int) -> str:
+    """Format a number of seconds as a timestamp string (e.g., 225 to 3:45).
+
+    Args:
+        seconds (int): The time in seconds.
+
+    Returns:
+        The timestamp, only including hours when there are any.
+    """
+    hours, remainder = divmod(int(seconds), second_multiplier[2])
+    minutes, seconds = divmod(remainder, second_multiplier[1])
+
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+
+    return f"{minutes}:{seconds:02}"
+
+
 def timestamp_from_extractor(link: str, extractor_key: str) -> Optional[int]:
     """Try to resolve the timestamp from a link and its extractor.
 
@@ -61,6 +83,78 @@ def timestamp_from_extractor(link: str, extractor_key: str) -> Optional[int]:
                 parse.unquote(url_parsed.fragment.split("=")[-1])
             )
 
+
+def normalize_url(link: str) -> str:
+    """Normalize a URL so that different ways of writing the same link compare equal.
+
+    The scheme and host are lowercased, default ports and trailing slashes are
+    removed, tracking query parameters are dropped and the rest are sorted. The
+    fragment is kept, as some extractors store timestamps in it.
+
+    Args:
+        link (str): The URL to normalize.
+
+    Returns:
+        The normalized URL.
+    """
+    url_parsed = parse.urlparse(link.strip())
+
+    scheme = url_parsed.scheme.lower()
+    netloc = url_parsed.netloc.lower()
+
+    # An invalid port is left as it is, for whatever fetches the link to reject.
+    try:
+        port = url_parsed.port
+    except ValueError:
+        port = None
+
+    if (scheme, port) in (("http", 80), ("https", 443)):
+        netloc = netloc.rsplit(":", 1)[0]
+
+    query = sorted(
+        (key, value)
+        for key, value in parse.parse_qsl(url_parsed.query, keep_blank_values=True)
+        if key.lower() not in tracking_parameters
+        and not key.lower().startswith("utm_")
+    )
+
+    return parse.urlunparse(
+        (
+            scheme,
+            netloc,
+            url_parsed.path.rstrip("/") or "/",
+            url_parsed.params,
+            parse.urlencode(query),
+            url_parsed.fragment,
+        )
+    )
+
+
+def url_expiry(link: str) -> Optional[int]:
+    """Try to find when a signed CDN URL stops working.
+
+    Args:
+        link (str): The signed URL, e.g., a `googlevideo.com` or CloudFront link.
+
+    Returns:
+        The UNIX timestamp at which the URL expires, or None if it doesn't say.
+    """
+    url_query = parse.parse_qs(parse.urlparse(link).query)
+
+    for key, values in url_query.items():
+        key = key.lower()
+
+        try:
+            # Instagram, Facebook, and Discord store it as a hexadecimal timestamp.
+            if key in ("oe", "ex"):
+                return int(values[0], 16)
+
+            if key in ("expire", "expires", "x-expires", "exp"):
+                return int(values[0])
+        except ValueError:
+            continue
+
+
 def uri_validator(x):
     try:
         result = urlparse(x)
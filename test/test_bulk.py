@@ -0,0 +1,146 @@
+import asyncio
+import io
+import json
+
+import pytest
+import pytest_asyncio
+
+from src import bulk, cache, shazam
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def create_song(title: str) -> dict:
+    return {
+        "title": title,
+        "artist": "Artist",
+        "album": None,
+        "album_art": None,
+        "label": None,
+        "release_year": None,
+    }
+
+
+@pytest_asyncio.fixture
+async def fake_stages(monkeypatch):
+    """Replaces extraction, slicing, and recognition, counting how often each ran.
+
+    Links are of the form `https://example.com/<id>?<delay>`, where links with the
+    same ID are the same media, and the delay is how long recognizing them takes.
+    """
+    instance = cache.Cache("redis://127.0.0.1:1")
+    monkeypatch.setattr(cache, "_cache", instance)
+
+    calls = {"extract": 0, "slice": 0, "recognize": 0}
+
+    async def download_media(link, **kwargs):
+        calls["extract"] += 1
+        media_id = link.split("/")[-1].split("?")[0]
+
+        if media_id == "broken":
+            raise RuntimeError("extraction failed")
+
+        return {"id": media_id, "extractor_key": "Fake", "url": link, "duration": 600}
+
+    async def slice_window(source, data_media, time_start, time_duration):
+        calls["slice"] += 1
+        return b"audio" if time_start < data_media["duration"] else b""
+
+    async def recognize_audio(data_audio, data_media, time_start, *args):
+        calls["recognize"] += 1
+        await asyncio.sleep(float(data_media["url"].split("?")[-1]))
+
+        return create_song(f"{data_media['id']} at {time_start}")
+
+    monkeypatch.setattr(shazam, "download_media", download_media)
+    monkeypatch.setattr(shazam, "_slice_window", slice_window)
+    monkeypatch.setattr(shazam, "_recognize_audio", recognize_audio)
+
+    yield calls
+
+    await instance.close()
+
+
+@pytest.mark.asyncio
+async def test_find_songs(fake_stages):
+    await cache.set_extract_info(
+        "https://example.com/cached?0",
+        {"id": "cached", "extractor_key": "Fake", "url": "https://example.com/"},
+        file_format="worstaudio/worst",
+    )
+    await cache.set_song_from_info(
+        {"id": "cached", "extractor_key": "Fake"}, create_song("cached"), 30
+    )
+
+    requests = [
+        ("https://example.com/slow?0.2", 0, 1),
+        ("https://example.com/fast?0", 0, 1),
+        ("https://example.com/fast?0", 0, 1),
+        ("https://example.com/cached?0", 30, 1),
+        ("https://example.com/broken?0", 0, 1),
+        ("https://example.com/fast?0", 900, 1),
+        ("not a link", 0, 1),
+    ]
+
+    results = [result async for result in shazam.find_songs(requests)]
+
+    by_index = {result["index"]: result for result in results}
+
+    assert len(results) == len(requests)
+    assert by_index[0]["song"]["title"] == "slow at 0"
+    assert by_index[1]["song"] == by_index[2]["song"]
+    assert by_index[3]["song"]["title"] == "cached"
+    assert "extraction failed" in by_index[4]["error"]
+    assert by_index[5]["song"] is None and by_index[5]["error"] is None
+    assert by_index[6]["error"] == "invalid link"
+
+    # Completion order, so the slow one comes after the others were recognized.
+    assert results[-1]["index"] == 0
+
+    # The cached one was never extracted, and the duplicate was only recognized once.
+    assert fake_stages == {"extract": 5, "slice": 3, "recognize": 2}
+
+
+def test_parse_line():
+    assert bulk.parse_line("https://example.com/a\n") == (
+        "https://example.com/a",
+        None,
+        1,
+    )
+    assert bulk.parse_line("https://example.com/a 30 2") == (
+        "https://example.com/a",
+        30,
+        2,
+    )
+    assert bulk.parse_line("https://example.com/a - 2")[1] is None
+    assert bulk.parse_line("# comment") is None
+    assert bulk.parse_line("   ") is None
+    assert bulk.parse_line("https://example.com/a 1:30")[1] == 90
+
+    with pytest.raises(ValueError):
+        bulk.parse_line("https://example.com/a 1m30")
+
+    with pytest.raises(ValueError):
+        bulk.parse_line("https://example.com/a - two")
+
+
+@pytest.mark.asyncio
+async def test_run_bad_lines(fake_stages):
+    lines = [
+        "https://example.com/fast?0 1m30\n",
+        "\n",
+        "https://example.com/fast?0 1:30\n",
+        "https://example.com/slow?0 0 two\n",
+    ]
+    output = io.StringIO()
+
+    failures = await bulk.run(lines, output, 15, 1, 1, 1, False)
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    by_index = {result["index"]: result for result in results}
+
+    assert failures == 2
+    assert sorted(by_index) == [0, 1, 2]
+    assert by_index[0]["error"] == "invalid timestamp: 1m30"
+    assert by_index[1]["song"]["title"] == "fast at 90"
+    assert by_index[2]["error"] == "invalid playlist index: two"
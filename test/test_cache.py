@@ -0,0 +1,427 @@
+import asyncio
+import json
+import time
+
+import pytest
+import pytest_asyncio
+
+from src import cache, metrics
+from src.api import song
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest_asyncio.fixture
+async def fallback_cache(monkeypatch):
+    """A cache that can't reach Redis, and so uses the fallback."""
+    instance = cache.Cache("redis://127.0.0.1:1")
+    monkeypatch.setattr(cache, "_cache", instance)
+
+    yield instance
+
+    await instance.close()
+
+
+@pytest.mark.asyncio
+async def test_extract_info_roundtrip(fallback_cache):
+    media_info = {
+        "id": "abc",
+        "extractor_key": "Youtube",
+        "url": "https://cdn.example.com/abc.webm",
+        "ext": "webm",
+        "filesize_approx": 1234,
+        "formats": [{"url": "not kept"}],
+    }
+
+    await cache.set_extract_info("https://youtube.com/watch?v=abc&si=1", media_info)
+
+    data = await cache.get_extract_info("https://youtube.com/watch?v=abc")
+
+    assert data is not None
+    assert data["url"] == media_info["url"]
+    assert "formats" not in data
+
+
+@pytest.mark.asyncio
+async def test_extract_info_keyed_on_index(fallback_cache):
+    await cache.set_extract_info("https://a.com/x", {"id": "1"}, playlist_index=1)
+
+    assert await cache.get_extract_info("https://a.com/x", playlist_index=2) is None
+
+
+@pytest.mark.asyncio
+async def test_extract_info_expired_url_not_cached(fallback_cache):
+    expire = int(time.time()) + 10
+
+    await cache.set_extract_info(
+        "https://a.com/x", {"id": "1", "url": f"https://cdn.a.com/x?expire={expire}"}
+    )
+
+    assert await cache.get_extract_info("https://a.com/x") is None
+
+
+@pytest.mark.asyncio
+async def test_attachment_url(fallback_cache):
+    expires = format(int(time.time()) + 3600, "x")
+    url = f"https://cdn.discordapp.com/attachments/1/2/a.mp4?ex={expires}"
+
+    await cache.set_attachment_url("key", url)
+    await cache.set_attachment_url(
+        "expired", "https://cdn.discordapp.com/attachments/1/2/a.mp4?ex=10"
+    )
+
+    assert await cache.get_attachment_url("key") == url
+    assert await cache.get_attachment_url("expired") is None
+    assert await cache.get_attachment_url("missing") is None
+
+
+@pytest.mark.asyncio
+async def test_palettes(fallback_cache):
+    hits = metrics.CACHE_LOOKUPS.get("palette", "hit")
+
+    await cache.set_palettes("digest", {32: b"png"})
+
+    assert await cache.get_palettes("digest", (32, 16)) == {32: b"png"}
+    assert await cache.get_palettes("other", (32,)) == {}
+    assert metrics.CACHE_LOOKUPS.get("palette", "hit") == hits + 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_memory_evicts_least_recently_used():
+    memory = cache.MemoryCache(max_entries=2)
+
+    memory.set("a", b"1")
+    memory.set("b", b"2")
+    memory.get("a")
+    memory.set("c", b"3")
+
+    assert "a" in memory
+    assert "b" not in memory
+    assert memory.evictions == 1
+
+
+def test_memory_bounded_by_bytes():
+    memory = cache.MemoryCache(max_bytes=10)
+
+    memory.set("a", b"1234")
+    memory.set("b", b"1234")
+    memory.set("c", b"1234")
+
+    assert len(memory) == 2
+    assert memory.size_bytes <= 10
+
+
+def test_memory_too_large_not_stored():
+    memory = cache.MemoryCache(max_bytes=10)
+
+    memory.set("a", b"1")
+    memory.set("b", b"12345678901")
+
+    assert "a" in memory
+    assert "b" not in memory
+
+
+def test_memory_ttl_expires():
+    clock = FakeClock()
+    memory = cache.MemoryCache(clock=clock)
+
+    memory.set("a", b"1", ttl=10)
+    memory.set("b", b"2")
+
+    clock.now = 11
+
+    assert memory.get("a") is None
+    assert memory.get("b") == b"2"
+    assert memory.expirations == 1
+
+
+def test_memory_counters():
+    memory = cache.MemoryCache()
+
+    memory.set("a", b"1")
+    memory.get("a")
+    memory.get("b")
+
+    assert memory.stats()["hits"] == 1
+    assert memory.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_fallback_stores_bytes(fallback_cache):
+    await fallback_cache.set("key", b"\x00\x01")
+
+    assert await fallback_cache.get("key") == b"\x00\x01"
+
+
+class FakeRedis:
+    """Stands in for a Redis host that can be taken down and brought back up."""
+
+    def __init__(self):
+        self.is_up = True
+        self.data = {}
+        self.calls = 0
+
+    def _check(self):
+        if not self.is_up:
+            raise cache.RedisError("Redis is down")
+
+    async def ping(self):
+        self._check()
+        return True
+
+    async def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None, px=None):
+        self._check()
+        self.data[key] = value
+
+    async def mget(self, keys):
+        self._check()
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, key, value, ex=None, px=None):
+        self.commands.append((key, value))
+
+    async def execute(self):
+        self.redis._check()
+        self.redis.calls += 1
+
+        for key, value in self.commands:
+            self.redis.data[key] = value
+
+
+@pytest_asyncio.fixture
+async def fake_redis_cache():
+    instance = cache.Cache("redis://127.0.0.1:1", health_interval=3600)
+    instance.redis_conn = FakeRedis()
+
+    yield instance
+
+    await instance.close()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_redis_does_not_raise(fallback_cache):
+    await fallback_cache.set("key", "value")
+
+    assert await fallback_cache.get("key") == b"value"
+    assert not fallback_cache.is_using_redis
+
+
+@pytest.mark.asyncio
+async def test_failover_and_write_back(fake_redis_cache):
+    redis = fake_redis_cache.redis_conn
+
+    await fake_redis_cache.set("before", "1")
+    assert fake_redis_cache.is_using_redis
+
+    redis.is_up = False
+
+    # The failing write should be kept locally, instead of raising.
+    await fake_redis_cache.set("during", "2")
+
+    assert not fake_redis_cache.is_using_redis
+    assert await fake_redis_cache.get("during") == b"2"
+
+    redis.is_up = True
+
+    assert await fake_redis_cache.check_health()
+    assert redis.data["during"] == b"2"
+
+
+@pytest.mark.asyncio
+async def test_latency_budget(fake_redis_cache):
+    async def slow_get(key):
+        await asyncio.sleep(1)
+
+    fake_redis_cache.latency_budget = 0.01
+    await fake_redis_cache.get("warm up")
+
+    fake_redis_cache.redis_conn.get = slow_get
+
+    assert await fake_redis_cache.get("key") is None
+    assert fake_redis_cache.timeouts == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("l1_enabled", [True, False])
+async def test_set_timeout_while_healthy(fake_redis_cache, l1_enabled):
+    redis = fake_redis_cache.redis_conn
+    set_redis = redis.set
+
+    async def slow_set(key, value, ex=None, px=None):
+        await asyncio.sleep(1)
+
+    if not l1_enabled:
+        fake_redis_cache._cache_l1 = None
+
+    fake_redis_cache.latency_budget = 0.01
+    await fake_redis_cache.get("warm up")
+
+    redis.set = slow_set
+    await fake_redis_cache.set("key", "value")
+
+    assert fake_redis_cache.timeouts == 1
+    assert fake_redis_cache.is_using_redis
+
+    # Still readable, although Redis never got it.
+    assert await fake_redis_cache.get("key") == b"value"
+
+    # Written back once Redis answers again.
+    redis.set = set_redis
+    await fake_redis_cache.get("other")
+    await fake_redis_cache._write_back_task
+
+    assert redis.data["key"] == b"value"
+    assert not fake_redis_cache._pending_writes
+
+
+@pytest.mark.asyncio
+async def test_get_many_and_set_many(fake_redis_cache):
+    redis = fake_redis_cache.redis_conn
+
+    await fake_redis_cache.set_many({"a": "1", "b": b"2"})
+    assert redis.calls == 1
+
+    await fake_redis_cache.get("a")
+    redis.calls = 0
+
+    # One is already held in front of Redis, the other is fetched in one call.
+    assert await fake_redis_cache.get_many(["a", "b", "c"]) == [b"1", b"2", None]
+    assert redis.calls == 1
+
+    redis.is_up = False
+
+    await fake_redis_cache.set_many({"c": "3"})
+    assert await fake_redis_cache.get_many(["c"]) == [b"3"]
+
+    redis.is_up = True
+
+    assert await fake_redis_cache.check_health()
+    assert redis.data["c"] == b"3"
+
+
+MEDIA_INFO = {"id": "abc", "extractor_key": "Youtube"}
+
+SONG = {
+    "title": "Never Gonna Give You Up",
+    "artist": "Rick Astley",
+    "album": "Whenever You Need Somebody",
+    "album_art": "https://is1-ssl.mzstatic.com/image/thumb/Music/v4/ab/cd/ef/"
+    "abcdef.jpg/400x400cc.jpg",
+    "label": None,
+    "release_year": "1987",
+}
+
+
+def test_song_encoding():
+    data = song.encode(SONG)
+
+    assert song.decode(data) == SONG
+    assert len(data) < len(json.dumps(SONG)) / 2
+
+    assert song.decode(song.encode(None)) == {}
+
+    # Songs cached before the binary encoding.
+    assert song.decode(json.dumps(SONG).encode("utf-8")) == SONG
+    assert song.decode(b"{}") == {}
+
+    with pytest.raises(ValueError):
+        song.decode(b"\xff\x00")
+
+
+@pytest.mark.asyncio
+async def test_songs_roundtrip(fallback_cache):
+    await cache.set_song_from_info(MEDIA_INFO, SONG, 0)
+    await cache.set_empty_from_info(MEDIA_INFO, 60)
+
+    assert await cache.get_from_info(MEDIA_INFO, 0) == SONG
+    assert await cache.get_many_from_info(MEDIA_INFO, [0, 60, 120]) == [
+        SONG,
+        {},
+        None,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_songs_migrated_from_json(fake_redis_cache, monkeypatch):
+    monkeypatch.setattr(cache, "_cache", fake_redis_cache)
+
+    redis = fake_redis_cache.redis_conn
+    redis.data["Youtube-abc-0"] = json.dumps(SONG).encode("utf-8")
+    redis.data["Youtube-abc-60"] = b"{}"
+
+    assert await cache.get_many_from_info(MEDIA_INFO, [0, 60]) == [SONG, {}]
+
+    assert not song.is_legacy(redis.data["Youtube-abc-0"])
+    assert not song.is_legacy(redis.data["Youtube-abc-60"])
+    assert song.decode(redis.data["Youtube-abc-0"]) == SONG
+
+
+@pytest.mark.asyncio
+async def test_songs_from_spans(fallback_cache):
+    await cache.set_song_from_info(MEDIA_INFO, SONG, 120, 15, song_offset=5)
+    await cache.set_empty_from_info(MEDIA_INFO, 300, 15)
+
+    # Anywhere from when the song started up to halfway through the window.
+    assert await cache.get_from_info(MEDIA_INFO, 122, 15) == SONG
+    assert await cache.get_from_info(MEDIA_INFO, 115, 15) == SONG
+    assert await cache.get_from_info(MEDIA_INFO, 110, 15) is None
+    assert await cache.get_from_info(MEDIA_INFO, 128, 15) is None
+
+    # Nothing found covers the window that was scanned.
+    assert await cache.get_from_info(MEDIA_INFO, 305, 15) == {}
+    assert await cache.get_from_info(MEDIA_INFO, 310, 15) is None
+
+    # Only used when asked to.
+    assert await cache.get_from_info(MEDIA_INFO, 122) is None
+
+
+@pytest.mark.asyncio
+async def test_spans_prefer_closest(fallback_cache):
+    other = dict(SONG, title="Other")
+
+    # The second song was mixed in part of the way through, so its span reaches back
+    # over the end of the first.
+    await cache.set_song_from_info(MEDIA_INFO, SONG, 100, 15)
+    await cache.set_song_from_info(MEDIA_INFO, other, 120, 15, song_offset=100)
+
+    assert await cache.get_from_info(MEDIA_INFO, 102, 15) == SONG
+    assert await cache.get_from_info(MEDIA_INFO, 115, 15) == other
+    assert await cache.get_from_info(MEDIA_INFO, 80, 15) is None
+
+
+@pytest.mark.asyncio
+async def test_spans_concurrent_writes(fallback_cache):
+    await asyncio.gather(
+        *[
+            cache.set_song_from_info(MEDIA_INFO, SONG, window, 15)
+            for window in range(0, 600, 60)
+        ]
+    )
+
+    assert (
+        await cache.get_many_from_info(
+            MEDIA_INFO, [window + 2 for window in range(0, 600, 60)], 15
+        )
+        == [SONG] * 10
+    )
@@ -0,0 +1,286 @@
+import struct
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from src import containers, downloader, partial
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def box(box_type: bytes, payload: bytes, full: bool = False) -> bytes:
+    if full:
+        payload = b"\x00\x00\x00\x00" + payload
+
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def element(element_id: int, payload: bytes) -> bytes:
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+
+    # Always use eight bytes for the size, which is allowed and simpler.
+    return id_bytes + b"\x01" + len(payload).to_bytes(7, "big") + payload
+
+
+def uint(element_id: int, value: int) -> bytes:
+    return element(element_id, value.to_bytes(4, "big"))
+
+
+def page(granule: int, payload: bytes, serial: int = 1) -> bytes:
+    segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+
+    return (
+        b"OggS"
+        + struct.pack("<BBqIIIB", 0, 0, granule, serial, 0, 0, len(segments))
+        + bytes(segments)
+        + payload
+    )
+
+
+def create_moov() -> bytes:
+    """An audio track of 100 samples of 0.1 seconds and 10 bytes each, in chunks of
+    10 samples, with 100 bytes of something else between each chunk."""
+    stbl = b"".join(
+        [
+            box(b"stts", struct.pack(">III", 1, 100, 100), full=True),
+            box(b"stsc", struct.pack(">IIII", 1, 1, 10, 1), full=True),
+            box(b"stsz", struct.pack(">II", 10, 100), full=True),
+            box(
+                b"stco",
+                struct.pack(">I10I", 10, *[1000 + 200 * index for index in range(10)]),
+                full=True,
+            ),
+        ]
+    )
+
+    mdia = b"".join(
+        [
+            box(b"mdhd", struct.pack(">IIII", 0, 0, 1000, 10_000), full=True),
+            box(b"hdlr", struct.pack(">I4s", 0, b"soun") + bytes(12), full=True),
+            box(b"minf", box(b"stbl", stbl)),
+        ]
+    )
+
+    return box(b"moov", box(b"trak", box(b"mdia", mdia)))
+
+
+def test_sniff():
+    assert containers.sniff(box(b"ftyp", b"isom")) == "mp4"
+    assert containers.sniff(element(containers.EBML_HEADER, b"")) == "matroska"
+    assert containers.sniff(page(0, b"OpusHead")) == "ogg"
+    assert containers.sniff(b"ID3\x04\x00") == "mpeg"
+    assert containers.sniff(b"\xff\xfb\x90\x00") == "mpeg"
+    assert containers.sniff(b"RIFF\x00\x00\x00\x00WAVE") is None
+
+
+def test_mp4_sample_range():
+    moov = create_moov()
+
+    assert not containers.mp4_is_fragmented(moov)
+
+    # Samples 10 to 20, which start the second and third chunks.
+    assert containers.mp4_sample_range(moov, 1.0, 2.0) == (1200, 1410)
+
+    # Samples in the middle of a chunk.
+    assert containers.mp4_sample_range(moov, 0.35, 0.55) == (1030, 1060)
+
+    # Past the end is clamped to the last sample.
+    assert containers.mp4_sample_range(moov, 9.5, 20) == (2850, 2900)
+    assert containers.mp4_sample_range(moov, 20, 30) is None
+
+
+def test_mp4_sidx_range():
+    references = b"".join(struct.pack(">III", 100, 1000, 0x90000000) for _ in range(4))
+    sidx = box(
+        b"sidx",
+        struct.pack(">IIIIHH", 1, 1000, 0, 0, 0, 4) + references,
+        full=True,
+    )
+
+    # The second and third fragments, relative to the end of the `sidx` box.
+    assert containers.mp4_sidx_range(sidx, 500, 1.5, 2.5) == (600, 800)
+    assert containers.mp4_sidx_range(sidx, 500, 0, 0.5) == (500, 600)
+    assert containers.mp4_sidx_range(sidx, 500, 10, 20) is None
+
+
+def test_matroska_head():
+    seek_head = element(
+        containers.MKV_SEEK_HEAD,
+        element(
+            containers.MKV_SEEK,
+            element(containers.MKV_SEEK_ID, struct.pack(">I", containers.MKV_CUES))
+            + uint(containers.MKV_SEEK_POSITION, 5000),
+        ),
+    )
+    info = element(containers.MKV_INFO, uint(containers.MKV_TIMESTAMP_SCALE, 1_000_000))
+    cluster = element(containers.MKV_CLUSTER, bytes(64))
+
+    segment = seek_head + info + cluster
+    head = element(containers.EBML_HEADER, b"") + element(
+        containers.MKV_SEGMENT, segment
+    )
+
+    data_head = containers.matroska_head(head)
+
+    assert data_head is not None
+    assert data_head.segment_offset == 12 + 12
+    assert data_head.timestamp_scale == 1_000_000
+    assert data_head.positions[containers.MKV_CUES] == 5000
+    assert data_head.first_cluster == len(seek_head) + len(info)
+
+
+def test_matroska_cues():
+    def cue_point(time: int, position: int) -> bytes:
+        return element(
+            containers.MKV_CUE_POINT,
+            uint(containers.MKV_CUE_TIME, time)
+            + element(
+                containers.MKV_CUE_TRACK_POSITIONS,
+                uint(containers.MKV_CUE_CLUSTER_POSITION, position),
+            ),
+        )
+
+    cues = element(
+        containers.MKV_CUES,
+        b"".join(cue_point(index * 5000, 1000 + index * 100) for index in range(10)),
+    )
+
+    points = containers.matroska_cues(cues)
+
+    assert points[:2] == [(0, 1000), (5000, 1100)]
+
+    # In milliseconds, so the window falls in the clusters at 10 and 15 seconds.
+    assert containers.matroska_cluster_range(points, 1_000_000, 12, 18) == (
+        1200,
+        1400,
+    )
+    assert containers.matroska_cluster_range(points, 1_000_000, 44, 60) == (
+        1800,
+        None,
+    )
+
+
+def test_ogg_pages():
+    opus_head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+    data = (
+        page(0, opus_head)
+        + page(0, b"OpusTags")
+        + page(48_312, bytes(300))
+        + page(96_312, bytes(300))
+    )
+
+    stream = containers.ogg_stream(data)
+
+    assert stream is not None
+    assert stream.sample_rate == 48_000
+    assert stream.header_end == len(page(0, opus_head)) + len(page(0, b"OpusTags"))
+    assert stream.time(96_312) == 2
+
+    # Starting in the middle of a page resyncs on the next one.
+    pages = list(containers.ogg_pages(data, stream.header_end + 10))
+
+    assert [page.granule for page in pages] == [96_312]
+
+
+@pytest_asyncio.fixture
+async def ogg_server():
+    """Serves an Ogg file of an hour of pages a second long, with range requests, and
+    an HLS playlist of it at `/playlist.m3u8`."""
+    opus_head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 0, 48000, 0, 0)
+    data = page(0, opus_head) + page(0, b"OpusTags")
+    data += b"".join(page(48_000 * second, bytes(1000)) for second in range(1, 3601))
+
+    playlist = b"#EXTM3U\n#EXT-X-TARGETDURATION:10\n"
+    playlist += b"".join(b"#EXTINF:10,\n/ranged\n" for _ in range(360))
+
+    async def handle(request):
+        if request.path == "/unranged":
+            return web.Response(body=data)
+
+        if request.path == "/playlist.m3u8":
+            return web.Response(
+                status=206,
+                body=playlist,
+                headers={
+                    "Content-Range": f"bytes 0-{len(playlist) - 1}/{len(playlist)}"
+                },
+            )
+
+        chunk = data[request.http_range]
+        start = request.http_range.start or 0
+
+        return web.Response(
+            status=206,
+            body=chunk,
+            headers={
+                "Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{len(data)}"
+            },
+        )
+
+    app = web.Application()
+    app.router.add_get("/{name}", handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+
+    yield f"http://127.0.0.1:{port}", len(data)
+
+    await downloader.close()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_fetch_window_ogg(ogg_server, tmp_path):
+    link, size = ogg_server
+
+    data_window = await partial.fetch_window(
+        f"{link}/ranged", str(tmp_path / "window"), 1800, 15
+    )
+
+    assert data_window is not None
+    assert data_window["bytes_fetched"] < size / 10
+
+    # Starts at most a few seconds before the window, and covers all of it.
+    assert 1800 - 10 <= data_window["time_offset"] <= 1800
+
+    with open(data_window["path"], "rb") as file:
+        data = file.read()
+
+    stream = containers.ogg_stream(data)
+    pages = list(containers.ogg_pages(data, stream.header_end))
+
+    assert stream.time(pages[0].granule) <= 1800 + 1
+    assert stream.time(pages[-1].granule) >= 1815
+
+
+@pytest.mark.asyncio
+async def test_fetch_window_unranged(ogg_server, tmp_path):
+    link, _ = ogg_server
+
+    assert (
+        await partial.fetch_window(
+            f"{link}/unranged", str(tmp_path / "window"), 1800, 15
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_fetch_window_manifest(ogg_server, tmp_path):
+    link, _ = ogg_server
+
+    # Left for `ffmpeg` to follow, rather than saved where it can't tell what it is.
+    assert (
+        await partial.fetch_window(
+            f"{link}/playlist.m3u8", str(tmp_path / "window"), 1800, 15, 3600
+        )
+        is None
+    )
+    assert partial._is_manifest(b'<?xml version="1.0"?>\n<MPD xmlns="urn:mpeg">')
+    assert not partial._is_manifest(page(0, b"OpusHead"))
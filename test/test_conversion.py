@@ -0,0 +1,364 @@
+import asyncio
+import io
+import os
+import wave
+
+import ffmpeg
+import pytest
+
+from src import conversion
+from src.exceptions import (
+    ConversionTimeoutException,
+    TargetSizeUnreachableException,
+)
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def test_pcm_to_wav():
+    data = b"\x00\x01" * conversion.SAMPLE_RATE
+
+    with wave.open(io.BytesIO(conversion.pcm_to_wav(data)), "rb") as file:
+        assert file.getnchannels() == conversion.SAMPLE_CHANNELS
+        assert file.getframerate() == conversion.SAMPLE_RATE
+        assert file.readframes(file.getnframes()) == data
+
+
+@pytest.mark.asyncio
+async def test_audio_slice_noisy_input(tmp_path):
+    """Corrupt audio makes `ffmpeg` log far more errors than a pipe can hold."""
+    path = str(tmp_path / "corrupt.mp3")
+
+    (
+        ffmpeg.input("sine=d=180", f="lavfi")
+        .output(path, acodec="libmp3lame")
+        .run(quiet=True)
+    )
+
+    with open(path, "r+b") as file:
+        data = bytearray(file.read())
+
+        for index in range(2000, len(data), 40):
+            data[index] ^= 0xFF
+
+        file.seek(0)
+        file.write(data)
+
+    try:
+        data_audio = await conversion.audio_slice(path, 0, 180, timeout=60)
+    except ffmpeg.Error as e:
+        assert len(e.stderr) > 64 * 1024
+    else:
+        assert data_audio
+
+
+@pytest.mark.asyncio
+async def test_audio_slice_timeout(tmp_path):
+    # Nothing ever writes to it, so `ffmpeg` waits forever to open it.
+    path = str(tmp_path / "input.pipe")
+    os.mkfifo(path)
+
+    with pytest.raises(ConversionTimeoutException):
+        await conversion.audio_slice(path, 0, 15, timeout=0.5)
+
+
+def test_process_limits(monkeypatch):
+    assert conversion._process_limits() is None
+
+    monkeypatch.setattr(conversion, "FFMPEG_NICE", 10)
+
+    assert conversion._process_limits() is conversion._limit_process
+
+
+@pytest.mark.asyncio
+async def test_wait_process_kills():
+    process = await asyncio.create_subprocess_exec(
+        "sleep", "10", stdout=asyncio.subprocess.PIPE
+    )
+
+    with pytest.raises(ConversionTimeoutException):
+        await conversion._wait_process(process, process.communicate(), 0.1)
+
+    assert process.returncode is not None
+
+
+def test_parse_progress():
+    progress = conversion._parse_progress(
+        {
+            "fps": "24.5",
+            "frame": "306",
+            "total_size": "1048576",
+            "out_time_us": "12500000",
+            "out_time_ms": "12500000",
+            "speed": "2.1x",
+            "progress": "continue",
+        }
+    )
+
+    assert progress["out_time"] == 12.5
+    assert progress["frames"] == 306
+    assert progress["total_size"] == 1048576
+    assert progress["speed"] == 2.1
+    assert not progress["is_done"]
+
+
+def test_parse_progress_missing():
+    progress = conversion._parse_progress({"out_time_us": "N/A", "progress": "end"})
+
+    assert progress["out_time"] is None
+    assert progress["is_done"]
+
+
+def create_info(**kwargs) -> conversion.MediaInfo:
+    info = conversion.MediaInfo(
+        duration=60,
+        size=50_000_000,
+        has_video=True,
+        has_audio=True,
+        width=1920,
+        height=1080,
+        fps=30,
+        sample_rate=48_000,
+        channels=2,
+        video_codec="h264",
+        audio_codec="aac",
+        audio_bitrate=128_000,
+    )
+    info.update(kwargs)
+
+    return info
+
+
+def test_media_info():
+    info = conversion.media_info(
+        {
+            "format": {"duration": "12.5", "size": "1000"},
+            "streams": [
+                {
+                    "codec_type": "video",
+                    "width": 640,
+                    "height": 360,
+                    "avg_frame_rate": "30000/1001",
+                },
+                {"codec_type": "audio", "sample_rate": "44100", "channels": 2},
+            ],
+        }
+    )
+
+    assert info["duration"] == 12.5
+    assert info["has_video"] and info["has_audio"]
+    assert round(info["fps"], 2) == 29.97
+
+
+def test_media_info_ignores_album_art():
+    info = conversion.media_info(
+        {
+            "format": {"duration": "180"},
+            "streams": [
+                {"codec_type": "audio"},
+                {"codec_type": "video", "disposition": {"attached_pic": 1}},
+            ],
+        }
+    )
+
+    assert not info["has_video"]
+
+
+def test_plan_video_fits_target():
+    target = 10 * 1024 * 1024
+    plan = conversion.plan_encode(create_info(), ".mp4", target)
+
+    assert plan["estimated_size"] <= target
+    assert plan["video_bitrate"] >= conversion.MIN_VIDEO_BITRATE
+
+
+def test_plan_video_lowers_resolution():
+    """A minute of 1080p in 10MB should be scaled down."""
+    plan = conversion.plan_encode(create_info(), ".mp4", 10 * 1024 * 1024)
+
+    assert plan["width"] is not None and plan["width"] < 1920
+    assert plan["two_pass"]
+
+
+def test_plan_unreachable():
+    with pytest.raises(TargetSizeUnreachableException):
+        conversion.plan_encode(create_info(duration=3600), ".mp4", 1024 * 1024)
+
+
+def test_plan_gif_fits_target():
+    target = 8 * 1024 * 1024
+    plan = conversion.plan_encode(create_info(duration=20), ".gif", target)
+
+    assert plan["estimated_size"] <= target
+    assert plan["max_colors"] in conversion.GIF_COLORS
+
+
+def test_plan_gif_unreachable():
+    with pytest.raises(TargetSizeUnreachableException):
+        conversion.plan_encode(create_info(duration=3600), ".gif", 1024 * 1024)
+
+
+def test_plan_flac_downmixes():
+    plan = conversion.plan_encode(
+        create_info(duration=600, has_video=False), ".flac", 25 * 1024 * 1024
+    )
+
+    assert plan["estimated_size"] <= 25 * 1024 * 1024
+    assert plan["sample_rate"] is not None or plan["channels"] == 1
+
+
+def test_plan_mp3_bitrate():
+    plan = conversion.plan_encode(
+        create_info(duration=600, has_video=False), ".mp3", 10 * 1024 * 1024
+    )
+
+    assert plan["audio_bitrate"] * 600 / 8 <= 10 * 1024 * 1024
+
+
+def test_copy_same_container():
+    plan = conversion.plan_copy(create_info(), ".mp4")
+
+    assert plan is not None
+    assert plan["options"]["c:v"] == "copy"
+    assert plan["options"]["c:a"] == "copy"
+
+
+def test_copy_video_only():
+    """H.264 can't go in a WebM, so the video has to be converted."""
+    assert conversion.plan_copy(create_info(), ".webm") is None
+
+
+def test_copy_converts_audio():
+    """VP9 can go in a WebM as it is, but AAC can't."""
+    plan = conversion.plan_copy(create_info(video_codec="vp9"), ".webm")
+
+    assert plan is not None
+    assert plan["options"]["c:v"] == "copy"
+    assert plan["options"]["c:a"] == "libopus"
+
+
+def test_copy_audio_only_output():
+    plan = conversion.plan_copy(
+        create_info(audio_codec="mp3", audio_bitrate=192_000), ".mp3"
+    )
+
+    assert plan is not None
+    assert not plan["copy_video"]
+    assert plan["options"] == {"c:a": "copy"}
+
+
+def test_copy_too_large():
+    assert conversion.plan_copy(create_info(), ".mp4", target_size=1024) is None
+
+
+def test_copy_gif():
+    assert conversion.plan_copy(create_info(), ".gif") is None
+
+
+def test_encode_options_tier():
+    plan = conversion.plan_encode(create_info(), ".webm", 10 * 1024 * 1024)
+    options = conversion._encode_options(
+        ".webm", plan, conversion.SpeedTier.FAST, threads=4
+    )
+
+    assert options["c:v"] == "libvpx-vp9"
+    assert options["deadline"] == "realtime"
+    assert options["row-mt"] == 1
+    assert options["threads"] == 4
+
+
+def test_can_two_pass():
+    assert not conversion._can_two_pass(".webm", conversion.SpeedTier.FAST)
+    assert conversion._can_two_pass(".webm", conversion.SpeedTier.BALANCED)
+    assert conversion._can_two_pass(".mp4", conversion.SpeedTier.FAST)
+
+
+def test_encode_options_audio_only():
+    plan = conversion.plan_encode(
+        create_info(duration=600, has_video=False), ".mp3", 10 * 1024 * 1024
+    )
+    options = conversion._encode_options(
+        ".mp3", plan, conversion.SpeedTier.FAST, threads=4
+    )
+
+    assert "c:v" not in options
+    assert "threads" not in options
+
+
+def test_encoder_threads(monkeypatch):
+    monkeypatch.setattr(conversion, "FFMPEG_CPU_AFFINITY", [0, 1, 2, 3, 4])
+
+    assert conversion.encoder_threads(2) == 2
+    assert conversion.encoder_threads(8) == 1
+
+
+@pytest.mark.asyncio
+async def test_video_to_gif_reuses_palette(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversion, "GIF_MAX_DURATION", 2)
+
+    input_path = str(tmp_path / "input.mp4")
+    (
+        ffmpeg.input("testsrc2=size=320x240:rate=25:d=4", f="lavfi")
+        .output(input_path, vcodec="libx264", pix_fmt="yuv420p")
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+    calls = []
+    gif_palette = conversion.gif_palette
+
+    async def _gif_palette(*args, **kwargs):
+        calls.append(args)
+        await gif_palette(*args, **kwargs)
+
+    monkeypatch.setattr(conversion, "gif_palette", _gif_palette)
+
+    palettes = {}
+
+    for width in (240, 120):
+        plan = conversion._plan(width=width, fps=10, max_colors=16)
+        await conversion.video_to_gif(
+            input_path, str(tmp_path / f"{width}.gif"), plan=plan, palettes=palettes
+        )
+
+    # The second size used the colors picked for the first.
+    assert len(calls) == 1
+    assert list(palettes) == [16]
+
+    frames, _ = (
+        ffmpeg.input(str(tmp_path / "120.gif"))
+        .output("pipe:", f="rawvideo", pix_fmt="gray")
+        .run(capture_stdout=True, quiet=True)
+    )
+
+    # Cut off after two seconds, at ten frames a second.
+    assert len(frames) == 120 * 90 * 20
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("keyint,runs", [(1000, 2), (10, 1)])
+async def test_gif_palette_few_keyframes(tmp_path, monkeypatch, keyint, runs):
+    input_path = str(tmp_path / "input.mp4")
+    (
+        ffmpeg.input("testsrc2=size=320x240:rate=25:d=4", f="lavfi")
+        .output(input_path, vcodec="libx264", pix_fmt="yuv420p", g=keyint)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+    commands = []
+    run_ffmpeg = conversion.run_ffmpeg
+
+    async def _run_ffmpeg(cmd, *args, **kwargs):
+        commands.append(cmd.compile())
+        await run_ffmpeg(cmd, *args, **kwargs)
+
+    monkeypatch.setattr(conversion, "run_ffmpeg", _run_ffmpeg)
+
+    path_palette = str(tmp_path / "palette.png")
+    await conversion.gif_palette(input_path, path_palette, 32)
+
+    # With a single keyframe, the colors are picked again from frames through the clip.
+    assert len(commands) == runs
+    assert ("-skip_frame" in commands[-1]) == (runs == 1)
+    assert os.path.getsize(path_palette) > 0
@@ -0,0 +1,193 @@
+import hashlib
+import os
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from src import downloader
+from src.exceptions import DownloadTooLargeException
+
+pytest_plugins = ("pytest_asyncio",)
+
+DATA = bytes(range(256)) * 1024
+
+
+@pytest_asyncio.fixture
+async def server():
+    """Serves `DATA` both with and without support for range requests."""
+
+    async def ranged(request):
+        return web.Response(body=DATA, content_type="audio/mpeg")
+
+    async def unranged(request):
+        return web.Response(
+            body=DATA, content_type="audio/mpeg", headers={"Accept-Ranges": "none"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/ranged", ranged)
+    app.router.add_get("/unranged", unranged)
+
+    # `web.Response` ignores the range header, so only answer it on one route.
+    @web.middleware
+    async def range_middleware(request, handler):
+        if request.path != "/ranged" or request.http_range.start is None:
+            return await handler(request)
+
+        chunk = DATA[request.http_range]
+        start = request.http_range.start
+
+        return web.Response(
+            status=206,
+            body=chunk,
+            content_type="audio/mpeg",
+            headers={
+                "Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{len(DATA)}"
+            },
+        )
+
+    app.middlewares.append(range_middleware)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+
+    yield f"http://127.0.0.1:{port}"
+
+    await downloader.close()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_download_whole(server, tmp_path):
+    data = await downloader.download(
+        f"{server}/ranged", str(tmp_path / "file{ext}"), chunk_size=1000
+    )
+
+    assert data["path"] == str(tmp_path / "file.mp3")
+    assert data["size"] == len(DATA)
+    assert data["total_size"] == len(DATA)
+
+    with open(data["path"], "rb") as file:
+        assert file.read() == DATA
+
+
+@pytest.mark.asyncio
+async def test_download_digest(server, tmp_path):
+    digest = hashlib.sha1()
+
+    await downloader.download(
+        f"{server}/ranged", str(tmp_path / "file"), chunk_size=1000, digest=digest
+    )
+
+    assert digest.hexdigest() == hashlib.sha1(DATA).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_download_error_not_hidden(server, tmp_path, monkeypatch):
+    """Failing before the file exists raises the original error, rather than one
+    from cleaning up a file that was never written."""
+
+    def open_denied(*args, **kwargs):
+        raise PermissionError("denied")
+
+    monkeypatch.setattr(downloader.aiofiles, "open", open_denied)
+
+    with pytest.raises(PermissionError):
+        await downloader.download(f"{server}/ranged", str(tmp_path / "file"))
+
+
+@pytest.mark.asyncio
+async def test_download_reuses_session(server, tmp_path):
+    session = downloader.get_session()
+
+    await downloader.download(f"{server}/ranged", str(tmp_path / "a{ext}"))
+    await downloader.download(f"{server}/ranged", str(tmp_path / "b{ext}"))
+
+    assert downloader.get_session() is session
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["ranged", "unranged"])
+async def test_download_range(server, tmp_path, route):
+    data = await downloader.download(
+        f"{server}/{route}",
+        str(tmp_path / "file{ext}"),
+        byte_range=(1000, 4999),
+        chunk_size=1024,
+    )
+
+    assert data["size"] == 4000
+    assert data["total_size"] == len(DATA)
+    assert data["is_partial"]
+
+    with open(data["path"], "rb") as file:
+        assert file.read() == DATA[1000:5000]
+
+
+@pytest.mark.asyncio
+async def test_download_too_large(server, tmp_path):
+    with pytest.raises(DownloadTooLargeException):
+        await downloader.download(
+            f"{server}/ranged", str(tmp_path / "file{ext}"), max_size=1000
+        )
+
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.asyncio
+async def test_download_range_within_max_size(server, tmp_path):
+    data = await downloader.download(
+        f"{server}/unranged",
+        str(tmp_path / "file{ext}"),
+        max_size=1000,
+        byte_range=(0, 999),
+    )
+
+    assert data["size"] == 1000
+
+
+def test_segments(monkeypatch):
+    monkeypatch.setattr(downloader, "SEGMENT_MIN_SIZE", 100)
+
+    assert downloader._segments(1000, 4) == [
+        (0, 249),
+        (250, 499),
+        (500, 749),
+        (750, 999),
+    ]
+    assert downloader._segments(250, 4) == [(0, 124), (125, 249)]
+    assert downloader._segments(50, 4) == [(0, 49)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["ranged", "unranged"])
+async def test_download_segmented(server, tmp_path, monkeypatch, route):
+    monkeypatch.setattr(downloader, "SEGMENT_MIN_SIZE", 16 * 1024)
+
+    data = await downloader.download_segmented(
+        f"{server}/{route}", str(tmp_path / "file{ext}"), segments=4
+    )
+
+    assert data["size"] == len(DATA)
+    assert not data["is_partial"]
+
+    with open(data["path"], "rb") as file:
+        assert file.read() == DATA
+
+
+@pytest.mark.asyncio
+async def test_download_segmented_too_large(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "SEGMENT_MIN_SIZE", 16 * 1024)
+
+    with pytest.raises(DownloadTooLargeException):
+        await downloader.download_segmented(
+            f"{server}/ranged", str(tmp_path / "file{ext}"), max_size=1000
+        )
+
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+import pytest_asyncio
+
+from src import cache, fingerprint
+from src.conversion import SAMPLE_RATE
+
+pytest_plugins = ("pytest_asyncio",)
+
+SONG = {
+    "title": "Song",
+    "artist": "Artist",
+    "album": None,
+    "album_art": None,
+    "label": None,
+    "release_year": None,
+}
+
+
+@pytest_asyncio.fixture
+async def fallback_cache(monkeypatch):
+    """A cache that can't reach Redis, and so uses the fallback."""
+    instance = cache.Cache("redis://127.0.0.1:1")
+    monkeypatch.setattr(cache, "_cache", instance)
+
+    yield instance
+
+    await instance.close()
+
+
+def create_audio(seed: int, seconds: int = 20) -> np.ndarray:
+    """Short notes of a few random tones each, with a burst of noise at the start of
+    every one, which is close enough to music for fingerprinting."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(SAMPLE_RATE // 8) / SAMPLE_RATE
+    notes = []
+
+    for _ in range(seconds * 8):
+        note = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(100, 3000, 6))
+        note = note * np.exp(-t * rng.uniform(2, 20))
+        note += rng.normal(0, 0.3, len(t)) * np.exp(-t * 40)
+        notes.append(note)
+
+    return np.concatenate(notes)
+
+
+def create_song(seed: int, seconds: int = 20) -> np.ndarray:
+    """Notes of the same scale at the same tempo, played on the same instrument, so
+    that two of them are far more alike than two pieces of unrelated audio."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(SAMPLE_RATE // 4) / SAMPLE_RATE
+    scale = 220 * 2 ** (np.array([0, 2, 4, 5, 7, 9, 11, 12]) / 12)
+    notes = []
+
+    for _ in range(seconds * 4):
+        pitch = rng.choice(scale)
+        note = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 8))
+        notes.append(note * np.exp(-t * 6))
+
+    return np.concatenate(notes)
+
+
+def to_pcm(samples: np.ndarray) -> bytes:
+    return (samples / np.abs(samples).max() * 12_000).astype("<i2").tobytes()
+
+
+def degrade(samples: np.ndarray, seed: int = 0) -> np.ndarray:
+    return samples + np.random.default_rng(seed).normal(0, 0.05, len(samples))
+
+
+def window(samples: np.ndarray, start: float, duration: float = 15) -> np.ndarray:
+    return samples[int(start * SAMPLE_RATE) : int((start + duration) * SAMPLE_RATE)]
+
+
+def test_compute():
+    data_fingerprint = fingerprint.compute(to_pcm(window(create_audio(1), 0)))
+
+    assert data_fingerprint is not None
+    assert data_fingerprint.dtype == np.uint32
+    assert len(data_fingerprint) == (15 * SAMPLE_RATE - 2048) // 256
+
+    assert fingerprint.compute(bytes(15 * SAMPLE_RATE * 2)) is None
+    assert fingerprint.compute(to_pcm(window(create_audio(1), 0, 1))) is None
+
+
+def test_bit_error_rate():
+    audio = create_audio(1)
+    data_a = fingerprint.compute(to_pcm(window(audio, 0)))
+    data_b = fingerprint.compute(to_pcm(window(degrade(audio), 0)))
+    data_other = fingerprint.compute(to_pcm(window(create_audio(2), 0)))
+
+    assert fingerprint.bit_error_rate(data_a, data_a, 0) == 0
+    assert fingerprint.bit_error_rate(data_a, data_b, 0) < 0.2
+    assert fingerprint.bit_error_rate(data_a, data_other, 0) > 0.4
+
+    # Too little overlap to compare.
+    assert fingerprint.bit_error_rate(data_a, data_b, len(data_b) - 10) is None
+
+
+def test_anchors_shared_between_offsets():
+    audio = create_audio(1)
+    data_a = fingerprint.compute(to_pcm(window(audio, 0)))
+    data_b = fingerprint.compute(to_pcm(window(audio, 4)))
+
+    positions_a = {value: position for position, value in fingerprint.anchors(data_a)}
+    offsets = [
+        positions_a[value] - position
+        for position, value in fingerprint.anchors(data_b)
+        if value in positions_a
+    ]
+
+    # Four seconds is 250 frames in.
+    assert offsets.count(250) >= fingerprint.ANCHOR_MODULUS // 8
+
+
+def test_roundtrip_bytes():
+    data_fingerprint = fingerprint.compute(to_pcm(window(create_audio(1), 0)))
+
+    assert np.array_equal(
+        fingerprint.from_bytes(fingerprint.to_bytes(data_fingerprint)),
+        data_fingerprint,
+    )
+
+
+@pytest.mark.asyncio
+async def test_cache_exact(fallback_cache):
+    data_fingerprint = fingerprint.compute(to_pcm(window(create_audio(1), 0)))
+
+    assert await cache.get_from_fingerprint(data_fingerprint) is None
+
+    await cache.set_fingerprint(data_fingerprint, SONG)
+
+    assert await cache.get_from_fingerprint(data_fingerprint) == SONG
+
+
+@pytest.mark.asyncio
+async def test_cache_similar(fallback_cache):
+    audio = create_audio(1)
+
+    await cache.set_fingerprint(fingerprint.compute(to_pcm(window(audio, 0))), SONG)
+
+    # Re-encoded, and trimmed a little differently.
+    data_similar = fingerprint.compute(to_pcm(window(degrade(audio), 3.01)))
+    data_other = fingerprint.compute(to_pcm(window(create_audio(2), 3)))
+
+    assert await cache.get_from_fingerprint(data_similar) == SONG
+    assert await cache.get_from_fingerprint(data_other) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "seed, seed_other, time_start", [(0, 107, 0), (4, 107, 2), (6, 100, 0)]
+)
+async def test_cache_similar_songs_differ(fallback_cache, seed, seed_other, time_start):
+    """Songs alike enough that a couple of seconds of them line up closely mustn't
+    be mistaken for one another."""
+    await cache.set_fingerprint(
+        fingerprint.compute(to_pcm(window(create_song(seed), 0))), SONG
+    )
+
+    data_other = fingerprint.compute(
+        to_pcm(window(create_song(seed_other), time_start))
+    )
+    assert await cache.get_from_fingerprint(data_other) is None
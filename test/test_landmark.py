@@ -0,0 +1,117 @@
+import wave
+
+import numpy as np
+import pytest
+
+from src import landmark, recognition
+from src.api import song
+
+pytest_plugins = ("pytest_asyncio",)
+
+SAMPLE_RATE = 16000
+
+
+def create_music(seed: int, seconds: int) -> np.ndarray:
+    """Eight notes a second, each a few decaying tones with a burst of noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(SAMPLE_RATE // 8) / SAMPLE_RATE
+    notes = []
+
+    for _ in range(seconds * 8):
+        note = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(100, 3000, 6))
+        note *= np.exp(-t * rng.uniform(2, 20))
+        note += rng.normal(0, 0.3, len(t)) * np.exp(-t * 40)
+        notes.append(note)
+
+    samples = np.concatenate(notes)
+
+    return (samples / np.abs(samples).max() * 12000).astype("<i2")
+
+
+@pytest.fixture(scope="module")
+def library(tmp_path_factory):
+    path = tmp_path_factory.mktemp("library")
+
+    for seed in range(3):
+        with wave.open(str(path / f"song{seed}.wav"), "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(SAMPLE_RATE)
+            file.writeframes(create_music(seed, 30).tobytes())
+
+    index = landmark.LandmarkIndex.build(
+        sorted(str(file) for file in path.iterdir()), processes=2
+    )
+    index_path = str(path / "landmarks.npz")
+    index.save(index_path)
+
+    return index_path
+
+
+def test_match(library):
+    index = landmark.LandmarkIndex.load(library)
+
+    assert len(index) == 3
+    assert index.songs[1]["title"] == "song1"
+
+    samples = create_music(1, 30).astype(np.float32)[10 * SAMPLE_RATE :]
+    samples += np.random.default_rng(0).normal(0, 3000, len(samples))
+
+    position, offset, count = index.match(samples)
+
+    assert position == 1
+    assert offset == pytest.approx(10, abs=0.05)
+    assert count >= landmark.MIN_MATCHES
+
+    assert index.match(create_music(99, 15).astype(np.float32)) is None
+
+
+@pytest.mark.asyncio
+async def test_recognizer(library):
+    recognizer = landmark.LandmarkRecognizer(library)
+
+    data = create_music(2, 30)[5 * SAMPLE_RATE : 20 * SAMPLE_RATE].tobytes()
+    response = await recognizer.recognize(data)
+
+    assert song.create(response)["title"] == "song2"
+    assert response["matches"][0]["offset"] == pytest.approx(5, abs=0.05)
+
+    assert await recognizer.recognize(create_music(99, 15).tobytes()) == {"matches": []}
+
+
+@pytest.mark.asyncio
+async def test_tiered_recognizer(library):
+    calls = []
+
+    class FakeRecognizer(recognition.Recognizer):
+        async def recognize(self, data):
+            calls.append(data)
+            return {"matches": []}
+
+    fallback = FakeRecognizer()
+    recognizer = recognition.TieredRecognizer(
+        [landmark.LandmarkRecognizer(library), fallback]
+    )
+
+    known = create_music(0, 30)[: 15 * SAMPLE_RATE].tobytes()
+    unknown = create_music(99, 15).tobytes()
+
+    assert song.create(await recognizer.recognize(known))["title"] == "song0"
+    assert await recognizer.recognize(unknown) == {"matches": []}
+
+    # Only the song missing from the library was sent on to the next tier.
+    assert calls == [unknown]
+
+
+def test_create_recognizer():
+    assert isinstance(
+        recognition.create_recognizer("shazam"), recognition.ShazamRecognizer
+    )
+
+    tiered = recognition.create_recognizer("local+shazam")
+
+    assert isinstance(tiered, recognition.TieredRecognizer)
+    assert isinstance(tiered.tiers[0], landmark.LandmarkRecognizer)
+
+    with pytest.raises(ValueError):
+        recognition.create_recognizer("local+unknown")
@@ -0,0 +1,123 @@
+import asyncio
+import socket
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+import pytest_asyncio
+
+from src import cache, conversion, metrics, partial, shazam
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest_asyncio.fixture
+async def fallback_cache(monkeypatch):
+    instance = cache.Cache("redis://127.0.0.1:1")
+    monkeypatch.setattr(cache, "_cache", instance)
+
+    yield instance
+
+    await instance.close()
+
+
+def test_histogram():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("stage",), (0.1, 1))
+
+    histogram.observe(0.05, "a")
+    histogram.observe(0.1, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5, "a")
+
+    lines = histogram.render()
+
+    assert 'mediautility_test_seconds_bucket{stage="a",le="0.1"} 2' in lines
+    assert 'mediautility_test_seconds_bucket{stage="a",le="1"} 3' in lines
+    assert 'mediautility_test_seconds_bucket{stage="a",le="+Inf"} 4' in lines
+    assert 'mediautility_test_seconds_count{stage="a"} 4' in lines
+    assert histogram.count("a") == 4
+    assert histogram.count("b") == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_lookups(fallback_cache):
+    media_info = {"id": "id", "extractor_key": "Fake"}
+    lookups = {
+        result: metrics.CACHE_LOOKUPS.get("song", result)
+        for result in ("hit", "miss", "negative")
+    }
+    cache_gets = metrics.STAGE_SECONDS.count("cache_get")
+
+    await cache.set_song_from_info(
+        media_info,
+        {
+            "title": "Title",
+            "artist": "Artist",
+            "album": None,
+            "album_art": None,
+            "label": None,
+            "release_year": None,
+        },
+        0,
+    )
+    await cache.set_empty_from_info(media_info, 60)
+    await cache.get_many_from_info(media_info, [0, 60, 120])
+
+    assert metrics.CACHE_LOOKUPS.get("song", "hit") == lookups["hit"] + 1
+    assert metrics.CACHE_LOOKUPS.get("song", "miss") == lookups["miss"] + 1
+    assert metrics.CACHE_LOOKUPS.get("song", "negative") == lookups["negative"] + 1
+    assert metrics.STAGE_SECONDS.count("cache_get") > cache_gets
+
+
+@pytest.mark.asyncio
+async def test_slice_stages(monkeypatch):
+    @asynccontextmanager
+    async def window(link, time_start, time_duration, duration=None):
+        await asyncio.sleep(0.2)
+        yield link, 0
+
+    async def audio_slice(source, time_start, time_duration):
+        return b"audio"
+
+    monkeypatch.setattr(partial, "window", window)
+    monkeypatch.setattr(conversion, "audio_slice", audio_slice)
+
+    observed = {}
+    monkeypatch.setattr(
+        metrics.STAGE_SECONDS,
+        "observe",
+        lambda value, stage: observed.setdefault(stage, value),
+    )
+
+    assert await shazam._slice_window("https://a.com/x", None, 0, 15) == b"audio"
+
+    # The fetch isn't counted as part of slicing.
+    assert observed.keys() == {"slice_fetch", "slice_wait", "slice"}
+    assert observed["slice_fetch"] >= 0.2
+    assert observed["slice"] < 0.1
+
+
+@pytest.mark.asyncio
+async def test_server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    with metrics.stage("slice"):
+        pass
+
+    runner = await metrics.start_server("127.0.0.1", port)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                assert response.status == 200
+                text = await response.text()
+    finally:
+        await runner.cleanup()
+
+    assert 'mediautility_stage_seconds_count{stage="slice"}' in text
+    assert 'mediautility_jobs{job_class="transcode",state="queued"} 0' in text
+    assert "mediautility_recognition_requests" in text
+
+    assert await metrics.start_server(port=None) is None
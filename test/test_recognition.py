@@ -0,0 +1,205 @@
+import asyncio
+import time
+
+import pytest
+
+from src import recognition
+from src.exceptions import RecognitionUnavailableException
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def create_client(func, **kwargs) -> recognition.RecognitionClient:
+    options = {
+        "rate": 0,
+        "burst": 1,
+        "concurrency_min": 1,
+        "concurrency_max": 8,
+        "retries": 3,
+        "backoff_base": 0.001,
+        "backoff_max": 0.01,
+        "breaker_threshold": 3,
+        "breaker_reset": 30,
+    }
+    options.update(kwargs)
+
+    return recognition.RecognitionClient(func, **options)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces():
+    bucket = recognition.TokenBucket(rate=50, burst=2)
+    time_start = time.monotonic()
+
+    for _ in range(6):
+        await bucket.acquire()
+
+    # The first two are from the burst, the rest come at 50 a second.
+    assert time.monotonic() - time_start >= 4 / 50 * 0.9
+
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = recognition.TokenBucket(rate=10, burst=5, clock=clock)
+
+    bucket.pause(2)
+    assert bucket.tokens == -20
+
+    clock.now = 2.1
+    assert 0 < bucket.tokens < 2
+
+
+def test_adaptive_limiter():
+    limiter = recognition.AdaptiveLimiter(8, 1, 8)
+
+    limiter.on_failure()
+    limiter.on_failure()
+    assert limiter.limit == 2
+
+    for _ in range(10):
+        limiter.on_success()
+
+    assert 4 <= limiter.limit <= 5
+
+    for _ in range(10):
+        limiter.on_failure()
+
+    assert limiter.limit == 1
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = recognition.CircuitBreaker(threshold=2, reset_timeout=10, clock=clock)
+
+    assert not breaker.check()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    assert breaker.state == recognition.BreakerState.OPEN
+
+    with pytest.raises(RecognitionUnavailableException):
+        breaker.check()
+
+    # Only one request at a time tests whether the service recovered.
+    clock.now = 10
+
+    assert breaker.check()
+
+    with pytest.raises(RecognitionUnavailableException):
+        breaker.check()
+
+    breaker.record_failure()
+    assert breaker.state == recognition.BreakerState.OPEN
+
+    clock.now = 20
+
+    assert breaker.check()
+    breaker.record_success()
+
+    assert breaker.state == recognition.BreakerState.CLOSED
+    assert breaker.opened == 2
+
+
+@pytest.mark.asyncio
+async def test_client_retries_when_throttled():
+    attempts = []
+
+    async def func(data):
+        attempts.append(data)
+
+        if len(attempts) <= 2:
+            raise recognition.UpstreamException(429)
+
+        return {"matches": []}
+
+    client = create_client(func)
+
+    assert await client.recognize(b"audio") == {"matches": []}
+
+    stats = client.stats()
+
+    assert len(attempts) == 3
+    assert stats["throttled"] == 2
+    assert stats["retried"] == 2
+    assert stats["concurrency_limit"] == 2
+    assert stats["latency"]["count"] == 3
+    assert stats["queue_wait"]["count"] == 3
+
+
+@pytest.mark.asyncio
+async def test_client_fails_fast_when_breaker_open():
+    calls = 0
+
+    async def func(data):
+        nonlocal calls
+        calls += 1
+
+        raise recognition.UpstreamException(503)
+
+    client = create_client(func, retries=1)
+
+    with pytest.raises(recognition.UpstreamException):
+        await client.recognize(b"audio")
+
+    # The third failure in a row opens the breaker, so the retry isn't sent.
+    with pytest.raises(RecognitionUnavailableException):
+        await client.recognize(b"audio")
+
+    assert calls == 3
+
+    with pytest.raises(RecognitionUnavailableException):
+        await client.recognize(b"audio")
+
+    assert calls == 3
+    assert client.stats()["breaker"] == "open"
+    assert client.stats()["rejected"] == 2
+
+
+@pytest.mark.asyncio
+async def test_client_bad_request_not_retried():
+    calls = 0
+
+    async def func(data):
+        nonlocal calls
+        calls += 1
+
+        raise ValueError("not audio")
+
+    client = create_client(func)
+
+    with pytest.raises(ValueError):
+        await client.recognize(b"audio")
+
+    assert calls == 1
+    assert client.stats()["failures"] == 0
+
+
+@pytest.mark.asyncio
+async def test_client_limits_concurrency():
+    in_flight = 0
+    in_flight_max = 0
+
+    async def func(data):
+        nonlocal in_flight, in_flight_max
+
+        in_flight += 1
+        in_flight_max = max(in_flight_max, in_flight)
+
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+        return {}
+
+    client = create_client(func, concurrency_max=3)
+
+    await asyncio.gather(*[client.recognize(b"audio") for _ in range(10)])
+
+    assert in_flight_max == 3
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import pytest
+
+from src import scheduler
+from src.exceptions import SchedulerBusyException
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def create_scheduler(**kwargs) -> scheduler.Scheduler:
+    options = {
+        "limits": {job_class: 1 for job_class in scheduler.JobClass},
+        "queue_limits": {job_class: 4 for job_class in scheduler.JobClass},
+        "cpu_slots": 1,
+    }
+    options.update(kwargs)
+
+    return scheduler.Scheduler(**options)
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_order():
+    """Waiters with a lower priority value should be given the slot first."""
+    limiter = scheduler.PriorityLimiter(1)
+    order = []
+
+    async def job(name: str, priority: int):
+        async with limiter.slot(priority):
+            order.append(name)
+
+    await limiter.acquire()
+
+    tasks = [
+        asyncio.ensure_future(job("transcode", 2)),
+        asyncio.ensure_future(job("slice", 1)),
+        asyncio.ensure_future(job("extract", 0)),
+    ]
+
+    await asyncio.sleep(0)
+    limiter.release()
+    await asyncio.gather(*tasks)
+
+    assert order == ["extract", "slice", "transcode"]
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_cancelled_waiter():
+    limiter = scheduler.PriorityLimiter(1)
+
+    await limiter.acquire()
+
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.sleep(0)
+
+    limiter.release()
+
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_run_uses_class_threads():
+    jobs = create_scheduler()
+
+    name = await jobs.run(
+        scheduler.JobClass.EXTRACT, lambda: threading.current_thread().name
+    )
+
+    assert name.startswith("job-extract")
+
+
+@pytest.mark.asyncio
+async def test_queue_full_rejected():
+    jobs = create_scheduler(
+        queue_limits={job_class: 1 for job_class in scheduler.JobClass}
+    )
+
+    async with jobs.slot(scheduler.JobClass.TRANSCODE):
+        with pytest.raises(SchedulerBusyException):
+            async with jobs.slot(scheduler.JobClass.TRANSCODE):
+                pass
+
+        # Other classes have their own queue.
+        async with jobs.slot(scheduler.JobClass.EXTRACT):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_admit_user_limit():
+    jobs = create_scheduler(user_limit=1)
+
+    async with jobs.admit(1, 100):
+        with pytest.raises(SchedulerBusyException):
+            async with jobs.admit(1, 100):
+                pass
+
+        async with jobs.admit(1, 200):
+            pass
+
+    async with jobs.admit(1, 100):
+        pass
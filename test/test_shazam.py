@@ -1,7 +1,10 @@
+from contextlib import asynccontextmanager
+
 import pytest
+import pytest_asyncio
 
-from src import shazam
-from src.exceptions import InvalidLinkException
+from src import cache, conversion, partial, shazam
+from src.exceptions import InvalidLinkException, RecognitionUnavailableException
 
 pytest_plugins = ("pytest_asyncio",)
 
@@ -90,3 +93,59 @@ async def test_song_playlist_index():
     assert song_two is not None
 
     assert song_one != song_two
+
+
+@pytest_asyncio.fixture
+async def fallback_cache(monkeypatch):
+    """A cache that can't reach Redis, and so uses the fallback."""
+    instance = cache.Cache("redis://127.0.0.1:1")
+    monkeypatch.setattr(cache, "_cache", instance)
+
+    yield instance
+
+    await instance.close()
+
+
+@pytest.mark.asyncio
+async def test_scan_recognition_unavailable(fallback_cache, monkeypatch):
+    """Every window failing because recognition is down isn't the same as there
+    being no songs."""
+
+    async def download_media(*args, **kwargs):
+        return {"id": "abc", "extractor_key": "Generic", "duration": 600}
+
+    @asynccontextmanager
+    async def media_source(*args):
+        yield "source"
+
+    async def recognize_window(*args):
+        raise RecognitionUnavailableException
+
+    monkeypatch.setattr(shazam, "download_media", download_media)
+    monkeypatch.setattr(shazam, "_media_source", media_source)
+    monkeypatch.setattr(shazam, "_recognize_window", recognize_window)
+
+    with pytest.raises(RecognitionUnavailableException):
+        await shazam.scan_songs("https://example.com/mix", window_count=3)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "protocol,source", [("https", "window"), ("m3u8_native", "https://a.com/x.m3u8")]
+)
+async def test_slice_window_direct_only(monkeypatch, protocol, source):
+    @asynccontextmanager
+    async def window(link, time_start, time_duration, duration=None):
+        yield "window", 0
+
+    async def audio_slice(source, time_start, time_duration):
+        return source.encode("utf-8")
+
+    monkeypatch.setattr(partial, "window", window)
+    monkeypatch.setattr(conversion, "audio_slice", audio_slice)
+
+    data_media = {"url": "https://a.com/x.m3u8", "protocol": protocol}
+
+    assert await shazam._slice_window(data_media["url"], data_media, 0, 15) == (
+        source.encode("utf-8")
+    )
@@ -44,3 +44,12 @@ def test_soundcloud():
         )
         == 4608
     )
+
+
+def test_dedupe_tracklist():
+    song_one = {"title": "One", "artist": "A"}
+    song_two = {"title": "Two", "artist": "B"}
+
+    assert shazam._dedupe_tracklist(
+        [(0, song_one), (60, song_one), (120, None), (180, song_two), (240, song_one)]
+    ) == [(0, song_one), (180, song_two), (240, song_one)]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from src.singleflight import SingleFlight
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_coalesced():
+    """Concurrent calls for the same key should only run the work once."""
+    flight = SingleFlight()
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "song"
+
+    results = await asyncio.gather(*[flight.run("key", work) for _ in range(5)])
+
+    assert results == ["song"] * 5
+    assert calls == 1
+    assert flight.coalesced == 4
+    assert len(flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_different_keys_not_coalesced():
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(flight.run("a", work), flight.run("b", work))
+
+    assert flight.coalesced == 0
+
+
+@pytest.mark.asyncio
+async def test_exception_raised_to_every_caller():
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError
+
+    results = await asyncio.gather(
+        flight.run("key", work), flight.run("key", work), return_exceptions=True
+    )
+
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_others():
+    """One caller giving up shouldn't cancel the work for everybody else."""
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return 1
+
+    first = asyncio.ensure_future(flight.run("key", work))
+    second = asyncio.ensure_future(flight.run("key", work))
+
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == 1
@@ -0,0 +1,140 @@
+import asyncio
+import os
+
+import pytest
+
+from src import store
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def write(path: str, size: int) -> None:
+    with open(path, "wb") as file:
+        file.write(b"x" * size)
+
+
+def create_download(size: int, calls: list):
+    async def download(path: str) -> None:
+        calls.append(path)
+        await asyncio.sleep(0.01)
+        write(path, size)
+
+    return download
+
+
+def test_evicts_least_recently_used(tmp_path):
+    media_store = store.MediaStore(str(tmp_path / "media"), max_bytes=250)
+
+    for key in ("a", "b"):
+        write(str(tmp_path / key), 100)
+        media_store.put(key, str(tmp_path / key))
+
+    assert media_store.get("a") is not None
+
+    write(str(tmp_path / "c"), 100)
+    media_store.put("c", str(tmp_path / "c"))
+
+    assert media_store.get("b") is None
+    assert media_store.get("a") is not None
+    assert media_store.stats()["bytes"] == 200
+    assert media_store.stats()["evictions"] == 1
+
+    # Files are found again after a restart, in the order they were last used.
+    media_store = store.MediaStore(str(tmp_path / "media"), max_bytes=150)
+
+    assert media_store.get("a") is not None
+    assert media_store.get("c") is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_downloads_once(tmp_path):
+    media_store = store.MediaStore(str(tmp_path), max_bytes=1000)
+    calls = []
+    download = create_download(100, calls)
+
+    async def fetch():
+        async with media_store.fetch("key", "video.mp4", download) as path:
+            with open(path, "rb") as file:
+                return len(file.read())
+
+    assert await asyncio.gather(fetch(), fetch()) == [100, 100]
+    assert await fetch() == 100
+
+    assert len(calls) == 1
+    assert media_store.stats()["hits"] == 1
+
+    # Downloads happen out of the way, and only the finished file is kept.
+    assert os.path.dirname(os.path.dirname(calls[0])) == str(tmp_path / ".tmp")
+    assert os.listdir(tmp_path / ".tmp") == []
+
+
+@pytest.mark.asyncio
+async def test_fetch_failed(tmp_path):
+    media_store = store.MediaStore(str(tmp_path), max_bytes=1000)
+
+    async def download(path: str) -> None:
+        pass
+
+    async with media_store.fetch("key", "video.mp4", download) as path:
+        assert path is None
+
+    async def download_error(path: str) -> None:
+        write(path, 10)
+        raise RuntimeError("download failed")
+
+    with pytest.raises(RuntimeError):
+        async with media_store.fetch("key", "video.mp4", download_error):
+            pass
+
+    assert media_store.stats()["entries"] == 0
+    assert os.listdir(tmp_path / ".tmp") == []
+
+
+@pytest.mark.asyncio
+async def test_fetch_larger_than_store(tmp_path):
+    media_store = store.MediaStore(str(tmp_path / "media"), max_bytes=50)
+
+    async with media_store.fetch("key", "video.mp4", create_download(100, [])) as path:
+        # Kept until it has been used, even though it doesn't fit.
+        assert os.path.getsize(path) == 100
+
+    assert not os.path.exists(path)
+    assert media_store.stats()["bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_disabled(tmp_path):
+    media_store = store.MediaStore(str(tmp_path / "media"), max_bytes=0)
+    calls = []
+
+    for _ in range(2):
+        async with media_store.fetch(
+            "key", "video.mp4", create_download(100, calls)
+        ) as path:
+            assert os.path.getsize(path) == 100
+
+        assert not os.path.exists(path)
+
+    assert len(calls) == 2
+    assert not os.path.exists(tmp_path / "media")
+
+
+def test_media_key():
+    assert store.media_key("Reddit", "abc", None) == store.media_key(
+        "Reddit", "abc", "default"
+    )
+    assert store.media_key("Reddit", "abc", None) != store.media_key(
+        "Reddit", "abd", None
+    )
+
+
+def test_conversion_key():
+    assert store.conversion_key("abc", ".mp4", None) == store.conversion_key(
+        "abc", ".mp4", 0
+    )
+    assert store.conversion_key("abc", ".mp4", None) != store.conversion_key(
+        "abc", ".webm", None
+    )
+    assert store.conversion_key("abc", ".mp4", 8000000) != store.conversion_key(
+        "abc", ".mp4", 25000000
+    )
@@ -18,3 +18,56 @@ def test_timestamp_valid_hms():
 def test_timestamp_invalid():
     with pytest.raises(ValueError):
         utility.timestamp_to_seconds("invalid, this is a string")
+
+
+def test_normalize_url_equivalent():
+    assert utility.normalize_url(
+        "HTTPS://WWW.YouTube.com:443/watch/?v=abc&utm_source=x&si=123"
+    ) == utility.normalize_url("https://www.youtube.com/watch?v=abc")
+
+
+def test_normalize_url_sorts_query():
+    assert utility.normalize_url("https://a.com/x?b=2&a=1") == (
+        "https://a.com/x?a=1&b=2"
+    )
+
+
+def test_normalize_url_keeps_fragment():
+    assert utility.normalize_url("https://soundcloud.com/a/b#t=1%3A32").endswith(
+        "#t=1%3A32"
+    )
+
+
+def test_normalize_url_invalid_port():
+    assert utility.normalize_url("https://example.com:99999/x") == (
+        "https://example.com:99999/x"
+    )
+
+
+def test_url_expiry():
+    assert utility.url_expiry("https://rr1.googlevideo.com/x?expire=1700000000") == (
+        1700000000
+    )
+
+
+def test_url_expiry_hex():
+    assert utility.url_expiry("https://scontent.cdninstagram.com/x?oe=6553F100") == (
+        0x6553F100
+    )
+
+
+def test_url_expiry_discord():
+    link = "https://cdn.discordapp.com/attachments/1/2/a.mp4?ex=6553F100&is=1&hm=ab"
+    assert utility.url_expiry(link) == 0x6553F100
+
+
+def test_url_expiry_missing():
+    assert utility.url_expiry("https://example.com/video.mp4") is None
+
+
+def test_seconds_to_timestamp_ms():
+    assert utility.seconds_to_timestamp(225) == "3:45"
+
+
+def test_seconds_to_timestamp_hms():
+    assert utility.seconds_to_timestamp(5661) == "1:34:21"